@@ -1,22 +1,28 @@
-import simples3
-from tamaraw.util import load_config
-import os, sys
-config = load_config()
-bucket = simples3.S3Bucket(str(config['simples3']['bucket']),
-                           str(config['simples3']['credentials']['aws_access_key_id']),
-                           str(config['simples3']['credentials']['aws_secret_access_key']),
-                           str(config['simples3']['baseurl']))
+#!/usr/bin/env python
+# fills the image cache of the simples3 store, e.g. to warm up a new node
+from tamaraw.util import load_config, parse_size
+from tamaraw.storage import store_from_config
+from tamaraw.prefetch import Prefetcher, top_keys
+import sys, logging, argparse
+
+parser = argparse.ArgumentParser(description='download images from s3 into the local cache')
+parser.add_argument('--select', choices=('all', 'originals', 'thumbnails'), default='all')
+parser.add_argument('--log', help='nginx access log, used with --top')
+parser.add_argument('--top', type=int, help='only cache the TOP most requested files of the access log')
+parser.add_argument('--threads', type=int, default=8)
+parser.add_argument('--limit', type=parse_size, help='bandwidth limit in bytes per second, e.g. 10M')
+parser.add_argument('--verify-etag', action='store_true', help='compare md5 sums of cached files with the s3 etags')
+args = parser.parse_args()
+if args.top and not args.log:
+    parser.error('--top requires --log')
 
-# if cache all. TODO cache selected
-for s3_key, _, _, _ in bucket.listdir('images_'):
-   store_key = s3_key.replace('images_', '')
-   cache_fn = config['cache']['basepath'] + '/' + store_key + '.jpg'
-   try:
-       os.stat(cache_fn)
-       print >> sys.stderr, 'not caching ' + s3_key + ' (already exists)'
-   except OSError:
-       # file does not exist
-       print >> sys.stderr, 'caching ' + s3_key + ' as ' + cache_fn
-       with open(cache_fn, 'w') as f:
-           s3file = bucket.get(s3_key)
-           f.write(s3file.read())
+config = load_config()
+if config['store'] != 'simples3':
+    print >> sys.stderr, "the image cache is only used by the simples3 store"
+    sys.exit(1)
+pool_size = max(config['simples3'].get('connection', {}).get('pool_size', 10), args.threads)
+store = store_from_config(config, logging.getLogger(), pool_size=pool_size)
+keys = top_keys(args.log, args.top) if args.top else None
+prefetcher = Prefetcher(store, args.threads, args.limit, args.verify_etag)
+stats = prefetcher.run(prefetcher.select(args.select, keys))
+sys.exit(1 if stats['failed'] else 0)
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# imports all images below a directory into one upload group. originals are stored
+# by several threads, thumbnails are created by a process pool and the images are
+# indexed with one bulk request per batch. imported files are recorded in a
+# checkpoint file, running the command again continues an interrupted ingest
+from tamaraw.util import load_config
+from tamaraw.storage import store_from_config, THUMBNAIL_SIZES
+from tamaraw.dao import ConfigDao, ImageDao
+from tamaraw.thumbnails import ThumbnailQueue
+from tamaraw.facets import configured_facet_counts
+from tamaraw.recent import configured_recent_images
+from tamaraw.ingest import Importer, Checkpoint, find_images, read_csv_properties, sidecar_properties
+import os, sys, time, uuid, logging, argparse, multiprocessing
+
+parser = argparse.ArgumentParser(description='import a directory tree of images')
+parser.add_argument('directory')
+parser.add_argument('--upload-group', help='defaults to a new one, or the one of the checkpoint')
+parser.add_argument('--checkpoint', help='defaults to <directory name>.ingest in the current directory')
+parser.add_argument('--batch-size', type=int, default=200, help='images per bulk index request')
+parser.add_argument('--threads', type=int, default=8, help='threads storing originals')
+parser.add_argument('--processes', type=int, default=None, help='thumbnail processes, defaults to the number of cores')
+parser.add_argument('--csv', help='csv file with a "filename" column and one column per property')
+parser.add_argument('--sidecars', action='store_true', help='read properties from image.json files next to the images')
+args = parser.parse_args()
+
+logging.basicConfig(level=logging.WARNING)
+logger = logging.getLogger('ingest')
+config = load_config()
+store = store_from_config(config, logger)
+dao_conf = [config['elasticsearch']['rawes'], config['elasticsearch']['indexname']]
+config_dao = ConfigDao(*dao_conf)
+image_dao = ImageDao(*dao_conf, facet_counts=configured_facet_counts(config, config_dao),
+                     recent_images=configured_recent_images(config))
+store.references = image_dao
+known_props = set(prop['key'] for prop in config_dao.get_property_config())
+thumbnail_sizes = sorted([tuple(size) for size in config.get('thumbnail_sizes', THUMBNAIL_SIZES)],
+                         key=lambda size: size[0] * size[1])
+
+directory = os.path.abspath(args.directory)
+checkpoint = Checkpoint(args.checkpoint or os.path.basename(directory) + '.ingest',
+                        args.upload_group or str(uuid.uuid4()))
+if args.upload_group and args.upload_group != checkpoint.upload_group:
+    print >> sys.stderr, "checkpoint %s belongs to upload group %s" % (checkpoint.path, checkpoint.upload_group)
+    sys.exit(1)
+csv_props = read_csv_properties(args.csv) if args.csv else {}
+unknown_props = set()
+
+def properties_for(path):
+    props = dict(csv_props.get(path) or csv_props.get(os.path.basename(path)) or {})
+    if args.sidecars:
+        props.update(sidecar_properties(os.path.join(directory, path)))
+    for key in set(props) - known_props:
+        if key not in unknown_props:
+            print >> sys.stderr, "ignoring unknown property %s" % (key,)
+            unknown_props.add(key)
+        del props[key]
+    return props
+
+paths = [path for path in find_images(directory) if path not in checkpoint]
+print >> sys.stderr, "upload group %s: %d images to import, %d already imported" % (
+    checkpoint.upload_group, len(paths), len(checkpoint.done))
+
+# at most two batches of thumbnail jobs are queued, see wait below
+thumbnail_queue = ThumbnailQueue(store, logger, args.processes or multiprocessing.cpu_count(),
+                                 max_pending=2 * args.batch_size)
+thumbnail_queue.start()
+importer = Importer(store, image_dao, logger, thumbnail_queue, thumbnail_sizes, args.threads)
+started_at = time.time()
+imported = failed = 0
+try:
+    for i in xrange(0, len(paths), args.batch_size):
+        batch = paths[i:i + args.batch_size]
+        thumbnail_queue.wait(args.batch_size)
+        files = [(open(os.path.join(directory, path), 'rb'), os.path.basename(path)) for path in batch]
+        try:
+            results = importer.import_files(checkpoint.upload_group, files, [properties_for(path) for path in batch])
+        finally:
+            for fp, _ in files:
+                fp.close()
+        for path, result in zip(batch, results):
+            if result['store_key'] != None:
+                checkpoint.add(path, result['store_key'])
+                imported += 1
+            else:
+                print >> sys.stderr, "failed to import %s: %s" % (path, result['error'])
+                failed += 1
+        checkpoint.flush()
+        elapsed = time.time() - started_at
+        print >> sys.stderr, "%d/%d imported, %d failed, %.1f images/s" % (imported, len(paths), failed,
+                                                                           imported / max(elapsed, 0.001))
+    print >> sys.stderr, "waiting for %d thumbnail jobs" % (thumbnail_queue.stats()['pending'],)
+    thumbnail_queue.wait()
+finally:
+    checkpoint.close()
+    thumbnail_queue.close()
+stats = thumbnail_queue.stats()
+elapsed = time.time() - started_at
+print >> sys.stderr, "done: %d imported, %d failed in %.0fs (%.1f images/s), thumbnails: %d created, %d failed" % (
+    imported, failed, elapsed, imported / max(elapsed, 0.001), stats['completed'], stats['failed'])
+sys.exit(1 if failed or stats['failed'] else 0)
@@ -0,0 +1,22 @@
+#!/usr/bin/env python
+# evicts rarely requested files from the image cache and fetches frequently requested
+# ones according to an nginx access log, meant to be run by cron
+from tamaraw.util import load_config, parse_size
+from tamaraw.storage import store_from_config
+import sys, logging
+
+if not len(sys.argv) == 3:
+    print >> sys.stderr, "USAGE: %s access_log max_size (bytes, or e.g. 500M, 20G)" % (__file__)
+    sys.exit(1)
+
+config = load_config()
+if config['store'] != 'simples3':
+    print >> sys.stderr, "the file cache is only used by the simples3 store"
+    sys.exit(1)
+store = store_from_config(config, logging.getLogger())
+report = store.manage_cache(sys.argv[1], parse_size(sys.argv[2]))
+print "requests analyzed:  %(requests)d (%(requested_files)d files)" % report
+print "hit ratio:          %.1f%% before, %.1f%% after" % (report['hit_ratio_before'] * 100, report['hit_ratio_after'] * 100)
+print "evicted:            %(files_evicted)d files, %(bytes_evicted)d bytes" % report
+print "fetched:            %(files_fetched)d files, %(bytes_fetched)d bytes" % report
+print "cache size:         %(cache_size)d bytes" % report
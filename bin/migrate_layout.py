@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+# moves the files of the local store or the image cache from the flat directory
+# layout into sharded directories. can run while the application is serving,
+# files are found at either location until they have been moved
+from tamaraw.util import load_config
+from tamaraw.storage import ShardedDirectory
+import sys, argparse
+
+parser = argparse.ArgumentParser(description='migrate the local store or image cache to the sharded layout')
+parser.add_argument('--batch-size', type=int, default=1000, help='number of files moved between pauses')
+parser.add_argument('--pause', type=float, default=0.5, help='seconds to pause after every batch')
+args = parser.parse_args()
+
+config = load_config()
+if config['store'] == 'local':
+    root = config['localstore']['basepath']
+else:
+    root = config['cache']['basepath']
+
+moved = 0
+for moved in ShardedDirectory(root).migrate(args.batch_size, args.pause):
+    print >> sys.stderr, "%s: %d files moved" % (root, moved)
+print >> sys.stderr, "%s: done, %d files moved" % (root, moved)
@@ -0,0 +1,14 @@
+#!/usr/bin/env python
+# replaces the facet counts of the browse pages with the facets of the index,
+# correcting drift from concurrent writes, meant to be run by cron
+from tamaraw.util import load_config
+from tamaraw.dao import ConfigDao, ImageDao
+from tamaraw.facets import configured_facet_counts
+import sys
+
+config = load_config()
+dao_conf = [config['elasticsearch']['rawes'], config['elasticsearch']['indexname']]
+config_dao = ConfigDao(*dao_conf)
+facet_counts = configured_facet_counts(config, config_dao)
+facet_counts.recount(ImageDao(*dao_conf))
+print >> sys.stderr, "recounted facets of %s" % (', '.join(facet_counts.keys()),)
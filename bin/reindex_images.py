@@ -0,0 +1,20 @@
+#!/usr/bin/env python
+# puts the image mapping derived from the property configuration and indexes all
+# images again, so images indexed before the mapping have the raw browse fields
+from tamaraw.util import load_config
+from tamaraw.dao import ConfigDao, ImageDao
+import sys, argparse
+
+parser = argparse.ArgumentParser(description='update the image mapping and reindex all images')
+parser.add_argument('--batch-size', type=int, default=500, help='images per bulk index request')
+args = parser.parse_args()
+
+config = load_config()
+dao_conf = [config['elasticsearch']['rawes'], config['elasticsearch']['indexname']]
+config_dao = ConfigDao(*dao_conf)
+config_dao.put_image_mapping(config_dao.get_property_config())
+print >> sys.stderr, "updated image mapping"
+indexed = 0
+for indexed in ImageDao(*dao_conf).reindex(args.batch_size):
+    print >> sys.stderr, "%d images indexed" % (indexed,)
+print >> sys.stderr, "done: %d images indexed" % (indexed,)
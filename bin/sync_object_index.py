@@ -0,0 +1,13 @@
+#!/usr/bin/env python
+# rebuilds the local index of existing s3 objects from a bucket listing, meant to be run by cron
+from tamaraw.util import load_config
+from tamaraw.storage import store_from_config
+import sys, logging
+
+config = load_config()
+if config['store'] != 'simples3':
+    print >> sys.stderr, "the object index is only used by the simples3 store"
+    sys.exit(1)
+store = store_from_config(config, logging.getLogger())
+store.sync_objects()
+print >> sys.stderr, "synchronized object index"
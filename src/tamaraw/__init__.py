@@ -1,21 +1,29 @@
 # encoding: utf-8
-from flask import Flask, request, redirect, url_for, abort, session, jsonify
+from flask import Flask, request, redirect, url_for, abort, session, jsonify, g, make_response
 from flask import render_template as flask_render_template
 import urlparse
 import urllib
-import mimetypes
 import re
+import hashlib
+import tempfile
 from flask.helpers import flash
 from datetime import datetime
 from dateutil import tz
 from jinja2 import TemplateNotFound
+from werkzeug.http import is_resource_modified, parse_content_range_header
 from functools import partial 
 from contracts import contract
 from flask import Markup
 import markdown
 
 import dao
-from storage import LocalStore, SimpleS3Store, FileCache
+from storage import store_from_config, FileSender, THUMBNAIL_SIZES, snap_size
+from thumbnails import ThumbnailQueue
+from ingest import Importer, allowed_file
+from facets import configured_facet_counts
+from snapshots import ResultSnapshots
+from recent import configured_recent_images
+from uploads import ChunkedUploads, UploadError, UnknownUpload, OffsetMismatch
 from util import InvalidStoreKey
 from util import load_config
 
@@ -25,25 +33,47 @@ app = Flask('tamaraw')
 
 app.config['SECRET_KEY'] = str(config['session_secret'])
 
-if config['store'] == 'simples3':
-    store = SimpleS3Store(config['simples3']['credentials'],
-                          config['simples3']['bucket'],
-                          config['simples3']['baseurl'],
-                          app.logger,
-                          'images_',
-                          FileCache(config['cache']['basepath']))
-elif config['store'] == 'local':
-    store = LocalStore(config['localstore']['basepath'])
-else:
-    raise Exception('no store backend configured, must be s3 or local')
+store = store_from_config(config, app.logger)
 
 dao_conf = [config['elasticsearch']['rawes'], config['elasticsearch']['indexname']]
-config_dao = dao.ConfigDao(*dao_conf)
+config_dao = dao.ConfigDao(*dao_conf, ttl=config['elasticsearch'].get('property_config_ttl', 60))
 comment_dao = dao.CommentDao(*dao_conf)
-image_dao = dao.ImageDao(*dao_conf)
+# counts of the browse pages, recounted from the index every facet_recount_interval seconds
+facet_counts = configured_facet_counts(config, config_dao)
+facet_recount_interval = config.get('facet_recount_interval', 3600)
+image_dao = dao.ImageDao(*dao_conf, facet_counts=facet_counts, recent_images=configured_recent_images(config))
+# the s3 store looks up references its disposable object index lacks in the image documents
+store.references = image_dao
 user_dao = dao.UserDao(*dao_conf)
 
-ALLOWED_EXTENSIONS = set(['png', 'jpg', 'jpeg', 'gif'])
+thumbnail_sizes = sorted([tuple(size) for size in config.get('thumbnail_sizes', THUMBNAIL_SIZES)],
+                         key=lambda size: size[0] * size[1])
+
+# thumbnails are created by a pool of worker processes unless "processes" is 0. every
+# web worker imports the app and has its own pool with 1 process by default, which is
+# started here before the server starts any request threads
+thumbnail_conf = config.get('thumbnail_workers', {})
+if thumbnail_conf.get('processes') != 0:
+    thumbnail_queue = ThumbnailQueue(store, app.logger, thumbnail_conf.get('processes', 1),
+                                     thumbnail_conf.get('max_pending', 64))
+    thumbnail_queue.start()
+    store.thumbnail_queue = thumbnail_queue
+else:
+    thumbnail_queue = None
+
+importer = Importer(store, image_dao, app.logger, thumbnail_queue, thumbnail_sizes, config.get('upload_workers', 4))
+
+result_snapshots = ResultSnapshots(config.get('snapshot_cache', '%s/tamaraw_snapshots_%s.sqlite' % (tempfile.gettempdir(),
+                                                                                                    dao_conf[1])),
+                                   config.get('snapshot_max_entries', 10000), config.get('snapshot_ttl', 3600))
+# links of result lists carry no snapshot, clicks into the same result set share one this young
+snapshot_reuse_age = config.get('snapshot_reuse_age', 60)
+
+chunked_uploads = ChunkedUploads(config.get('chunked_upload_dir', tempfile.gettempdir() + '/tamaraw_uploads'))
+
+# files are sent by the worker ("python") or handed to the front proxy ("x-accel-redirect", "x-sendfile")
+delivery_conf = config.get('delivery', {})
+store.sender = FileSender(delivery_conf.get('mode', 'python'), delivery_conf.get('locations'))
 
 def get_git_version():
     import subprocess, os
@@ -78,6 +108,58 @@ def template_filter(values, filter=None):
 def template_date_format(value, format='%d.%m.%Y'):
     return value.astimezone(VIEW_TZ).strftime(format)
 
+def request_batch():
+    """ the dao batch of the current request, reads queued on it share one round trip """
+    if not hasattr(g, 'dao_batch'):
+        g.dao_batch = dao.Batch(image_dao.es, image_dao.indexname)
+    return g.dao_batch
+
+def get_image_with_config(store_key):
+    batch = request_batch()
+    image = image_dao.get_deferred(batch, store_key)
+    config_dao.prefetch(batch)
+    return image.result()
+
+# store keys are never reused, so files can be cached forever
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+def add_file_validators(response, etag):
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    if 'Expires' in response.headers:
+        del response.headers['Expires']
+    return response
+
+def page_etag(*parts):
+    """ etag of a page, which also depends on the app version, the property config and the user """
+    return hashlib.sha1(repr((VERSION, config_dao.version, session.get('username')) + parts)).hexdigest()
+
+def last_modified_of(image):
+    updated_at = image.get('updated_at')
+    if isinstance(updated_at, datetime):
+        return updated_at.astimezone(tz.tzutc()).replace(tzinfo=None, microsecond=0)
+    return None
+
+def add_page_validators(response, etag, last_modified=None):
+    response.set_etag(etag)
+    if last_modified != None:
+        response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.headers['Vary'] = 'Cookie'
+    return response
+
+def page_not_modified(etag, last_modified=None):
+    """ returns a 304 response if the client's copy of the page is still valid, None otherwise """
+    # flashed messages are shown only once, so the page has to be rendered
+    if '_flashes' in session or is_resource_modified(request.environ, etag, last_modified=last_modified):
+        return None
+    return add_page_validators(app.response_class(status=304), etag, last_modified)
+
+def thumbnail_srcset(store_key):
+    return ', '.join('%s %sw' % (url_for('get_image', store_key=store_key, x=x, y=y), x) for x, y in thumbnail_sizes)
+
+app.jinja_env.globals.update(thumbnail_srcset=thumbnail_srcset)
+
 def linkify_image(image):
     return dict(href=url_for('get_image', store_key=image['store_key']), **image)
 
@@ -106,19 +188,30 @@ def api_get_image(store_key):
 def api_list_images():
     offset = int(request.args.get('offset') or 0)
     length = int(request.args.get('length') or 100)
-    images, total = image_dao.search({'query': dao.range_query('created_at', datetime.fromtimestamp(0, tz.gettz()), datetime.now(tz.gettz())),
-                                     'sort': {'created_at': {'order': 'desc'}}},
-                                    offset, length)
-
-    return jsonify(total=total, images=[linkify_image(image) for image in images])
+    page = image_dao.recent(offset, length, request.args.get('cursor'))
+    return jsonify(total=page['total'], offset=page['offset'], next_cursor=page['next'], prev_cursor=page['prev'],
+                   images=[linkify_image(image) for image in page['images']])
 
 @app.route('/files/<store_key>', defaults={'x':None, 'y':None})
 @app.route('/files/<store_key>_<int:x>x<int:y>')
 def get_image(store_key, x, y):
+    size = None
     if x and y:
-        return store.deliver_image(store_key, (x, y))
-    else:
-        return store.deliver_image(store_key)
+        size = snap_size((x, y), thumbnail_sizes)
+        if size != (x, y):
+            # not permanent, thumbnail_sizes may change. clients may reuse it for an hour
+            return app.response_class(status=302, headers={
+                'Location': url_for('get_image', store_key=store_key, x=size[0], y=size[1], _external=True),
+                'Cache-Control': 'public, max-age=3600'})
+    # the content behind a url never changes, so revalidation needs neither store nor database
+    etag = store_key if size == None else '%s_%sx%s' % ((store_key,) + size)
+    if not is_resource_modified(request.environ, etag):
+        return add_file_validators(app.response_class(status=304), etag)
+    response = store.deliver_image(store_key, size)
+    # redirects to signed urls and answers for pending thumbnails must not be cached
+    if response.status_code in (200, 206) and not response.cache_control.no_store:
+        add_file_validators(response, etag)
+    return response
 
 # the accompanying website
 @app.route('/recent/o<int:offset>')
@@ -126,8 +219,8 @@ def get_image(store_key, x, y):
 def recent_images(offset):
     session['last_collection'] = url_for('recent_images', offset=offset)
     page_size = get_page_size()
-    images, total = image_dao.recent(offset, page_size)
-    return render_image_list(images, 'recent.html', partial(url_for, 'recent_images'), offset, page_size, total,
+    page = image_dao.recent(offset, page_size, request.args.get('c'))
+    return render_image_list(page, 'recent.html', partial(url_for, 'recent_images'), page_size,
                              additional_params={'query_name': 'recent_images'})
 
 @app.route('/upload_group/<upload_group>/', defaults={'offset': 0})
@@ -135,41 +228,43 @@ def recent_images(offset):
 def upload_group(upload_group, offset):
     session['last_collection'] = url_for('upload_group', upload_group=upload_group, offset=offset)
     page_size = get_page_size()
-    images, total = image_dao.upload_group_by_creation(upload_group, offset, page_size)
-    return render_image_list(images, 'upload_group.html', partial(url_for, 'upload_group', upload_group=upload_group),
-                             offset, page_size, total, additional_params={'query_name': 'upload_group:%s' % (upload_group,)})
+    page = image_dao.upload_group_by_creation(upload_group, offset, page_size, request.args.get('c'))
+    return render_image_list(page, 'upload_group.html', partial(url_for, 'upload_group', upload_group=upload_group),
+                             page_size, additional_params={'query_name': 'upload_group:%s' % (upload_group,)})
 
 def get_page_size(default=8):
     page_size = request.args.get('page_size') or default
     return int(page_size)
 
-def render_image_list(images, template_name, url_for_func, offset, page_size, total, additional_params={}):
+def render_image_list(page, template_name, url_for_func, page_size, additional_params={}):
+    """ page is a result of ImageDao.search_page, the links to adjacent pages carry its cursors """
+    images = page['images']
     for image in images:
         for key in image:
             if image[key] is None:
                 image[key] = ''
     params = dict(images=images, **additional_params)
-    add_pagination_params(params, url_for_func, offset, page_size, total)
+    add_pagination_params(params, url_for_func, page['offset'], page_size, page['total'], page['next'], page['prev'])
     return render_template(template_name, **params)
 
-def add_pagination_params(params, url_for_func, offset, page_size, total):
+def add_pagination_params(params, url_for_func, offset, page_size, total, next_cursor=None, prev_cursor=None):
     params['offset'] = offset
     params['page_size'] = page_size
     params['total'] = total
     if total > (offset + page_size):
-        params['next_offset'] = url_for_func(offset=offset + page_size)
+        params['next_offset'] = url_for_func(offset=offset + page_size, c=next_cursor)
     if offset > 0:
         prev_offset = offset - page_size
         if prev_offset > 0:
-            params['prev_offset'] = url_for_func(offset=prev_offset)
+            params['prev_offset'] = url_for_func(offset=prev_offset, c=prev_cursor)
         else: 
-            params['prev_offset'] = url_for_func(offset=0)
+            params['prev_offset'] = url_for_func(offset=0, c=prev_cursor)
     return params
-    
-def allowed_file(filename):
-    return '.' in filename and \
-           filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+@app.errorhandler(dao.InvalidCursor)
+def invalid_cursor(e):
+    return 'invalid cursor', 400
+    
 import uuid, sys
 
 @app.route('/upload', methods=['GET'])
@@ -178,23 +273,17 @@ def upload_page():
         flash('you need to be logged in to upload files', 'alert-warning')
     return render_template('upload.html', upload_group=uuid.uuid4())
 
+def import_file(upload_group, fp, filename):
+    """ saves an uploaded file in the store and creates its image, returns the store key """
+    return importer.import_file(upload_group, fp, filename)
+
 @app.route('/upload/<upload_group>', methods=['POST'])
 def upload_file(upload_group):
     status = 500
     try:
         file = request.files['file']
         if file.filename and allowed_file(file.filename):
-            # we don't always receive a mimetype via file.content_type, so derive it from the extension 
-            mimetype, _ = mimetypes.guess_type(file.filename) or 'application/octet-stream'
-            store_key = store.save(file, mimetype=mimetype)
-            app.logger.info('saved file under store_key %s with mimetype %s', store_key, mimetype)
-            try:
-                image_dao.create(upload_group, store_key, file.filename)
-            except Exception as e:
-                app.logger.exception('caught exception while persisting new image to database, removing from store')
-                store.delete(store_key)
-                raise e
-            app.logger.info('image with store_key %s persisted in database', store_key)
+            import_file(upload_group, file, file.filename)
             status = 200
             flash('successfully uploaded file', 'alert-success')
         else:
@@ -207,6 +296,81 @@ def upload_file(upload_group):
         flash('encountered an exception during upload ' + str(sys.exc_info()[0]), 'alert-error')
     return render_template('upload.html', upload_group=uuid.uuid4()), status
 
+# resumable uploads: POST .../chunked creates an upload, every PUT appends the byte range given
+# by its Content-Range, GET reports the offset to continue at and POST .../finalize imports the file
+@app.route('/upload/<upload_group>/chunked', methods=['POST'])
+def chunked_upload_create(upload_group):
+    filename = request.form.get('filename', '')
+    if not allowed_file(filename):
+        return jsonify(error='invalid filename'), 400
+    size = request.form.get('size')
+    upload_id = chunked_uploads.create(upload_group, filename, int(size) if size else None)
+    return jsonify(upload_id=upload_id, offset=0), 201
+
+def chunked_upload_info(upload_group, upload_id):
+    try:
+        info = chunked_uploads.info(upload_id)
+    except UnknownUpload:
+        abort(404)
+    if info['upload_group'] != upload_group:
+        abort(404)
+    return info
+
+@app.route('/upload/<upload_group>/chunked/<upload_id>', methods=['GET'])
+def chunked_upload_status(upload_group, upload_id):
+    if 'username' not in session:
+        abort(403)
+    info = chunked_upload_info(upload_group, upload_id)
+    return jsonify(offset=info['offset'], size=info['size'])
+
+@app.route('/upload/<upload_group>/chunked/<upload_id>', methods=['PUT'])
+def chunked_upload_append(upload_group, upload_id):
+    chunked_upload_info(upload_group, upload_id)
+    content_range = parse_content_range_header(request.headers.get('Content-Range'))
+    if content_range != None:
+        offset, length = content_range.start, content_range.stop - content_range.start
+    else:
+        # without Content-Range the body is appended at the offset given as parameter
+        offset, length = request.args.get('offset', 0, type=int), request.content_length or 0
+    if length != (request.content_length or 0):
+        return jsonify(error='Content-Range does not match Content-Length'), 400
+    try:
+        # the body is streamed to disk, it never goes through the form parser
+        offset = chunked_uploads.append(upload_id, offset, request.stream, length,
+                                        content_range.length if content_range != None else None)
+    except OffsetMismatch as e:
+        return jsonify(error=str(e), offset=e.offset), 409
+    except UploadError as e:
+        return jsonify(error=str(e)), 400
+    return jsonify(offset=offset)
+
+@app.route('/upload/<upload_group>/chunked/<upload_id>/finalize', methods=['POST'])
+def chunked_upload_finalize(upload_group, upload_id):
+    info = chunked_upload_info(upload_group, upload_id)
+    try:
+        fp = chunked_uploads.take(upload_id)
+    except OffsetMismatch as e:
+        return jsonify(error='upload is incomplete', offset=e.offset), 409
+    except UnknownUpload:
+        # finalized by a concurrent request
+        abort(404)
+    try:
+        store_key = import_file(upload_group, fp, info['filename'])
+    finally:
+        fp.close()
+    return jsonify(store_key=store_key, url=url_for('image_page', store_key=store_key))
+
+@app.route('/upload/<upload_group>/batch', methods=['POST'])
+def upload_batch(upload_group):
+    """ imports all files of the field "file" and reports the result of every file """
+    files = request.files.getlist('file')
+    valid = [(file, file.filename) for file in files if file.filename and allowed_file(file.filename)]
+    results = dict((id(file), result) for (file, _), result in zip(valid, importer.import_files(upload_group, valid)))
+    report = [results.get(id(file), dict(filename=file.filename, store_key=None, error='invalid file'))
+              for file in files]
+    failed = len([item for item in report if item['store_key'] == None])
+    return jsonify(created=len(report) - failed, failed=failed, items=report), 200 if failed == 0 else 207
+
 @app.route('/public/image/<store_key>/comment', methods=['POST'])
 def comment(store_key):
     check_invisible_captcha('name')
@@ -221,7 +385,7 @@ def document_mock(store_key):
         return image_page_in_result(store_key, result_set, int(request.args.get('o')))
     else:
         try:
-            image = image_dao.get(store_key)
+            image = get_image_with_config(store_key)
             if image == None:
                 abort(404)
             prop_config = config_dao.get_property_config()
@@ -238,44 +402,75 @@ def image_page(store_key):
         return image_page_in_result(store_key, result_set, int(request.args.get('o')))
     else:
         try:
-            image = image_dao.get(store_key)
+            image = get_image_with_config(store_key)
             if image == None:
                 abort(404)
             prop_config = config_dao.get_property_config()
+            etag, last_modified = page_etag('image', store_key, image.get('updated_at')), last_modified_of(image)
+            not_modified = page_not_modified(etag, last_modified)
+            if not_modified:
+                return not_modified
             view_props = create_view_props(image, prop_config, set(['prop_title']))
-            return render_template('image.html', image=image, view_props=view_props)
+            return add_page_validators(make_response(render_template('image.html', image=image, view_props=view_props)),
+                                       etag, last_modified)
         except InvalidStoreKey:
             app.logger.warning('invalid store_key %s', repr(store_key))
             abort(400)
 
-def image_page_in_result(store_key, result_set, offset):
-    prev_offset = offset - 1
-    is_first = prev_offset == -1
-    start_offset = max(prev_offset, 0)
+def result_set_query(result_set):
+    """ the query and the title of the result set named result_set, (None, None) if it is unknown """
     if result_set == 'recent_images':
-        images, total = image_dao.recent(start_offset, 3)
-        result_set_title = 'Neue Bilder'
+        return image_dao.recent_query(), 'Neue Bilder'
     elif result_set.startswith('upload_group:'):
         _, upload_group = result_set.split(':')
-        result_set_title = 'Uploadgruppe ' + upload_group
-        images, total = image_dao.upload_group_by_creation(upload_group, start_offset, 3)
+        return image_dao.upload_group_query(upload_group), 'Uploadgruppe ' + upload_group
     elif result_set.startswith('search:'):
-        query = result_set.replace('search:', '')
-        result_set_title = 'Volltextsuche: ' + query
-        fields = assemble_full_text_fields(query)
-        images, total = image_dao.search({'query': {'multi_match': {'query': query, 'fields': fields}}}, start_offset, 3)
+        search_query = result_set.replace('search:', '')
+        fields = assemble_full_text_fields(search_query)
+        return {'query': {'multi_match': {'query': search_query, 'fields': fields}}}, 'Volltextsuche: ' + search_query
     elif result_set.startswith('browse:'):
         tmp = result_set.replace('browse:', '')
         key = tmp[:tmp.index(':')]
         value = tmp[tmp.index(':') + 1:]
-        result_set_title = human_name(key) + ': ' + value
-        images, total = image_dao.browse(key, value, start_offset, 3)
-    else:
+        return image_dao.browse_query(key, value), human_name(key) + ': ' + value
+    return None, None
+
+# store keys per result set snapshot, the window starts a quarter before the requested offset
+SNAPSHOT_SIZE = 1000
+
+def snapshot_covers(snapshot, offset):
+    """ True if snapshot has the keys at offset and of its neighbours """
+    if not 0 <= offset < snapshot['total']:
+        return False
+    first = max(offset - 1, 0)
+    last = min(offset + 1, snapshot['total'] - 1)
+    return snapshot['start'] <= first and last < snapshot['start'] + len(snapshot['keys'])
+
+def image_page_in_result(store_key, result_set, offset):
+    # fetches the config with the image, building the query of a result set needs it
+    image = get_image_with_config(store_key)
+    if image == None:
+        abort(404)
+    query, result_set_title = result_set_query(result_set)
+    if query == None:
         # unknown result set
         return redirect(url_for('image_page', store_key=store_key))
 
-    image = images[int(not is_first)]
-    if image['store_key'] != store_key:
+    snapshot_id = request.args.get('s')
+    snapshot = result_snapshots.get(snapshot_id) if snapshot_id else None
+    if snapshot == None or snapshot['result_set'] != result_set or not snapshot_covers(snapshot, offset):
+        snapshot = result_snapshots.latest(result_set, offset, snapshot_reuse_age)
+        if snapshot != None and (not snapshot_covers(snapshot, offset)
+                                 or snapshot['keys'][offset - snapshot['start']] != store_key):
+            snapshot = None
+    if snapshot == None:
+        start = max(offset - SNAPSHOT_SIZE / 4, 0)
+        keys, total = image_dao.result_keys(query, start, SNAPSHOT_SIZE)
+        snapshot = dict(id=result_snapshots.create(result_set, start, keys, total), result_set=result_set,
+                        start=start, total=total, keys=keys)
+    keys, start, total = snapshot['keys'], snapshot['start'], snapshot['total']
+
+    if not snapshot_covers(snapshot, offset) or keys[offset - start] != store_key:
         # result set has changed e.g. new uploads or edits changed the order
         flash(u"Das Suchergebnis sich während der Navigation geändert (z.B. durch Hinzufügen neuer Bilder oder durch " + 
               u"Änderung einer Bildbeschreibung etc.). Die Navigation innerhalb des Suchergebnisses kann daher nicht "
@@ -283,16 +478,22 @@ def image_page_in_result(store_key, result_set, offset):
         return redirect(url_for('image_page', store_key=store_key))
 
     pagination_params = dict(offset=offset, total=total, page_size=1)
-    is_last = offset + 1 >= total
-    if not is_last:
-        pagination_params['next_offset'] = url_for('image_page', store_key=images[1 + int(not is_first)]['store_key'],
-                                                   r=result_set, o=offset + 1)
-    if not is_first:
-        pagination_params['prev_offset'] = url_for('image_page', store_key=images[0]['store_key'], r=result_set, o=offset - 1)
+    if offset + 1 < total:
+        pagination_params['next_offset'] = url_for('image_page', store_key=keys[offset + 1 - start],
+                                                   r=result_set, o=offset + 1, s=snapshot['id'])
+    if offset > 0:
+        pagination_params['prev_offset'] = url_for('image_page', store_key=keys[offset - 1 - start],
+                                                   r=result_set, o=offset - 1, s=snapshot['id'])
     prop_config = config_dao.get_property_config()
+    etag = page_etag('image', store_key, result_set, offset, snapshot['id'], image.get('updated_at'))
+    not_modified = page_not_modified(etag)
+    if not_modified:
+        return not_modified
     view_props = create_view_props(image, prop_config, set(['prop_title']))
-    return render_template('image.html', image=image, view_props=view_props,
-                           in_result_set=True, result_set_title=result_set_title, **pagination_params)
+    return add_page_validators(make_response(render_template('image.html', image=image, view_props=view_props,
+                                                             in_result_set=True, result_set_title=result_set_title,
+                                                             **pagination_params)),
+                               etag)
 
 @app.route('/image/<store_key>/edit', methods=['POST'])
 def save_image(store_key):
@@ -348,7 +549,7 @@ def create_view_props(image, prop_config, exclude=set([])):
 
 @app.route('/image/<store_key>/edit')
 def edit_image(store_key):
-    image = image_dao.get(store_key)
+    image = get_image_with_config(store_key)
     if image == None:
         abort(404)
     prop_config = config_dao.get_property_config()
@@ -377,22 +578,22 @@ def quick_search(offset):
     if query == None:
         abort(400)
     fields = assemble_full_text_fields(query)
-    images, total = image_dao.search({'query': {'multi_match': {'query': query, 'fields': fields}}}, offset, page_size)
-    return render_image_list(images, 'search.html', partial(url_for, 'quick_search', query=query),
-                             offset, page_size, total, {'search_title': 'Volltextsuche: ' + query,
+    page = image_dao.search_page({'query': {'multi_match': {'query': query, 'fields': fields}}}, page_size, offset,
+                                 request.args.get('c'))
+    return render_image_list(page, 'search.html', partial(url_for, 'quick_search', query=query),
+                             page_size, {'search_title': 'Volltextsuche: ' + query,
                                                         'query_name': 'search:' + query})
 
 def human_name(property_key):
-    for prop_config in config_dao.get_property_config():
-        if prop_config['key'] == property_key:
-            return prop_config['human_' + config['language']]
-    raise ValueError('not a valid property name')
+    prop = config_dao.get_property(property_key)
+    if prop == None:
+        raise ValueError('not a valid property name')
+    return prop['human_' + config['language']]
 
 @contract(returns="list(dict)")
 def get_categories():
-    props = config_dao.get_property_config()
     return [dict(key=prop['key'], human_name=prop['human_' + config['language']])
-            for prop in props if prop['use_for_browse']]
+            for prop in config_dao.get_browse_properties()]
 
 @app.route('/browse/')
 def browse_overview():
@@ -402,31 +603,51 @@ def browse_overview():
 def browse_facets(short_key):
     key = 'prop_' + short_key
     current = dict(key=key, human_name=human_name(key))
-    facet_request = {}
-    for prop in config_dao.get_property_config():
-        facet_key = prop['key']
-        if facet_key != key:
-            facet_request[facet_key] = {'terms': {'field': facet_key}}
-
-    facets = [dict(term=k, count=v) for k, v in image_dao.get_facets(key)[key].iteritems() if k != '']
-    facets.sort(lambda f1, f2 : cmp(f1['term'], f2['term']))
-    return render_template('browse_overview.html', current_category=current, facets=facets)
+    facets, next_after = facet_page(key, FACET_PAGE_SIZE)
+    return render_template('browse_overview.html', current_category=current, facets=facets,
+                           prefix=request.args.get('prefix', u''), next_after=next_after)
+
+@app.route('/api/facets/<short_key>')
+def api_facets(short_key):
+    limit = min(request.args.get('limit', FACET_PAGE_SIZE, type=int), FACET_PAGE_SIZE)
+    facets, next_after = facet_page('prop_' + short_key, max(limit, 1))
+    return jsonify(facets=facets, next_after=next_after)
+
+FACET_PAGE_SIZE = 1000
+
+def facet_page(key, limit):
+    """
+    the facets of key starting with the request argument prefix and sorting after
+    the argument after, and the term to continue with if there are more
+    """
+    prop = config_dao.get_property(key)
+    if prop == None:
+        abort(404)
+    facet_counts.refresh(image_dao, key, facet_recount_interval, app.logger)
+    terms = facet_counts.terms(key, request.args.get('prefix', u''), request.args.get('after'), limit + 1,
+                               numeric=prop['type'] == 'integer')
+    facets = [dict(term=term, count=count) for term, count in terms[:limit]]
+    return facets, facets[-1]['term'] if len(terms) > limit else None
 
 @app.route('/browse/<short_key>/<path:value>/', defaults={'offset': 0})
 @app.route('/browse/<short_key>/<path:value>/o<int:offset>')
 def browse(short_key, value, offset):
     key = 'prop_' + short_key
     page_size = get_page_size()
-    images, total = image_dao.browse(key, value, offset, page_size)
+    page = image_dao.browse(key, value, offset, page_size, request.args.get('c'))
     category_name = human_name(key)
-    return render_image_list(images, 'browse.html', partial(url_for, 'browse', short_key=short_key, value=value),
-                             offset, page_size, total, {'search_title': '%s: %s' % (category_name, value),
-                                                        'query_name': 'browse:%s:%s' % (key, value)})
+    return render_image_list(page, 'browse.html', partial(url_for, 'browse', short_key=short_key, value=value),
+                             page_size, {'search_title': '%s: %s' % (category_name, value),
+                                         'query_name': 'browse:%s:%s' % (key, value)})
 
 @app.route('/image/<store_key>/delete', methods=['POST'])
 def delete_image(store_key):
     try:
+        # the store learns the original of a duplicate before the image document is gone
+        store.resolve(store_key)
         image_dao.delete(store_key)
+        # the store counts the remaining references of the original with a search
+        image_dao.refresh_indices()
         store.delete(store_key)
         flash('successfully deleted file', 'alert-success')
         app.logger.info('deleted image with store key %s', store_key)
@@ -437,7 +658,6 @@ def delete_image(store_key):
         # if this file causes persistent errors, it should be ok to let the user remove it
         app.logger.exception("caught exception while removing file")
         flash('ignorable error while deleting file', 'alert-warning')
-    image_dao.refresh_indices()
     if 'last_collection' in session:
         return redirect(session['last_collection'])
     else:
@@ -473,6 +693,11 @@ def mark_comment_as_read(comment_id):
     else:
         abort(404)
 
+@app.route('/private/stats')
+def stats():
+    return jsonify(elasticsearch=dao.connection_stats(),
+                   thumbnails=thumbnail_queue.stats() if thumbnail_queue != None else None)
+
 @app.route('/private/comments/', defaults={'offset': 0})
 @app.route('/private/comments/o<int:offset>')
 def comments(offset):
@@ -504,5 +729,4 @@ def login():
 
 @app.route('/')
 def start():
-    images, _ = image_dao.search({'query':{'match_all': {}}}, 0, 5)
-    return render_template('start.html', demo_images=images)
+    return render_template('start.html', demo_images=image_dao.recent(0, 5)['images'])
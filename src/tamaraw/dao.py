@@ -1,5 +1,8 @@
 # encoding: utf-8
-import rawes, re
+import rawes, re, time, uuid, json, base64, threading, requests
+from requests.packages.urllib3.poolmanager import PoolManager
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool
+from rawes.encoders import encode_date_optional_time
 from datetime import datetime
 from dateutil import tz
 from contracts import contract
@@ -18,10 +21,255 @@ def map_timestamps(obj):
                 pass
     return obj
 
+class InvalidCursor(ValueError):
+    pass
+
+def encode_cursor(**position):
+    """ an opaque url safe token for the position of a page in a result list """
+    return base64.urlsafe_b64encode(json.dumps(position, separators=(',', ':'))).rstrip('=')
+
+def decode_cursor(cursor):
+    try:
+        position = json.loads(base64.urlsafe_b64decode(str(cursor) + '=' * (-len(cursor) % 4)))
+    except (TypeError, ValueError, UnicodeError):
+        raise InvalidCursor(cursor)
+    if not isinstance(position, dict) or not isinstance(position.get('o'), int) or position['o'] < 0:
+        raise InvalidCursor(cursor)
+    if 'v' in position and (not isinstance(position['v'], list) or len(position['v']) != 2):
+        raise InvalidCursor(cursor)
+    if position.get('b') and not isinstance(position.get('t'), int):
+        raise InvalidCursor(cursor)
+    return position
+
+# browse properties are indexed twice, analyzed for searching and as a whole in the
+# sub-field "raw" for facets and exact lookups
+RAW_FIELD = '%s.raw'
+
+def image_mapping(props):
+    """ the mapping of the image type with a multi_field for every browse property and the timestamps """
+    fields = {}
+    for prop in props:
+        if not prop['use_for_browse']:
+            continue
+        if prop['type'] == 'integer':
+            # the type dynamic mapping picks for numbers
+            field, raw = {'type': 'long'}, {'type': 'long'}
+        else:
+            field, raw = {'type': 'string'}, {'type': 'string', 'index': 'not_analyzed'}
+        fields[prop['key']] = {'type': 'multi_field', 'fields': {prop['key']: field, 'raw': raw}}
+    # blob references are counted by exact key
+    fields['blob_key'] = {'type': 'string', 'index': 'not_analyzed'}
+    # recent pages sort on created_at
+    for timestamp in ('created_at', 'updated_at'):
+        fields[timestamp] = {'type': 'date', 'format': 'dateOptionalTime'}
+    return {'image': {'properties': fields}}
+
+# duplicate uploads are recorded before their image documents exist, see ImageDao.add_blob_reference
+BLOB_REFERENCE_MAPPING = {'blob_reference': {'properties': {'blob_key': {'type': 'string', 'index': 'not_analyzed'}}}}
+
+class ReconnectCountingPool(HTTPConnectionPool):
+    """ connection pool which counts the connections opened again after they were closed or broken """
+    def __init__(self, *args, **kwargs):
+        HTTPConnectionPool.__init__(self, *args, **kwargs)
+        self.reconnects = 0
+        self.reconnects_lock = threading.Lock()
+
+    def count_reconnect(self):
+        with self.reconnects_lock:
+            self.reconnects += 1
+
+    def _get_conn(self, timeout=None):
+        conn = HTTPConnectionPool._get_conn(self, timeout)
+        # a pooled connection whose socket is closed connects again on its next request
+        if getattr(conn, 'pooled', False) and conn.sock == None:
+            self.count_reconnect()
+        return conn
+
+    def _put_conn(self, conn):
+        if conn == None:
+            # a broken connection was discarded, a new one takes its place
+            self.count_reconnect()
+        else:
+            conn.pooled = True
+        HTTPConnectionPool._put_conn(self, conn)
+
+class PooledConnection(object):
+    """
+    rawes connection which keeps a bounded pool of keep-alive connections to
+    elasticsearch. idempotent reads are retried with exponential backoff.
+    """
+    RETRY_METHODS = ('get', 'head')
+
+    def __init__(self, host, port, timeout=None, pool_size=10, max_retries=2, retry_backoff=0.1):
+        self.url = 'http://%s:%s' % (host, port)
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.session = requests.session(timeout=timeout, config={'keep_alive': True})
+        self.session.poolmanager = PoolManager(num_pools=1, maxsize=pool_size)
+        self.pool = ReconnectCountingPool(host, port, maxsize=pool_size)
+        self.session.poolmanager.pools[('http', host, port)] = self.pool
+        # callers wait for a free slot instead of opening and discarding surplus connections
+        self.slots = threading.BoundedSemaphore(pool_size)
+        self.lock = threading.Lock()
+        self.in_use = 0
+        self.waits = 0
+        self.retries = 0
+        self.failures = 0
+
+    def request(self, method, path, **kwargs):
+        """ kwargs are passed to requests, a timeout overrides the one of the connection for this request """
+        if not self.slots.acquire(False):
+            with self.lock:
+                self.waits += 1
+            self.slots.acquire()
+        with self.lock:
+            self.in_use += 1
+        try:
+            return self.request_with_retries(method, path, **kwargs)
+        finally:
+            with self.lock:
+                self.in_use -= 1
+            self.slots.release()
+
+    def request_with_retries(self, method, path, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                response = self.session.request(method, '%s/%s' % (self.url, path), **kwargs)
+                break
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if method not in self.RETRY_METHODS or attempt >= self.max_retries:
+                    with self.lock:
+                        self.failures += 1
+                    raise
+                with self.lock:
+                    self.retries += 1
+                time.sleep(self.retry_backoff * 2 ** attempt)
+                attempt += 1
+        if response.text == '':
+            return response.status_code < 300
+        return json.loads(response.text)
+
+    def stats(self):
+        return dict(url=self.url,
+                    pool_size=self.pool_size,
+                    in_use=self.in_use,
+                    waits=self.waits,
+                    retries=self.retries,
+                    failures=self.failures,
+                    connections_opened=self.pool.num_connections,
+                    reconnects=self.pool.reconnects)
+
+POOL_PARAMS = ('pool_size', 'max_retries', 'retry_backoff')
+connections = {}
+connections_lock = threading.Lock()
+
+def connect(rawes_params):
+    """
+    returns a rawes.Elastic which shares its connection pool with all other daos
+    connecting to the same elasticsearch url. besides the rawes parameters, 
+    pool_size, max_retries and retry_backoff (in seconds) are accepted. timeout
+    is the default of the requests, single requests may pass their own, e.g.
+    es.get(path, timeout=5).
+    """
+    params = dict(rawes_params)
+    pool_params = dict((key, params.pop(key)) for key in POOL_PARAMS if key in params)
+    if params.get('connection_type', 'http') != 'http':
+        return rawes.Elastic(**params)
+    url = params.get('url', 'localhost:9200')
+    timeout = params.get('timeout', 30)
+    key = (url, timeout) + tuple(sorted(pool_params.items()))
+    with connections_lock:
+        if key not in connections:
+            url_parts = url.split(':')
+            port = int(url_parts[1]) if len(url_parts) == 2 else 9200
+            connections[key] = PooledConnection(url_parts[0], port, timeout=timeout, **pool_params)
+    return rawes.Elastic(connection=connections[key], **params)
+
+def connection_stats():
+    with connections_lock:
+        return [connection.stats() for connection in connections.values()]
+
 class Dao(object):
     def refresh_indices(self):
         self.es.post("%s/_refresh" % (self.indexname))
 
+class SearchError(Exception):
+    """ elasticsearch failed to run a search of a batch """
+    pass
+
+class Deferred(object):
+    def __init__(self, batch, key, mapper):
+        self.batch = batch
+        self.key = key
+        self.mapper = mapper
+
+    def result(self):
+        if self.key not in self.batch.results:
+            self.batch.execute()
+        result = self.batch.results[self.key]
+        if isinstance(result, SearchError):
+            raise result
+        return self.mapper(result)
+
+class Batch(object):
+    """
+    collects the reads of a request and sends them as one _mget and one _msearch
+    request. identical reads are only sent once, their results are kept until the
+    batch is discarded.
+    """
+    def __init__(self, es, indexname):
+        self.es = es
+        self.indexname = indexname
+        self.queued = []
+        self.results = {}
+        self.callbacks = []
+
+    def enqueue(self, key, mapper):
+        if key not in self.results and key not in self.queued:
+            self.queued.append(key)
+        return Deferred(self, key, mapper)
+
+    def get(self, doc_type, doc_id, mapper=lambda res: res):
+        return self.enqueue(('get', doc_type, doc_id), mapper)
+
+    def search(self, doc_type, data, offset, size, mapper=lambda res: res):
+        body = dict(data)
+        body['from'] = offset
+        body['size'] = size
+        key = ('search', doc_type, json.dumps(body, sort_keys=True, default=encode_date_optional_time))
+        return self.enqueue(key, mapper)
+
+    def after(self, callback):
+        """ callback is invoked after the next execution of the batch """
+        self.callbacks.append(callback)
+
+    def execute(self):
+        gets = [key for key in self.queued if key[0] == 'get']
+        searches = [key for key in self.queued if key[0] == 'search']
+        self.queued = []
+        if gets:
+            res = self.es.get('_mget', data={'docs': [{'_index': self.indexname, '_type': doc_type, '_id': doc_id}
+                                                      for _, doc_type, doc_id in gets]})
+            for key, doc in zip(gets, res['docs']):
+                self.results[key] = doc
+        if searches:
+            lines = []
+            for _, doc_type, body in searches:
+                lines.append(json.dumps({'index': self.indexname, 'type': doc_type}))
+                lines.append(body)
+            res = self.es.get('_msearch', data='\n'.join(lines) + '\n')
+            for key, search_result in zip(searches, res['responses']):
+                # a failed search must not look like an empty result
+                if 'error' in search_result:
+                    search_result = SearchError(search_result['error'])
+                self.results[key] = search_result
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback()
+
 
 class ConfigDao(Dao):
 
@@ -36,39 +284,134 @@ class ConfigDao(Dao):
                      {u"key": u"prop_location", u"human_de": u"Aufnahmeort", u"default": True, u"type": 'string', u"use_for_browse": True},
                      {u"key": u"prop_tags", u"human_de": u"Sachbegriffe", u"default": True, u"type": 'array', u"use_for_browse": True}]
     
-    def __init__(self, rawes_params, indexname):
-        self.es = rawes.Elastic(**rawes_params)
+    def __init__(self, rawes_params, indexname, ttl=60):
+        self.es = connect(rawes_params)
         self.indexname = indexname
+        # seconds after which the version stamp in the index is checked again
+        self.ttl = ttl
         self.property_config = None
+        self.props_by_key = {}
+        self.browse_props = []
+        self.version = None
+        self.checked_at = 0
 
     def config_path(self):
         return '%s/property_config/props' % (self.indexname)
-    
+
+    def version_path(self):
+        return '%s/property_config/version' % (self.indexname)
+
+    def put_image_mapping(self, config):
+        """
+        existing string fields are turned into multi_fields, documents indexed before
+        only get the raw sub-field when they are indexed again, see bin/reindex_images.py
+        """
+        res = self.es.put('%s/image/_mapping' % (self.indexname), data=image_mapping(config))
+        if not res.get('ok'):
+            raise Exception(res)
+        res = self.es.put('%s/blob_reference/_mapping' % (self.indexname), data=BLOB_REFERENCE_MAPPING)
+        if not res.get('ok'):
+            raise Exception(res)
+
     def import_default_props(self):
         res = self.es.get(self.config_path())
         if res.has_key('exists') and res['exists']:
             raise Exception("property config must not exist yet")
         self.update_property_config(ConfigDao.DEFAULT_PROPS)
-    
+
     @contract(config='list')
     def update_property_config(self, config):
+        # a mapping elasticsearch rejects leaves the stored config untouched
+        self.put_image_mapping(config)
         self.es.put(self.config_path(), data={'obj': config})
-    
+        # other processes only compare this small document with their cached stamp
+        version = uuid.uuid4().hex
+        self.es.put(self.version_path(), data={'version': version})
+        self.memoize(config, version)
+
+    def invalidate(self):
+        self.property_config = None
+        self.checked_at = 0
+
+    def memoize(self, config, version):
+        self.props_by_key = dict((prop['key'], prop) for prop in config)
+        self.browse_props = [prop for prop in config if prop['use_for_browse']]
+        self.property_config = config
+        self.version = version
+        self.checked_at = time.time()
+
+    def fetch_version(self):
+        res = self.es.get(self.version_path())
+        if not res.has_key('exists') or not res['exists']:
+            return None
+        return res['_source']['version']
+
+    def create_missing_version(self):
+        """
+        configs saved before the version stamp was introduced get one, otherwise they
+        would be fetched again on every ttl expiry. the first process to create it wins
+        """
+        self.es.put(self.version_path(), data={'version': uuid.uuid4().hex}, params={'op_type': 'create'})
+        return self.fetch_version()
+
     @contract(returns='list')
     def get_property_config(self):
         if self.property_config != None:
-            return self.property_config
+            if time.time() - self.checked_at < self.ttl:
+                return self.property_config
+            version = self.fetch_version()
+            if version != None and version == self.version:
+                self.checked_at = time.time()
+                return self.property_config
+        else:
+            version = self.fetch_version()
         res = self.es.get(self.config_path())
         if not res.has_key('exists') or not res['exists']:
             self.import_default_props()
             return ConfigDao.DEFAULT_PROPS
         else:
-            return res['_source']['obj']
+            if version == None:
+                version = self.create_missing_version()
+            self.memoize(res['_source']['obj'], version)
+            return self.property_config
+
+    def prefetch(self, batch):
+        """ adds the property config to the batch unless the cached copy is fresh """
+        if self.property_config != None and time.time() - self.checked_at < self.ttl:
+            return
+        version = batch.get('property_config', 'version')
+        props = batch.get('property_config', 'props')
+        def memoize_prefetched():
+            props_res, version_res = props.result(), version.result()
+            if not props_res.get('exists'):
+                return
+            stamp = version_res['_source']['version'] if version_res.get('exists') else None
+            self.memoize(props_res['_source']['obj'], stamp)
+        batch.after(memoize_prefetched)
+
+    def get_property(self, key):
+        self.get_property_config()
+        return self.props_by_key.get(key)
+
+    @contract(returns='list')
+    def get_browse_properties(self):
+        self.get_property_config()
+        return self.browse_props
 
 class ImageDao(Dao):
-    def __init__(self, rawes_params, indexname):
-        self.es = rawes.Elastic(**rawes_params)
+    def __init__(self, rawes_params, indexname, facet_counts=None, recent_images=None):
+        self.es = connect(rawes_params)
         self.indexname = indexname
+        # a facets.FacetCounts kept up to date with every write
+        self.facet_counts = facet_counts
+        # a recent.RecentImages serving the first page of recent, invalidated by every write
+        self.recent_images = recent_images
+
+    def written(self, old_image, new_image):
+        if self.facet_counts != None:
+            self.facet_counts.update(old_image, new_image)
+        if self.recent_images != None:
+            self.recent_images.invalidate()
         
     @contract(rawes_result='dict(unicode: *)', returns='tuple(list, int)')
     def map_search_results(self, rawes_result):
@@ -94,35 +437,206 @@ class ImageDao(Dao):
         # todo merge paging with additional_params
         res = self.es.get('%s/image/_search' % (self.indexname), data=data, params={'from': offset, 'size': page_size})
         return self.map_search_results(res)
-    
+
+    @contract(data='dict(str: *)', offset='int,>=0', page_size='int,>=1')
+    def search_deferred(self, batch, data, offset, page_size):
+        return batch.search('image', data, offset, page_size, self.map_search_results)
+
+    @contract(data='dict(str: *)', page_size='int,>=1', offset='int,>=0', returns='dict(str: *)')
+    def search_page(self, data, page_size, offset=0, cursor=None):
+        """
+        returns the page of the query data at offset or at the position of cursor
+        as dict(images, total, offset, next, prev), next and prev are the cursors
+        of the adjacent pages or None.
+
+        queries sorted on one field continue after the sort values of the last hit,
+        with the _uid as tiebreaker, so every page costs the same as the first one.
+        elasticsearch can't filter on scores, cursors of queries sorted by relevance
+        hold the offset of the page.
+        """
+        position = decode_cursor(cursor) if cursor != None else {'o': offset}
+        sort = data.get('sort')
+        if not sort or len(sort) != 1:
+            images, total = self.search(data, position['o'], page_size)
+            offset = position['o']
+            return dict(images=images, total=total, offset=offset,
+                        next=encode_cursor(o=offset + page_size) if offset + page_size < total else None,
+                        prev=encode_cursor(o=max(offset - page_size, 0)) if offset > 0 else None)
+        query, start = self.page_query(data, position)
+        res = self.es.get('%s/image/_search' % (self.indexname), data=query, params={'from': start, 'size': page_size})
+        return self.map_page(res, position, page_size)
+
+    def page_query(self, data, position):
+        """ the query for the page of data sorted on one field at position, and the offset to request """
+        field, spec = data['sort'].items()[0]
+        order = spec['order'] if isinstance(spec, dict) else spec
+        if position.get('b', False):
+            order = 'asc' if order == 'desc' else 'desc'
+        query = dict(data, sort=[{field: {'order': order}}, {'_uid': {'order': order}}])
+        if 'v' not in position:
+            return query, position['o']
+        value, uid = position['v']
+        op = 'lt' if order == 'desc' else 'gt'
+        after = {'or': [{'range': {field: {op: value}}},
+                        {'and': [{'term': {field: value}}, {'range': {'_uid': {op: uid}}}]}]}
+        query['query'] = {'filtered': {'query': data.get('query', {'match_all': {}}), 'filter': after}}
+        return query, 0
+
+    def map_page(self, rawes_result, position, page_size):
+        hits = rawes_result['hits']['hits'] if 'hits' in rawes_result else []
+        images, remaining = self.map_search_results(rawes_result)
+        if position.get('b', False):
+            hits, images = hits[::-1], images[::-1]
+            # remaining are the hits before the position, the total is the one of the first page
+            offset, total = max(remaining - len(images), 0), position['t']
+        elif 'v' in position:
+            offset, total = position['o'], position['o'] + remaining
+        else:
+            offset, total = position['o'], remaining
+        page = dict(images=images, total=total, offset=offset, next=None, prev=None)
+        if hits and offset + len(hits) < total:
+            page['next'] = encode_cursor(o=offset + len(hits), v=hits[-1]['sort'], t=total)
+        if hits and offset > 0:
+            page['prev'] = encode_cursor(o=max(offset - page_size, 0), v=hits[0]['sort'], t=total, b=True)
+        return page
+
+    @contract(data='dict(str: *)', start='int,>=0', size='int,>=1')
+    def result_keys(self, data, start, size):
+        """ the store keys of size hits of the query data from start on, in the order of search_page, and the total """
+        query = dict(data, fields=[])
+        sort = data.get('sort')
+        if sort and len(sort) == 1:
+            field, spec = sort.items()[0]
+            order = spec['order'] if isinstance(spec, dict) else spec
+            query['sort'] = [{field: {'order': order}}, {'_uid': {'order': order}}]
+        res = self.es.get('%s/image/_search' % (self.indexname), data=query, params={'from': start, 'size': size})
+        if 'hits' not in res:
+            return [], 0
+        return [hit['_id'] for hit in res['hits']['hits']], int(res['hits']['total'])
+
+    def upload_group_query(self, upload_group):
+        return {'query': {'match': {'upload_group': upload_group}},
+                'sort': {'created_at': {'order': 'desc'}}}
+
+    def recent_query(self):
+        # a constant query, unlike a range up to now elasticsearch can cache it
+        return {'query': {'match_all': {}},
+                'sort': {'created_at': {'order': 'desc'}}}
+
+    def browse_query(self, key, value):
+        # the whole value, just like the facet counts of the browse pages
+        return {'query': {'term': {RAW_FIELD % (key,): value}},
+                'sort': {'created_at': {'order': 'desc'}}}
+
     @contract(offset='int,>=0', page_size='int,>=1')
-    def upload_group_by_creation(self, upload_group, offset, page_size):
-        return self.search({'query': {'match': {'upload_group': upload_group}},
-                            'sort': {'created_at': {'order': 'desc'}}},
-                            offset, page_size)
+    def upload_group_by_creation(self, upload_group, offset, page_size, cursor=None):
+        return self.search_page(self.upload_group_query(upload_group), page_size, offset, cursor)
     
     @contract(offset='int,>=0', page_size='int,>=1')
-    def recent(self, offset, page_size):
-        return self.search({'query': range_query('created_at', datetime.fromtimestamp(0, tz.gettz()), datetime.now(tz.gettz())),
-                            'sort': {'created_at': {'order': 'desc'}}},
-                           offset, page_size)
+    def recent(self, offset, page_size, cursor=None):
+        if self.recent_images == None or offset != 0 or cursor != None or page_size > self.recent_images.size:
+            return self.search_page(self.recent_query(), page_size, offset, cursor)
+        res = self.recent_images.get()
+        if res == None:
+            queried_at = time.time()
+            query, start = self.page_query(self.recent_query(), {'o': 0})
+            res = self.es.get('%s/image/_search' % (self.indexname), data=query,
+                              params={'from': start, 'size': self.recent_images.size})
+            if 'hits' in res:
+                self.recent_images.put(res, queried_at)
+        if 'hits' in res:
+            hits = dict(res[u'hits'])
+            hits[u'hits'] = hits[u'hits'][:page_size]
+            res = dict(res)
+            res[u'hits'] = hits
+        return self.map_page(res, {'o': 0}, page_size)
 
     @contract(offset='int,>=0', page_size='int,>=1')
-    def browse(self, key, value, offset, page_size):
-        return self.search({'query': {'match': {key: {'query': value, 'operator': 'and'}}}}, offset, page_size)
+    def browse(self, key, value, offset, page_size, cursor=None):
+        return self.search_page(self.browse_query(key, value), page_size, offset, cursor)
 
     @contract(returns='dict(unicode: *)')
     def get_facets(self, *keys):
-        facet_request = dict([(key, {'terms': {"script_field" : "_source.%s" % (key,), 'size': 2 ** 16}, 'global': True}) for key in keys ])
-        res = self.es.get('%s/image/_search' % (self.indexname), data={'facets': facet_request}, params={'from': 0, 'size': 1})
+        """ counts the values of the browse properties keys using their raw sub-fields """
+        facet_request = dict([(key, {'terms': {'field': RAW_FIELD % (key,), 'size': 2 ** 16}}) for key in keys])
+        res = self.es.get('%s/image/_search' % (self.indexname), data={'query': {'match_all': {}}, 'facets': facet_request},
+                          params={'search_type': 'count'})
         return self.map_facet_results(res)
+
+    def reindex(self, batch_size=500, scroll='5m'):
+        """
+        indexes all images again unchanged, so they pick up mapping changes. yields
+        the number of images indexed after every batch
+        """
+        res = self.es.get('%s/image/_search' % (self.indexname), data={'query': {'match_all': {}}},
+                          params={'search_type': 'scan', 'scroll': scroll, 'size': batch_size})
+        indexed = 0
+        while True:
+            res = self.es.get('_search/scroll', data=res['_scroll_id'], params={'scroll': scroll})
+            hits = res['hits']['hits']
+            if not hits:
+                return
+            lines = []
+            for hit in hits:
+                lines.append(json.dumps({'index': {'_index': self.indexname, '_type': 'image', '_id': hit['_id']}}))
+                lines.append(json.dumps(hit['_source']))
+            res_bulk = self.es.post('_bulk', data='\n'.join(lines) + '\n')
+            errors = [item.values()[0].get('error') for item in res_bulk['items']]
+            if any(errors):
+                raise Exception([error for error in errors if error])
+            indexed += len(hits)
+            yield indexed
         
+    def map_document(self, res):
+        if not res['exists']:
+            return None
+        return dict(store_key=res['_id'], **map_timestamps(res['_source']))
+
     def get(self, store_key):
         check_store_key(store_key)
-        res = self.es.get('%s/image/%s' % (self.indexname, store_key))
-        if not res['exists']:
+        return self.map_document(self.es.get('%s/image/%s' % (self.indexname, store_key)))
+
+    def blob_key(self, store_key):
+        """ the store key of the original the image shares with its duplicates, None if there is no image """
+        image = self.get(store_key)
+        if image == None:
             return None
-        return dict(store_key=store_key, **map_timestamps(res['_source']))
+        return image.get('blob_key') or store_key
+
+    def count_blob_references(self, blob_key):
+        """
+        the number of images and blob references whose original is stored under blob_key.
+        the search only sees images created or deleted before the last refresh of the index
+        """
+        check_store_key(blob_key)
+        # images created before blob_key was recorded are their own blob
+        query = {'query': {'bool': {'should': [{'ids': {'values': [blob_key]}},
+                                               {'term': {'blob_key': blob_key}}]}}}
+        res = self.es.get('%s/image,blob_reference/_search' % (self.indexname), data=query,
+                          params={'search_type': 'count'})
+        if 'hits' not in res:
+            raise SearchError(res.get('error', res))
+        return int(res['hits']['total'])
+
+    def add_blob_reference(self, store_key, blob_key):
+        """
+        records that store_key refers to the original blob_key before its image document
+        exists, so the original isn't deleted meanwhile. visible to searches immediately
+        """
+        check_store_key(store_key)
+        check_store_key(blob_key)
+        res = self.es.put('%s/blob_reference/%s' % (self.indexname, store_key), data={'blob_key': blob_key},
+                          params={'refresh': 'true'})
+        if not res.get('ok'):
+            raise Exception(res)
+
+    def remove_blob_reference(self, store_key):
+        check_store_key(store_key)
+        self.es.delete('%s/blob_reference/%s' % (self.indexname, store_key), params={'refresh': 'true'})
+
+    def get_deferred(self, batch, store_key):
+        check_store_key(store_key)
+        return batch.get('image', store_key, self.map_document)
 
     # TODO how cam i assure that it's either str or unicode? pycontracts doesn't know basestring
     # @contract(upload_group='str[>0]')
@@ -133,22 +647,45 @@ class ImageDao(Dao):
                                  updated_at=datetime.now(tz.gettz()),
                                  **properties))
 
+    def create_many(self, upload_group, images):
+        """
+        creates the images given as tuple(store_key, original_filename, properties) with
+        one bulk request. returns a list with None for every created image and the error otherwise
+        """
+        now = datetime.now(tz.gettz())
+        lines = []
+        for store_key, original_filename, properties in images:
+            check_store_key(store_key)
+            lines.append(json.dumps({'index': {'_index': self.indexname, '_type': 'image', '_id': store_key}}))
+            lines.append(json.dumps(dict(properties, original_filename=original_filename, upload_group=upload_group,
+                                         created_at=now, updated_at=now), default=encode_date_optional_time))
+        res = self.es.post('_bulk', data='\n'.join(lines) + '\n')
+        errors = [item.values()[0].get('error') for item in res['items']]
+        for (_, _, properties), error in zip(images, errors):
+            if error == None:
+                self.written(None, properties)
+        return errors
+
     def put(self, store_key, image):
         check_store_key(store_key)
         image_without_store_key = dict(**image)
         if image.has_key('store_key'):
             del image_without_store_key['store_key']
         image_without_store_key['updated_at'] = datetime.now(tz.gettz())
+        old_image = self.get(store_key) if self.facet_counts != None else None
         self.es.put("%s/image/%s" % (self.indexname, store_key), data=image_without_store_key)
+        self.written(old_image, image_without_store_key)
 
     def delete(self, store_key):
         check_store_key(store_key)
+        old_image = self.get(store_key) if self.facet_counts != None else None
         self.es.delete("%s/image/%s" % (self.indexname, store_key))
+        self.written(old_image, None)
 
 class UserDao(Dao):
     import passlib.hash
     def __init__(self, rawes_params, indexname, hash_algo=passlib.hash.pbkdf2_sha256):
-        self.es = rawes.Elastic(**rawes_params)
+        self.es = connect(rawes_params)
         self.indexname = indexname
         self.hash_algo = hash_algo
 
@@ -168,7 +705,7 @@ class InvalidCommentId(Exception):
 
 class CommentDao(Dao):
     def __init__(self, rawes_params, indexname):
-        self.es = rawes.Elastic(**rawes_params)
+        self.es = connect(rawes_params)
         self.indexname = indexname
 
     @contract(offset='int,>=0', length='int,>=1', returns='tuple(list, int)')
@@ -0,0 +1,133 @@
+# encoding: utf-8
+import time, tempfile, threading
+from collections import defaultdict
+from storage import SqliteIndex, SingleFlight
+
+def terms_of(image, key):
+    """ the terms image has for the browse property key, array properties have several """
+    if image == None:
+        return []
+    value = image.get(key)
+    values = value if isinstance(value, list) else [value]
+    return [unicode(term) for term in values if term != None and term != '']
+
+class FacetCounts(SqliteIndex):
+    """
+    the number of images per term of every browse property, shared by all
+    processes on a host through sqlite. writes of images apply the difference
+    between their old and new terms, recount replaces the counts of a property
+    with the facets computed by elasticsearch and corrects any drift. keys is
+    a function returning the keys of the browse properties.
+    """
+    def __init__(self, path, keys):
+        SqliteIndex.__init__(self, path)
+        self.keys = keys
+        self.single_flight = SingleFlight(path + '.locks')
+        self.guard = threading.Lock()
+        # keys recounted by a background thread of this process
+        self.recounting = set()
+
+    def create_tables(self, conn):
+        conn.execute('CREATE TABLE IF NOT EXISTS counts (key TEXT, term TEXT, count INTEGER, PRIMARY KEY (key, term))')
+        conn.execute('CREATE TABLE IF NOT EXISTS recounts (key TEXT PRIMARY KEY, recounted_at REAL)')
+
+    def terms(self, key, prefix=u'', after=None, limit=None, numeric=False):
+        """
+        returns up to limit tuple(term, count) of key sorted by term, only terms
+        starting with prefix and sorting after the term after are returned. terms
+        of numeric properties are sorted by their value
+        """
+        query, params = 'SELECT term, count FROM counts WHERE key = ?', [key]
+        if prefix:
+            # every term starting with prefix sorts below prefix followed by the largest code point
+            query += ' AND term >= ? AND term < ?'
+            params += [prefix, prefix + u'\U0010ffff']
+        # terms are stored as text, whatever the type of the property
+        sort_key, after_param = ('CAST(term AS INTEGER)', 'CAST(? AS INTEGER)') if numeric else ('term', '?')
+        if after != None:
+            query += ' AND %s > %s' % (sort_key, after_param)
+            params.append(after)
+        query += ' ORDER BY ' + sort_key
+        if limit != None:
+            query += ' LIMIT ?'
+            params.append(limit)
+        return self.connection().execute(query, params).fetchall()
+
+    def recounted_at(self, key):
+        """ the time the counts of key were last replaced, None if they never were """
+        row = self.connection().execute('SELECT recounted_at FROM recounts WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def update(self, old_image, new_image):
+        """ applies the change from old_image to new_image, both may be None """
+        deltas = defaultdict(int)
+        for key in self.keys():
+            for term in terms_of(old_image, key):
+                deltas[key, term] -= 1
+            for term in terms_of(new_image, key):
+                deltas[key, term] += 1
+        deltas = [(delta, key, term) for (key, term), delta in deltas.iteritems() if delta != 0]
+        if not deltas:
+            return
+        with self.connection() as conn:
+            conn.executemany('INSERT OR IGNORE INTO counts (key, term, count) VALUES (?, ?, 0)',
+                             [(key, term) for _, key, term in deltas])
+            conn.executemany('UPDATE counts SET count = count + ? WHERE key = ? AND term = ?', deltas)
+            conn.executemany('DELETE FROM counts WHERE key = ? AND term = ? AND count <= 0',
+                             [(key, term) for _, key, term in deltas])
+
+    def replace(self, key, counts):
+        """ replaces the counts of key with the dict counts """
+        with self.connection() as conn:
+            conn.execute('DELETE FROM counts WHERE key = ?', (key,))
+            conn.executemany('INSERT INTO counts (key, term, count) VALUES (?, ?, ?)',
+                             [(key, unicode(term), count) for term, count in counts.iteritems()
+                              if term != '' and count > 0])
+            conn.execute('INSERT OR REPLACE INTO recounts (key, recounted_at) VALUES (?, ?)', (key, time.time()))
+
+    def recount(self, image_dao, keys=None):
+        """ replaces the counts of keys, by default of all browse properties, with the facets of the index """
+        keys = keys or self.keys()
+        facets = image_dao.get_facets(*keys)
+        for key in keys:
+            self.replace(key, facets.get(key, {}))
+
+    def refresh(self, image_dao, key, max_age, logger):
+        """
+        recounts key if its counts are older than max_age seconds. counts that were
+        never made are made right away, stale ones are served while a background
+        thread recounts them, at most one per process and key
+        """
+        recounted_at = self.recounted_at(key)
+        if recounted_at == None:
+            self.recount_once(image_dao, key, max_age)
+        elif time.time() - recounted_at > max_age:
+            with self.guard:
+                if key in self.recounting:
+                    return
+                self.recounting.add(key)
+            thread = threading.Thread(target=self.recount_in_background, args=(image_dao, key, max_age, logger))
+            thread.daemon = True
+            thread.start()
+
+    def recount_once(self, image_dao, key, max_age):
+        # processes waiting for the lock skip counts the first one has just made
+        with self.single_flight.lock(key):
+            recounted_at = self.recounted_at(key)
+            if recounted_at == None or time.time() - recounted_at > max_age:
+                self.recount(image_dao, [key])
+
+    def recount_in_background(self, image_dao, key, max_age, logger):
+        try:
+            self.recount_once(image_dao, key, max_age)
+        except Exception:
+            logger.exception('recounting the facets of %s failed', key)
+        finally:
+            with self.guard:
+                self.recounting.discard(key)
+
+def configured_facet_counts(config, config_dao):
+    """ the FacetCounts of the browse properties of config_dao, stored in the file facet_cache """
+    path = config.get('facet_cache', '%s/tamaraw_facets_%s.sqlite' % (tempfile.gettempdir(),
+                                                                      config['elasticsearch']['indexname']))
+    return FacetCounts(path, lambda: [prop['key'] for prop in config_dao.get_browse_properties()])
@@ -0,0 +1,172 @@
+# encoding: utf-8
+import os, csv, json, mimetypes
+from multiprocessing.pool import ThreadPool
+
+ALLOWED_EXTENSIONS = set(['png', 'jpg', 'jpeg', 'gif'])
+
+def allowed_file(filename):
+    return '.' in filename and \
+           filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+def find_images(directory):
+    """ yields the paths of all images below directory relative to it, in a stable order """
+    for dirpath, dirnames, filenames in os.walk(directory):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if allowed_file(filename):
+                yield os.path.relpath(os.path.join(dirpath, filename), directory)
+
+def prop_key(name):
+    name = name.strip()
+    return name if name.startswith('prop_') else 'prop_' + name
+
+def read_csv_properties(csv_file):
+    """
+    maps the file names in the column "filename" (relative paths or base names)
+    to the properties given by the other columns, in utf-8
+    """
+    properties = {}
+    with open(csv_file, 'rb') as f:
+        for row in csv.DictReader(f):
+            filename = row.pop('filename')
+            properties[filename] = dict((prop_key(name), value.decode('utf-8'))
+                                        for name, value in row.items() if value)
+    return properties
+
+def sidecar_properties(path):
+    """ the properties in the json file next to an image, named image.jpg.json or image.json """
+    for sidecar in (path + '.json', os.path.splitext(path)[0] + '.json'):
+        if os.path.exists(sidecar):
+            with open(sidecar) as f:
+                return dict((prop_key(name), value) for name, value in json.load(f).items())
+    return {}
+
+class Checkpoint(object):
+    """
+    records the imported files of an ingest as json lines, so an interrupted
+    ingest continues where it stopped. the first line holds the upload group.
+    """
+    def __init__(self, path, upload_group):
+        self.path = path
+        self.done = {}
+        self.upload_group = upload_group
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    entry = json.loads(line)
+                    if 'upload_group' in entry:
+                        self.upload_group = entry['upload_group']
+                    else:
+                        self.done[entry['path']] = entry['store_key']
+        self.file = open(path, 'a')
+        if self.file.tell() == 0:
+            self.file.write(json.dumps(dict(upload_group=self.upload_group)) + '\n')
+
+    def __contains__(self, path):
+        return path in self.done
+
+    def add(self, path, store_key):
+        self.done[path] = store_key
+        self.file.write(json.dumps(dict(path=path, store_key=store_key)) + '\n')
+
+    def flush(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+def guess_mimetype(filename):
+    # we don't always receive a mimetype via file.content_type, so derive it from the extension
+    return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+class Importer(object):
+    """
+    saves uploaded files in the store and creates their images. if the image
+    can't be created, the file is removed from the store again.
+    """
+    def __init__(self, store, image_dao, logger, thumbnail_queue=None, thumbnail_sizes=(), workers=4):
+        self.store = store
+        self.image_dao = image_dao
+        self.logger = logger
+        self.thumbnail_queue = thumbnail_queue
+        self.thumbnail_sizes = thumbnail_sizes
+        self.workers = workers
+
+    def save(self, fp, filename):
+        mimetype = guess_mimetype(filename)
+        store_key = self.store.save(fp, mimetype=mimetype)
+        self.logger.info('saved file under store_key %s with mimetype %s', store_key, mimetype)
+        return store_key
+
+    def created(self, store_key):
+        self.logger.info('image with store_key %s persisted in database', store_key)
+        if self.thumbnail_queue != None:
+            self.thumbnail_queue.submit(store_key, self.thumbnail_sizes)
+
+    def rollback(self, store_key):
+        try:
+            # the store counts the other references of the original with a search
+            self.image_dao.refresh_indices()
+            self.store.delete(store_key)
+        except Exception:
+            self.logger.exception('could not remove store_key %s from the store', store_key)
+
+    def import_file(self, upload_group, fp, filename):
+        """ returns the store key of the new image """
+        store_key = self.save(fp, filename)
+        try:
+            self.image_dao.create(upload_group, store_key, filename, blob_key=self.store.resolve(store_key))
+        except Exception as e:
+            self.logger.exception('caught exception while persisting new image to database, removing from store')
+            self.rollback(store_key)
+            raise e
+        self.created(store_key)
+        return store_key
+
+    def save_item(self, item):
+        fp, filename = item
+        try:
+            return self.save(fp, filename), None
+        except Exception as e:
+            self.logger.exception('error while saving %s', filename)
+            return None, str(e)
+
+    def import_files(self, upload_group, files, properties=None):
+        """
+        imports the files given as tuple(file object, filename), properties is an
+        optional list with the properties of every file. the files are saved
+        concurrently and all images are created with one bulk request. returns a
+        dict(filename, store_key, error) per file, store_key is None on failure.
+        """
+        properties = properties or [{}] * len(files)
+        results = [dict(filename=filename, store_key=None, error=None) for _, filename in files]
+        if not files:
+            return results
+        pool = ThreadPool(min(self.workers, len(files)))
+        try:
+            saved = pool.map(self.save_item, files)
+        finally:
+            pool.close()
+            pool.join()
+        for result, (store_key, error) in zip(results, saved):
+            result.update(store_key=store_key, error=error)
+        stored = [(result, props) for result, props in zip(results, properties) if result['store_key'] != None]
+        if not stored:
+            return results
+        try:
+            errors = self.image_dao.create_many(upload_group, [(result['store_key'], result['filename'],
+                                                                dict(props, blob_key=self.store.resolve(result['store_key'])))
+                                                               for result, props in stored])
+        except Exception as e:
+            self.logger.exception('caught exception while persisting new images to database, removing from store')
+            errors = [str(e)] * len(stored)
+        for (result, _), error in zip(stored, errors):
+            if error == None:
+                self.created(result['store_key'])
+            else:
+                self.logger.error('could not persist image with store_key %s: %s', result['store_key'], error)
+                self.rollback(result['store_key'])
+                result.update(store_key=None, error=error)
+        return results
@@ -0,0 +1,131 @@
+# encoding: utf-8
+import os, sys, time, hashlib, threading, heapq
+from collections import defaultdict
+from multiprocessing.pool import ThreadPool
+from storage import extension_for, access_log_hits, open_log, THUMBNAIL_KEY_RE
+
+CACHE_EXTENSIONS = ('.jpg', '.png', '.gif')
+CHUNK_SIZE = 65536
+
+class RateLimiter(object):
+    """ token bucket shared by all download threads. a rate of None means unlimited """
+    def __init__(self, bytes_per_second=None):
+        self.rate = bytes_per_second
+        self.allowance = bytes_per_second
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.time()
+            self.allowance = min(self.rate, self.allowance + (now - self.last) * self.rate) - amount
+            self.last = now
+            wait = -self.allowance / float(self.rate) if self.allowance < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+def top_keys(log_file, n):
+    """ the n most frequently requested keys of an nginx access log """
+    counts = defaultdict(int)
+    with open_log(log_file) as lines:
+        for _, key in access_log_hits(lines):
+            counts[key] += 1
+    return set(heapq.nlargest(n, counts, key=counts.get))
+
+class Prefetcher(object):
+    """
+    downloads objects of a SimpleS3Store into its file cache with several threads.
+    files are written under a temporary name and renamed when complete, objects
+    whose cached file has the listed size (and optionally md5 etag) are skipped.
+    """
+    def __init__(self, store, threads=8, bytes_per_second=None, verify_etag=False, out=sys.stderr, interval=5):
+        self.store = store
+        self.threads = threads
+        self.limiter = RateLimiter(bytes_per_second)
+        self.verify_etag = verify_etag
+        self.out = out
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.stats = dict(files=0, skipped=0, fetched=0, failed=0, bytes=0)
+
+    def select(self, selection='all', keys=None):
+        """ yields (key, etag, size) of the objects to cache. selection is one of all, originals, thumbnails """
+        # a half read listing would keep its connection out of the pool
+        for s3_key, _, etag, size in list(self.store.bucket().listdir(self.store.prefix)):
+            key = s3_key[len(self.store.prefix):]
+            is_thumbnail = THUMBNAIL_KEY_RE.search(key) != None
+            if selection == 'originals' and is_thumbnail or selection == 'thumbnails' and not is_thumbnail:
+                continue
+            if keys != None and key not in keys:
+                continue
+            yield key, etag, size
+
+    def cached_files(self, key):
+        return [key + ext for ext in CACHE_EXTENSIONS if key + ext in self.store.cache]
+
+    def is_complete(self, name, etag, size):
+        path = self.store.cache.path(name)
+        if os.stat(path).st_size != size:
+            return False
+        etag = etag.strip('"')
+        # etags of multipart uploads are no md5 sums of the content
+        if self.verify_etag and '-' not in etag:
+            md5 = hashlib.md5()
+            with open(path) as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+                    md5.update(chunk)
+            return md5.hexdigest() == etag
+        return True
+
+    def fetch(self, item):
+        key, etag, size = item
+        try:
+            cached = self.cached_files(key)
+            if any(self.is_complete(name, etag, size) for name in cached):
+                return 'skipped', 0
+            response = self.store.bucket().get(self.store.prefix + key)
+            written = 0
+            try:
+                ext = extension_for(response.s3_info.get('mimetype', '')) or '.jpg'
+                with self.store.cache.open_atomic(key + ext) as cache_file:
+                    for chunk in iter(lambda: response.read(CHUNK_SIZE), ''):
+                        self.limiter.consume(len(chunk))
+                        cache_file.write(chunk)
+                        written += len(chunk)
+            finally:
+                response.close()
+            # incomplete files or files with a wrong extension from earlier runs
+            for name in cached:
+                if name != key + ext:
+                    os.remove(self.store.cache.path(name))
+            return 'fetched', written
+        except Exception as e:
+            self.out.write('failed to cache %s: %s\n' % (key, e))
+            return 'failed', 0
+
+    def report(self, started_at):
+        elapsed = max(time.time() - started_at, 0.001)
+        with self.lock:
+            self.out.write('%(files)d files: %(fetched)d fetched, %(skipped)d skipped, %(failed)d failed, ' % self.stats +
+                           '%.1f MB in %.0fs (%.2f MB/s)\n' % (self.stats['bytes'] / 1048576.0, elapsed,
+                                                                self.stats['bytes'] / 1048576.0 / elapsed))
+
+    def run(self, items):
+        started_at = last_report = time.time()
+        pool = ThreadPool(self.threads)
+        try:
+            for status, written in pool.imap_unordered(self.fetch, items):
+                with self.lock:
+                    self.stats['files'] += 1
+                    self.stats[status] += 1
+                    self.stats['bytes'] += written
+                if time.time() - last_report >= self.interval:
+                    self.report(started_at)
+                    last_report = time.time()
+        finally:
+            pool.close()
+            pool.join()
+        self.report(started_at)
+        return self.stats
@@ -0,0 +1,45 @@
+# encoding: utf-8
+import time, json, tempfile
+from storage import SqliteIndex
+
+class RecentImages(SqliteIndex):
+    """
+    the search result with the size most recently created images, shared by all
+    processes on a host through sqlite. writes invalidate it, results of queries
+    sent before elasticsearch made the last write searchable (refresh_interval)
+    are not kept, nor are results older than ttl, which bounds how long writes of
+    other hosts stay unnoticed.
+    """
+    def __init__(self, path, size=50, ttl=60, refresh_interval=1):
+        SqliteIndex.__init__(self, path)
+        self.size = size
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+
+    def create_tables(self, conn):
+        conn.execute('CREATE TABLE IF NOT EXISTS recent (id INTEGER PRIMARY KEY, result TEXT, '
+                     'queried_at REAL, invalidated_at REAL)')
+        conn.execute('INSERT OR IGNORE INTO recent (id, invalidated_at) VALUES (1, 0)')
+
+    def get(self):
+        """ the cached search result or None """
+        row = self.connection().execute('SELECT result, queried_at FROM recent WHERE id = 1').fetchone()
+        if row == None or row[0] == None or time.time() - row[1] > self.ttl:
+            return None
+        return json.loads(row[0])
+
+    def put(self, result, queried_at):
+        """ caches result of the query sent at queried_at unless a write could be missing from it """
+        with self.connection() as conn:
+            conn.execute('UPDATE recent SET result = ?, queried_at = ? WHERE id = 1 AND invalidated_at < ?',
+                         (json.dumps(result), queried_at, queried_at - self.refresh_interval))
+
+    def invalidate(self):
+        with self.connection() as conn:
+            conn.execute('UPDATE recent SET result = NULL, invalidated_at = ? WHERE id = 1', (time.time(),))
+
+def configured_recent_images(config):
+    """ the RecentImages stored in the file recent_cache """
+    path = config.get('recent_cache', '%s/tamaraw_recent_%s.sqlite' % (tempfile.gettempdir(),
+                                                                        config['elasticsearch']['indexname']))
+    return RecentImages(path, config.get('recent_cache_size', 50), config.get('recent_cache_ttl', 60))
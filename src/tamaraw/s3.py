@@ -0,0 +1,167 @@
+# encoding: utf-8
+import urllib, urllib2, socket, time, re
+from StringIO import StringIO
+from simples3 import S3Bucket
+from simples3.bucket import S3Error, AnyMethodRequest
+from simples3.utils import aws_md5, rfc822_fmt
+from requests.packages.urllib3 import connection_from_url
+from requests.packages.urllib3.exceptions import HTTPError as PoolHTTPError
+
+class PooledResponse(object):
+    """ adapts an urllib3 response to the parts of the urllib2 response interface simples3 uses """
+    def __init__(self, response, url):
+        self.response = response
+        self.url = url
+        self.code = response.status
+        self.msg = response.reason
+
+    def info(self):
+        # header names are lower case, just like in dict(urllib2_response.info())
+        return self.response.headers
+
+    def read(self, amt=None):
+        return self.response.read(amt)
+
+    def close(self):
+        # the connection goes back into the pool once the body has been consumed
+        self.response.read()
+        self.response.release_conn()
+
+class PooledS3Bucket(S3Bucket):
+    """
+    S3Bucket which sends its requests over a pool of keep-alive connections
+    instead of opening a new connection for every request. requests failing
+    on the transport level are retried with exponential backoff. all requests
+    simples3 makes (GET, HEAD, PUT and DELETE of keys) are idempotent.
+    instances may be used by several threads, but not across a fork.
+    """
+    def __init__(self, name, access_key=None, secret_key=None, base_url=None, timeout=30,
+                 pool_size=10, max_retries=3, retry_backoff=0.1, part_size=8 * 1024 * 1024):
+        S3Bucket.__init__(self, name, access_key, secret_key, base_url, timeout)
+        self.pool = connection_from_url(self.base_url, maxsize=pool_size, timeout=timeout)
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.part_size = part_size
+
+    def build_opener(self):
+        return None
+
+    def open_request(self, request):
+        url = request.get_full_url()
+        attempt = 0
+        while True:
+            try:
+                # retries=1 lets urllib3 replace a keep-alive connection the server has closed
+                response = self.pool.urlopen(request.get_method(), url, body=request.get_data(),
+                                             headers=dict(request.header_items()), retries=1,
+                                             redirect=False, preload_content=False, release_conn=False)
+                break
+            except (socket.error, PoolHTTPError) as e:
+                if attempt >= self.max_retries:
+                    raise urllib2.URLError(e)
+                time.sleep(self.retry_backoff * 2 ** attempt)
+                attempt += 1
+        if response.status >= 400:
+            body = response.read()
+            response.release_conn()
+            raise urllib2.HTTPError(url, response.status, response.reason, response.headers, StringIO(body))
+        return PooledResponse(response, url)
+
+    def subresource_request(self, method, key, subresource, data=None, headers={}):
+        """
+        sends a request to a subresource like ?uploads, which simples3 doesn't
+        sign. subresource is a list of (name, value) tuples sorted by name,
+        value is None for names without value.
+        """
+        headers = dict(headers, Date=time.strftime(rfc822_fmt, time.gmtime()))
+        if data:
+            headers['Content-MD5'] = aws_md5(data)
+        signed = '&'.join(name if value == None else '%s=%s' % (name, value) for name, value in subresource)
+        headers['Authorization'] = 'AWS %s:%s' % (self.access_key, self.get_request_signature(
+            method, key=key, headers=headers, subresource=signed))
+        query = '&'.join(name if value == None else '%s=%s' % (name, urllib.quote(str(value), ''))
+                         for name, value in subresource)
+        try:
+            return self.open_request(AnyMethodRequest(method, self.make_url(key) + '?' + query, data=data,
+                                                      headers=headers))
+        except urllib2.HTTPError as e:
+            raise S3Error.from_urllib(e, key=key)
+
+    def upload(self, key, mimetype, headers={}):
+        return MultipartUpload(self, key, mimetype, headers, self.part_size)
+
+def xml_value(body, tag):
+    match = re.search('<%s>(.*?)</%s>' % (tag, tag), body)
+    return match.group(1) if match else None
+
+class MultipartUpload(object):
+    """
+    uploads an object written to it in chunks of any size as parts of
+    part_size bytes, so no more than one part is held in memory. objects
+    smaller than one part are uploaded with a single PUT. if the with-block
+    raises, the upload is aborted.
+    """
+    def __init__(self, bucket, key, mimetype, headers={}, part_size=8 * 1024 * 1024):
+        # s3 requires all parts but the last one to be at least 5 MB
+        assert part_size >= 5 * 1024 * 1024
+        self.bucket = bucket
+        self.key = key
+        self.headers = dict(headers, **{'Content-Type': str(mimetype)})
+        self.part_size = part_size
+        self.buffer = []
+        self.buffered = 0
+        self.upload_id = None
+        self.etags = []
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.part_size:
+            self.upload_part()
+
+    def upload_part(self):
+        if self.upload_id == None:
+            response = self.bucket.subresource_request('POST', self.key, [('uploads', None)], headers=self.headers)
+            self.upload_id = xml_value(response.read(), 'UploadId')
+            response.close()
+        data = ''.join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        response = self.bucket.subresource_request('PUT', self.key, [('partNumber', len(self.etags) + 1),
+                                                                     ('uploadId', self.upload_id)], data)
+        self.etags.append(response.info()['etag'])
+        response.close()
+
+    def close(self):
+        if self.upload_id == None:
+            self.bucket.put(self.key, ''.join(self.buffer), headers=self.headers)
+            self.buffer = []
+            return
+        if self.buffered:
+            self.upload_part()
+        parts = ''.join('<Part><PartNumber>%d</PartNumber><ETag>%s</ETag></Part>' % (number + 1, etag)
+                        for number, etag in enumerate(self.etags))
+        response = self.bucket.subresource_request('POST', self.key, [('uploadId', self.upload_id)],
+                                                   '<CompleteMultipartUpload>%s</CompleteMultipartUpload>' % (parts,))
+        body = response.read()
+        response.close()
+        # errors during completion are reported with status 200
+        if '<Error>' in body:
+            raise S3Error('completing multipart upload failed: %s' % (xml_value(body, 'Message'),), key=self.key)
+
+    def abort(self):
+        if self.upload_id != None:
+            self.bucket.subresource_request('DELETE', self.key, [('uploadId', self.upload_id)]).close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type == None:
+            self.close()
+        else:
+            try:
+                self.abort()
+            except (S3Error, urllib2.URLError):
+                # the original exception is more useful, unfinished uploads are removed by the bucket's lifecycle rules
+                pass
@@ -0,0 +1,60 @@
+# encoding: utf-8
+import time, json, uuid
+from storage import SqliteIndex
+
+class ResultSnapshots(SqliteIndex):
+    """
+    the ordered store keys of a window of a result set, so navigating from image
+    to image stays in the order the result set had when navigation started.
+    shared by all processes on a host through sqlite, snapshots expire ttl
+    seconds after they were created and only the max_entries newest are kept.
+    reading a snapshot never writes.
+    """
+    def __init__(self, path, max_entries=10000, ttl=3600):
+        SqliteIndex.__init__(self, path)
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+    def create_tables(self, conn):
+        # snapshots are disposable, tables of older versions are replaced
+        columns = set(row[1] for row in conn.execute('PRAGMA table_info(snapshots)'))
+        if columns and 'created_at' not in columns:
+            conn.execute('DROP TABLE snapshots')
+        conn.execute('CREATE TABLE IF NOT EXISTS snapshots (id TEXT PRIMARY KEY, result_set TEXT, start INTEGER, '
+                     'size INTEGER, total INTEGER, keys TEXT, created_at REAL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS snapshots_result_set ON snapshots (result_set, created_at)')
+        conn.execute('CREATE INDEX IF NOT EXISTS snapshots_created_at ON snapshots (created_at)')
+
+    def create(self, result_set, start, keys, total):
+        """ stores the keys of result_set from offset start on and returns the id of the snapshot """
+        snapshot_id = uuid.uuid4().hex
+        now = time.time()
+        with self.connection() as conn:
+            conn.execute('INSERT INTO snapshots (id, result_set, start, size, total, keys, created_at) '
+                         'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                         (snapshot_id, result_set, start, len(keys), total, json.dumps(keys), now))
+            conn.execute('DELETE FROM snapshots WHERE created_at < ?', (now - self.ttl,))
+            conn.execute('DELETE FROM snapshots WHERE id IN (SELECT id FROM snapshots ORDER BY created_at DESC '
+                         'LIMIT -1 OFFSET ?)', (self.max_entries,))
+        return snapshot_id
+
+    def get(self, snapshot_id):
+        """ returns dict(id, result_set, start, total, keys) or None if the snapshot expired """
+        row = self.connection().execute('SELECT id, result_set, start, total, keys FROM snapshots '
+                                        'WHERE id = ? AND created_at >= ?',
+                                        (snapshot_id, time.time() - self.ttl)).fetchone()
+        return self.as_dict(row)
+
+    def latest(self, result_set, offset, max_age):
+        """ the newest snapshot of result_set with the key at offset created at most max_age seconds ago, or None """
+        row = self.connection().execute('SELECT id, result_set, start, total, keys FROM snapshots '
+                                        'WHERE result_set = ? AND created_at >= ? AND start <= ? AND ? < start + size '
+                                        'ORDER BY created_at DESC LIMIT 1',
+                                        (result_set, time.time() - min(max_age, self.ttl), offset, offset)).fetchone()
+        return self.as_dict(row)
+
+    def as_dict(self, row):
+        if row == None:
+            return None
+        snapshot_id, result_set, start, total, keys = row
+        return dict(id=snapshot_id, result_set=result_set, start=start, total=total, keys=json.loads(keys))
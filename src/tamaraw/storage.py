@@ -1,13 +1,28 @@
 # encoding: utf-8
-import random, os, magic, Image, base64, struct, time, mimetypes
-from flask import redirect
+import random, os, re, magic, Image, base64, struct, time, calendar, mimetypes, tempfile, threading, fcntl, zlib, errno, sqlite3, gzip, urllib, hashlib
+from contextlib import contextmanager
+from StringIO import StringIO
+from flask import redirect, request, Response
 from flask.helpers import send_file
 from util import check_store_key
-from simples3 import S3Bucket
+from s3 import PooledS3Bucket
+from simples3.bucket import KeyNotFound
 
 def unique_id():
     return base64.urlsafe_b64encode(struct.pack('fHH', time.time(), os.getpid() % 65536, random.randint(0, 65535))).replace('=', '')
 
+# canonical thumbnail sizes. requests for other sizes are redirected to one of these
+# so the number of thumbnails per image stays bounded
+THUMBNAIL_SIZES = [(320, 240), (400, 300), (640, 480), (1280, 960)]
+
+def snap_size(size, ladder=THUMBNAIL_SIZES):
+    """ returns the smallest size of the ladder which covers size, or the largest one """
+    ladder = sorted(ladder, key=lambda s: s[0] * s[1])
+    for candidate in ladder:
+        if candidate[0] >= size[0] and candidate[1] >= size[1]:
+            return candidate
+    return ladder[-1]
+
 # http://united-coders.com/christian-harms/image-resizing-tips-every-coder-should-know/
 def resize(img, box, fit, out, quality=75):
     '''Downsample the image.
@@ -43,6 +58,318 @@ def resize(img, box, fit, out, quality=75):
     # save it into a file-like object
     img.save(out, "JPEG", quality=quality)
 
+def resize_all(img, sizes, open_out, quality=75):
+    '''Downsample the image to several sizes, decoding it only once.
+    @param img: Image - an Image-object which has not been loaded yet
+    @param sizes: list of tuple(x, y) - the bounding boxes of the result images
+    @param open_out: function(size) - returns the file-like-object for the image of the given size,
+        it is closed afterwards
+    '''
+    sizes = sorted(sizes, key=lambda size: size[0] * size[1], reverse=True)
+    if img.format == 'JPEG':
+        # let the decoder scale by 1/2, 1/4 or 1/8 as long as the result covers the largest box
+        img.draft(img.mode, sizes[0])
+    if img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+    previous, previous_size = None, None
+    for size in sizes:
+        # a larger thumbnail is a cheaper source than the original if it covers the box
+        if previous is not None and previous_size[0] >= size[0] and previous_size[1] >= size[1]:
+            current = previous.copy()
+        else:
+            current = img.copy()
+        with open_out(size) as out:
+            resize(current, size, False, out, quality)
+        previous, previous_size = current, size
+
+class AtomicFile(object):
+    """
+    a file which is written under a temporary name in the same directory and
+    renamed to its final name when it is closed, so readers never see partial
+    content. if the with-block raises, the temporary file is removed instead.
+    """
+    def __init__(self, path, mode='w+b'):
+        self.path = path
+        makedirs(os.path.dirname(path))
+        fd, self.tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp_')
+        # mkstemp creates files only readable by the owner, the web server must read them
+        os.fchmod(fd, 0644)
+        self.file = os.fdopen(fd, mode)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+            os.rename(self.tmp_path, self.path)
+
+    def discard(self):
+        self.file.close()
+        try:
+            os.remove(self.tmp_path)
+        except OSError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type == None:
+            self.close()
+        else:
+            self.discard()
+
+CHUNK_SIZE = 65536
+
+def copy_chunks(fp, outputs, head=''):
+    """
+    copies head and the rest of fp chunk by chunk to all outputs. returns
+    tuple(sha1 hex digest, size) of the copied content
+    """
+    sha1 = hashlib.sha1()
+    size = 0
+    chunk = head or fp.read(CHUNK_SIZE)
+    while chunk:
+        sha1.update(chunk)
+        size += len(chunk)
+        for out in outputs:
+            out.write(chunk)
+        chunk = fp.read(CHUNK_SIZE)
+    return sha1.hexdigest(), size
+
+def sniff_mimetype(head, mimetype=None):
+    """ the mimetype of content starting with head, or mimetype if it can't be recognized """
+    try:
+        return Image.MIME.get(Image.open(StringIO(head)).format, mimetype)
+    except Exception:
+        # truncated or no image
+        sniffed = magic.from_buffer(head, mime=True)
+        return mimetype if sniffed in (None, 'application/octet-stream') else sniffed
+
+def image_metadata(f, mimetype=None, content_hash=None):
+    """
+    mimetype, byte size, pixel dimensions, extension and sha1 of the content
+    of the file f. content_hash is tuple(sha1 hex digest, size) if known
+    """
+    if content_hash == None:
+        f.seek(0)
+        content_hash = copy_chunks(f, [])
+    sha1, size = content_hash
+    f.seek(0)
+    width = height = None
+    try:
+        img = Image.open(f)
+        width, height = img.size
+        mimetype = Image.MIME.get(img.format, mimetype)
+    except IOError:
+        if mimetype == None:
+            mimetype = magic.from_buffer(f.read(8192), mime=True)
+    f.seek(0)
+    mimetype = mimetype or 'application/octet-stream'
+    return dict(mimetype=mimetype, size=size, width=width, height=height,
+                ext=extension_for(mimetype), sha1=sha1)
+
+def makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+THUMBNAIL_KEY_RE = re.compile(r'_\d+x\d+$')
+
+# store key, optional thumbnail size and optional extension of the files of stores and caches
+STORE_FILE_RE = re.compile(r'^([A-Za-z0-9_-]+?)(_\d+x\d+)?(\.[a-z]{3,4})?$')
+
+class ShardedDirectory(object):
+    """
+    places a file at root/ab/cd/name, where abcd are the first hex digits of the
+    md5 of the store key it belongs to, so thumbnails share the directory of
+    their original. files in the old flat layout (root/name) are still found
+    until they have been migrated.
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def sharded_path(self, name):
+        match = STORE_FILE_RE.match(name)
+        digest = hashlib.md5(match.group(1) if match else name).hexdigest()
+        return '%s/%s/%s/%s' % (self.root, digest[:2], digest[2:4], name)
+
+    def flat_path(self, name):
+        return self.root + '/' + name
+
+    def path(self, name):
+        """ the path a file is found at or, if it does not exist yet, is to be created at """
+        path = self.sharded_path(name)
+        if not os.path.exists(path) and os.path.exists(self.flat_path(name)):
+            return self.flat_path(name)
+        return path
+
+    def names_of(self, key):
+        """ the names of the sharded files of key and its thumbnails """
+        directory = os.path.dirname(self.sharded_path(key))
+        if not os.path.isdir(directory):
+            return []
+        return [name for name in os.listdir(directory)
+                if name == key or name.startswith(key + '_') and THUMBNAIL_KEY_RE.search(name)]
+
+    def flat_names(self):
+        for name in os.listdir(self.root):
+            if STORE_FILE_RE.match(name) and len(name) != 2 and os.path.isfile(self.flat_path(name)):
+                yield name
+
+    def names(self):
+        """ the names of all files in both layouts, except hidden and temporary ones """
+        for shard in os.listdir(self.root):
+            if len(shard) != 2 or not os.path.isdir(self.flat_path(shard)):
+                continue
+            for sub_shard in os.listdir(self.flat_path(shard)):
+                for name in os.listdir('%s/%s/%s' % (self.root, shard, sub_shard)):
+                    if not name.startswith('.'):
+                        yield name
+        for name in self.flat_names():
+            yield name
+
+    def migrate(self, batch_size=1000, pause=0.0):
+        """
+        moves the files of the flat layout to their sharded paths and yields the
+        number of files moved after every batch. files are linked to the new path
+        before the old one is removed, so they can be read at any time.
+        """
+        moved = 0
+        for name in self.flat_names():
+            path = self.sharded_path(name)
+            makedirs(os.path.dirname(path))
+            try:
+                os.link(self.flat_path(name), path)
+            except OSError as e:
+                # created at the new path in the meantime, e.g. a thumbnail
+                if e.errno != errno.EEXIST:
+                    raise
+            os.remove(self.flat_path(name))
+            moved += 1
+            if moved % batch_size == 0:
+                yield moved
+                time.sleep(pause)
+        if moved % batch_size != 0:
+            yield moved
+
+class SingleFlight(object):
+    """
+    serializes work on the same key: threads of one process wait on a lock per
+    key, processes wait on an flock of one of 256 lock files in lock_dir.
+    """
+    def __init__(self, lock_dir):
+        self.lock_dir = lock_dir
+        self.guard = threading.Lock()
+        # key -> [lock, number of threads holding or waiting for it]
+        self.locks = {}
+
+    def lock_file_path(self, key):
+        return '%s/%02x.lock' % (self.lock_dir, zlib.crc32(key) & 0xff)
+
+    @contextmanager
+    def lock(self, key):
+        with self.guard:
+            entry = self.locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        entry[0].acquire()
+        try:
+            makedirs(self.lock_dir)
+            with open(self.lock_file_path(key), 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+        finally:
+            entry[0].release()
+            with self.guard:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self.locks[key]
+
+def read_range(f, start, stop, chunk_size=65536):
+    try:
+        f.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+class FileSender(object):
+    """
+    sends local files. in mode python the worker streams the file itself and
+    answers single byte range requests. in modes x-accel-redirect (nginx) and
+    x-sendfile (apache, lighttpd) only headers are sent and the front proxy
+    delivers the file, including ranges. locations maps storage roots to the
+    internal locations (or paths) the proxy knows them by, files outside of
+    all roots are sent by the worker.
+    """
+    MODES = ('python', 'x-accel-redirect', 'x-sendfile')
+
+    def __init__(self, mode='python', locations=None):
+        if mode not in self.MODES:
+            raise ValueError('unknown delivery mode %s, must be one of %s' % (mode, ', '.join(self.MODES)))
+        self.mode = mode
+        # longest roots first, so nested roots take precedence
+        self.locations = sorted([(os.path.abspath(root).rstrip('/') + '/', location.rstrip('/') + '/')
+                                 for root, location in (locations or {}).items()],
+                                key=lambda item: -len(item[0]))
+
+    def internal_location(self, path):
+        path = os.path.abspath(path)
+        for root, location in self.locations:
+            if path.startswith(root):
+                return location + path[len(root):]
+        return None
+
+    def send(self, path, mimetype, etag=None):
+        location = self.internal_location(path)
+        if self.mode == 'x-accel-redirect' and location != None:
+            response = Response(mimetype=mimetype, headers={'X-Accel-Redirect': urllib.quote(location)})
+        elif self.mode == 'x-sendfile':
+            response = Response(mimetype=mimetype, headers={'X-Sendfile': location or os.path.abspath(path)})
+        else:
+            response = self.send_python(path, mimetype, etag)
+        response.headers['Accept-Ranges'] = 'bytes'
+        return response
+
+    def requested_range(self, etag):
+        """ the Range of the request or None if the whole file has to be sent """
+        try:
+            byte_range = request.range
+        except ValueError:
+            return None
+        if byte_range == None or byte_range.units != 'bytes' or len(byte_range.ranges) != 1:
+            return None
+        if_range = request.if_range
+        # a range for a different version of the file (or a date we can't verify) means the whole file
+        if if_range.date != None or if_range.etag != None and if_range.etag != etag:
+            return None
+        return byte_range
+
+    def send_python(self, path, mimetype, etag):
+        byte_range = self.requested_range(etag)
+        if byte_range == None:
+            return send_file(path, mimetype)
+        size = os.path.getsize(path)
+        content_range = byte_range.range_for_length(size)
+        if content_range == None:
+            return Response(status=416, headers={'Content-Range': 'bytes */%d' % (size,)})
+        start, stop = content_range
+        response = Response(read_range(open(path, 'rb'), start, stop), 206, mimetype=mimetype, direct_passthrough=True)
+        response.headers['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1, size)
+        response.content_length = stop - start
+        return response
+
 class StoreError (StandardError):
     def __init__(self, msg):
         super(msg)
@@ -61,59 +388,151 @@ class Store:
     def deliver_image(self, key, size):
         raise NotImplementedError
 
+    def create_thumbnails(self, key, sizes):
+        raise NotImplementedError
+
     def delete(self, key):
         raise NotImplementedError
 
 class LocalStore:
     def __init__(self, root):
         self.root = root
+        self.files = ShardedDirectory(root)
+        self.single_flight = SingleFlight(root + '/.locks')
+        self.objects = ObjectIndex(root + '/.objects.sqlite')
+        # if set, missing thumbnails are created in the background
+        self.thumbnail_queue = None
+        self.sender = FileSender()
 
     def save(self, fp, mimetype='application/octet-stream'):
         key = unique_id()
-        filename = self.root + '/' + key
-        with open(filename, 'w') as dest:
-            dest.write(fp.read())
+        with AtomicFile(self.files.sharded_path(key)) as dest:
+            content_hash = copy_chunks(fp, [dest])
+            if self.objects.add_reference(key, *content_hash) != None:
+                # the same content is already stored, key refers to it
+                dest.discard()
+                return key
+            try:
+                dest.flush()
+                metadata = image_metadata(dest, mimetype, content_hash)
+            except Exception:
+                self.objects.remove_reference(key)
+                raise
+        self.objects.add(key, metadata)
         return key
 
+    def thumbnail_key(self, key, size):
+        return key + ('_%sx%s' % (size))
+
+    def resolve(self, key):
+        """ the key of the stored original, which differs from key for duplicate uploads """
+        check_store_key(key)
+        return self.objects.resolve(key)
+
     def thumbnail_path(self, key, size):
         check_store_key(key)
-        return self.root + '/' + key + ('_%sx%s' % (size))
+        return self.files.path(self.thumbnail_key(self.objects.resolve(key), size))
 
     def path(self, key):
         check_store_key(key)
-        return self.root + '/' + key
+        return self.files.path(self.objects.resolve(key))
 
     def create_thumbnail(self, key, size):
+        self.create_thumbnails(key, [size])
+
+    def create_thumbnails(self, key, sizes):
         check_store_key(key)
-        image = Image.open(self.path(key))
-        with open(self.thumbnail_path(key, size), 'w') as out:
-            resize(image, size, False, out)
+        key = self.objects.resolve(key)
+        # concurrent requests for the same image wait for the first one and reuse its thumbnails
+        with self.single_flight.lock(key):
+            sizes = [size for size in sizes if not os.path.exists(self.thumbnail_path(key, size))]
+            if not sizes:
+                return
+            with open(self.path(key)) as original:
+                resize_all(Image.open(original), sizes, lambda size: AtomicFile(self.thumbnail_path(key, size)))
+            for size in sizes:
+                with open(self.thumbnail_path(key, size), 'rb') as thumbnail:
+                    self.objects.add(self.thumbnail_key(key, size), image_metadata(thumbnail, 'image/jpeg'))
+
+    def metadata(self, name):
+        """ metadata of an original or thumbnail, recorded on first use for files stored without it """
+        metadata = self.objects.metadata(name)
+        if metadata == None:
+            with open(self.files.path(name), 'rb') as f:
+                metadata = image_metadata(f)
+            self.objects.add(name, metadata)
+        return metadata
 
     def deliver_image(self, key, size=None):
         check_store_key(key)
+        # the requested key, not the one of the shared original, is the etag the client knows
+        etag = key if size == None else self.thumbnail_key(key, size)
+        key = self.objects.resolve(key)
         if size != None:
-            path = self.thumbnail_path(key, size)
-            try:
-                os.stat(path)
-            except OSError:
+            name = self.thumbnail_key(key, size)
+            if not self.objects.lookup(name) and not os.path.exists(self.thumbnail_path(key, size)):
+                if self.thumbnail_queue != None:
+                    retry = self.thumbnail_queue.create_or_retry(key, size)
+                    if retry != None:
+                        return retry
+                # creates it if the job failed or was rejected
                 self.create_thumbnail(key, size)
-            return self.deliver_file(self.thumbnail_path(key, size))
+            return self.deliver_file(name, etag)
         else:
-            return self.deliver_file(self.path(key))
+            return self.deliver_file(key, etag)
 
-    def deliver_file(self, path):
-        return send_file(path, magic.from_file(path))
+    def deliver_file(self, name, etag=None):
+        # the name is the key or thumbnail key, which is also the etag of the file unless it is shared
+        return self.sender.send(self.files.path(name), self.metadata(name)['mimetype'], etag or name)
 
     def delete(self, key):
         check_store_key(key)
-        os.remove(self.path(key))
+        blob, unreferenced = self.objects.remove_reference(key)
+        if not unreferenced:
+            return
+        names = set(self.files.names_of(blob) + self.objects.thumbnail_keys(blob) + [blob])
+        for name in names:
+            try:
+                os.remove(self.files.path(name))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            self.objects.remove(name)
+
+def extension_for(mimetype):
+    # ".jpe" would have been my first choice for naming jpegs.. not
+    return (mimetypes.guess_extension(mimetype) or '').replace('jpe', 'jpg')
+
+ACCESS_LOG_RE = re.compile(r'^\S+ \S+ \S+ \[([^\]]+)\] "(?:GET|HEAD) /files/([0-9a-zA-Z_\-]+) [^"]*" (\d{3}) ')
+
+def parse_log_time(value):
+    """ parses nginx' $time_local, e.g. 18/Oct/2016:13:55:36 +0200, into a unix timestamp """
+    timestamp = calendar.timegm(time.strptime(value[:20], '%d/%b/%Y:%H:%M:%S'))
+    offset = value[21:]
+    if offset:
+        sign = -1 if offset[0] == '-' else 1
+        timestamp -= sign * (int(offset[1:3]) * 3600 + int(offset[3:5]) * 60)
+    return timestamp
+
+def access_log_hits(lines):
+    """ yields (timestamp, key) for every successfully delivered file of an nginx access log """
+    for line in lines:
+        match = ACCESS_LOG_RE.match(line)
+        if match and int(match.group(3)) < 400 and match.group(3) != '301':
+            yield parse_log_time(match.group(1)), match.group(2)
+
+def open_log(log_file):
+    if log_file.endswith('.gz'):
+        return gzip.open(log_file)
+    return open(log_file)
 
 class FileCache:
     def __init__(self, cache_dir='/tmp/tamaraw/image_cache'):
         self.cache_dir = cache_dir
+        self.files = ShardedDirectory(cache_dir)
 
     def path(self, key):
-        return self.cache_dir + '/' + key
+        return self.files.path(key)
     
     def __contains__(self, key):
         try:
@@ -123,107 +542,512 @@ class FileCache:
             return False
     
     def open(self, key, mode='r'):
-        return open(self.path(key), mode)
+        path = self.path(key)
+        if 'r' not in mode:
+            makedirs(os.path.dirname(path))
+        return open(path, mode)
+
+    def open_atomic(self, key):
+        return AtomicFile(self.path(key))
         
+    def entries(self):
+        """ maps the keys of all cached files to tuple(file name, size) """
+        entries = {}
+        for name in self.files.names():
+            key, ext = os.path.splitext(name)
+            if ext not in ('.jpg', '.png', '.gif'):
+                continue
+            try:
+                entries[key] = (name, os.stat(self.path(name)).st_size)
+            except OSError:
+                pass
+        return entries
+
     # the idea is to call this from a cron job
-    # this function should analyze an nginx log file and determine which
-    # images should be cached, possibly evicting seldomly requested ones
+    # this function analyzes an nginx log file and determines which
+    # images should be cached, evicting seldomly requested ones
     # and downloading additional ones which have dropped out of the cache.
     # this is necessary because the s3 store class only fills the cache
     # when convenient
-    def manage(self, log_file, max_size):
-        raise NotImplementedError
+    def manage(self, log_file, max_size, source=None, half_life=7 * 86400, now=None):
+        """
+        every request adds 1 to the score of a file, scores halve every half_life
+        seconds. the files with the highest scores are kept or fetched as long as
+        they fit into max_size bytes, all others are evicted. source must provide
+        object_info(key) -> tuple(size, extension) or None and
+        fetch_into_cache(key, extension) -> number of bytes written. without a
+        source, the cache is only shrunk.
+        """
+        # key -> [decayed score, time of the last update, number of requests]
+        scores = {}
+        with open_log(log_file) as lines:
+            for timestamp, key in access_log_hits(lines):
+                entry = scores.get(key)
+                if entry == None:
+                    scores[key] = [1.0, timestamp, 1]
+                elif timestamp >= entry[1]:
+                    entry[0] = entry[0] * 0.5 ** ((timestamp - entry[1]) / float(half_life)) + 1
+                    entry[1] = timestamp
+                    entry[2] += 1
+                else:
+                    entry[0] += 0.5 ** ((entry[1] - timestamp) / float(half_life))
+                    entry[2] += 1
+        now = now or time.time()
+        def score(key):
+            entry = scores.get(key)
+            if entry == None:
+                return 0.0
+            return entry[0] * 0.5 ** (max(now - entry[1], 0) / float(half_life))
+
+        cached = self.entries()
+        budget = max_size
+        keep = set()
+        fetch = []
+        for key in sorted(set(scores) | set(cached), key=score, reverse=True):
+            if key in cached:
+                size = cached[key][1]
+            elif source != None and budget > 0:
+                info = source.object_info(key)
+                if info == None:
+                    continue
+                size, ext = info
+            else:
+                continue
+            if size > budget:
+                continue
+            budget -= size
+            if key in cached:
+                keep.add(key)
+            else:
+                fetch.append((key, ext))
+
+        report = dict(requests=sum(entry[2] for entry in scores.itervalues()),
+                      requested_files=len(scores),
+                      files_evicted=0, bytes_evicted=0, files_fetched=0, bytes_fetched=0)
+        for key, (name, size) in cached.iteritems():
+            if key not in keep:
+                try:
+                    os.remove(self.path(name))
+                    report['files_evicted'] += 1
+                    report['bytes_evicted'] += size
+                except OSError:
+                    pass
+        fetched = set()
+        for key, ext in fetch:
+            try:
+                report['bytes_fetched'] += source.fetch_into_cache(key, ext)
+                report['files_fetched'] += 1
+                fetched.add(key)
+            except KeyError:
+                pass
+        requests = float(report['requests']) or 1.0
+        report['hit_ratio_before'] = sum(scores[key][2] for key in cached if key in scores) / requests
+        report['hit_ratio_after'] = sum(scores[key][2] for key in keep | fetched if key in scores) / requests
+        report['cache_size'] = sum(size for key, (_, size) in cached.iteritems() if key in keep) + report['bytes_fetched']
+        return report
+
+METADATA_FIELDS = ('mimetype', 'size', 'width', 'height', 'ext', 'sha1')
+
+class SqliteIndex(object):
+    """
+    base of the indexes shared by all processes on a host through the sqlite
+    file path. subclasses create their tables in create_tables.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    def connection(self):
+        # sqlite connections must neither be shared between threads nor survive a fork
+        if getattr(self.local, 'pid', None) != os.getpid():
+            makedirs(os.path.dirname(self.path))
+            conn = sqlite3.connect(self.path, timeout=10)
+            self.create_tables(conn)
+            conn.commit()
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return self.local.conn
+
+    def create_tables(self, conn):
+        raise NotImplementedError()
+
+class ObjectIndex(SqliteIndex):
+    """
+    persistent index of the keys known to exist and their metadata (see
+    image_metadata), shared by all processes on a host through sqlite. keys
+    found missing are remembered in memory for negative_ttl seconds.
+    originals with the same content are stored once, the references table
+    maps the keys of all images to the key of the stored original (blob).
+    """
+    def __init__(self, path, negative_ttl=30):
+        SqliteIndex.__init__(self, path)
+        self.negative_ttl = negative_ttl
+        self.misses = {}
+
+    def create_tables(self, conn):
+        conn.execute('CREATE TABLE IF NOT EXISTS objects (key TEXT PRIMARY KEY, mimetype TEXT, size INTEGER, '
+                     'width INTEGER, height INTEGER, ext TEXT, sha1 TEXT)')
+        # indexes created before metadata was recorded
+        columns = set(row[1] for row in conn.execute('PRAGMA table_info(objects)'))
+        for field in METADATA_FIELDS:
+            if field not in columns:
+                conn.execute('ALTER TABLE objects ADD COLUMN %s' % (field,))
+        conn.execute('CREATE INDEX IF NOT EXISTS objects_sha1 ON objects (sha1)')
+        conn.execute('CREATE TABLE IF NOT EXISTS refs (key TEXT PRIMARY KEY, blob TEXT)')
+        conn.execute('CREATE INDEX IF NOT EXISTS refs_blob ON refs (blob)')
+
+    def lookup(self, key):
+        """ returns True if key is known to exist, False if it was recently found missing, None otherwise """
+        if self.connection().execute('SELECT 1 FROM objects WHERE key = ?', (key,)).fetchone():
+            return True
+        missed_at = self.misses.get(key)
+        if missed_at != None:
+            if time.time() - missed_at < self.negative_ttl:
+                return False
+            self.misses.pop(key, None)
+        return None
+
+    def metadata(self, key):
+        """ returns the metadata of key or None if it is unknown """
+        row = self.connection().execute('SELECT %s FROM objects WHERE key = ? AND mimetype IS NOT NULL'
+                                        % (', '.join(METADATA_FIELDS),), (key,)).fetchone()
+        return dict(zip(METADATA_FIELDS, row)) if row else None
+
+    def add(self, key, metadata=None):
+        self.misses.pop(key, None)
+        with self.connection() as conn:
+            if metadata == None:
+                conn.execute('INSERT OR IGNORE INTO objects (key) VALUES (?)', (key,))
+            else:
+                conn.execute('INSERT OR REPLACE INTO objects (key, %s) VALUES (?%s)'
+                             % (', '.join(METADATA_FIELDS), ', ?' * len(METADATA_FIELDS)),
+                             (key,) + tuple(metadata[field] for field in METADATA_FIELDS))
+
+    def add_miss(self, key):
+        self.misses[key] = time.time()
+
+    def remove(self, key):
+        with self.connection() as conn:
+            conn.execute('DELETE FROM objects WHERE key = ?', (key,))
+
+    def thumbnail_keys(self, key):
+        """ the known thumbnails of key """
+        # '`' follows '_', the keys in between start with key and an underscore
+        rows = self.connection().execute('SELECT key FROM objects WHERE key > ? AND key < ?', (key + '_', key + '`'))
+        return [name for name, in rows if THUMBNAIL_KEY_RE.search(name) and name.rindex('_') == len(key)]
+
+    def resolve(self, key):
+        """ the key of the blob key refers to """
+        blob = self.blob_of(key)
+        return blob if blob != None else key
+
+    def blob_of(self, key):
+        """ the key of the blob key refers to, None if the index has no reference of key """
+        row = self.connection().execute('SELECT blob FROM refs WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def cache_reference(self, key, blob):
+        """ records a reference known from elsewhere, e.g. the image documents """
+        with self.connection() as conn:
+            conn.execute('INSERT OR IGNORE INTO refs (key, blob) VALUES (?, ?)', (key, blob))
+
+    def add_reference(self, key, sha1, size, record=None):
+        """
+        if an original with the same content is stored, key becomes a reference
+        to it and the key of that original is returned. otherwise key becomes
+        the first reference to itself and None is returned. record is called with
+        the original before key refers to it, e.g. to record the reference elsewhere.
+        """
+        with self.connection() as conn:
+            # no blob can be released between finding and referencing it
+            conn.execute('BEGIN IMMEDIATE')
+            blob = None
+            for candidate, in conn.execute('SELECT key FROM objects WHERE sha1 = ? AND size = ?', (sha1, size)):
+                if not THUMBNAIL_KEY_RE.search(candidate):
+                    blob = candidate
+                    break
+            if blob != None and record != None:
+                record(blob)
+            # originals stored before references were counted refer to themselves
+            if blob != None and not conn.execute('SELECT 1 FROM refs WHERE blob = ?', (blob,)).fetchone():
+                conn.execute('INSERT INTO refs (key, blob) VALUES (?, ?)', (blob, blob))
+            conn.execute('INSERT OR REPLACE INTO refs (key, blob) VALUES (?, ?)', (key, blob or key))
+            return blob
+
+    def remove_reference(self, key, referenced=None):
+        """
+        removes the reference of key. returns tuple(blob key, True if the blob is no
+        longer referenced). unreferenced blobs are removed from the index, so they
+        can't be referenced again while they are being deleted. if given, referenced
+        is called with the blob and decides instead of the references in the index.
+        """
+        with self.connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT blob FROM refs WHERE key = ?', (key,)).fetchone()
+            blob = row[0] if row else key
+            conn.execute('DELETE FROM refs WHERE key = ?', (key,))
+            if referenced != None:
+                if referenced(blob):
+                    return blob, False
+                conn.execute('DELETE FROM refs WHERE blob = ?', (blob,))
+            elif conn.execute('SELECT 1 FROM refs WHERE blob = ?', (blob,)).fetchone():
+                return blob, False
+            conn.execute('DELETE FROM objects WHERE key = ?', (blob,))
+            return blob, True
+
+    def replace_all(self, keys):
+        """ replaces the index with the given keys, e.g. from a bucket listing. metadata of known keys is kept """
+        self.misses.clear()
+        with self.connection() as conn:
+            conn.execute('CREATE TEMP TABLE IF NOT EXISTS listed (key TEXT PRIMARY KEY)')
+            conn.execute('DELETE FROM listed')
+            conn.executemany('INSERT OR IGNORE INTO listed (key) VALUES (?)', ((key,) for key in keys))
+            conn.execute('DELETE FROM objects WHERE key NOT IN (SELECT key FROM listed)')
+            conn.execute('INSERT OR IGNORE INTO objects (key) SELECT key FROM listed')
+            conn.execute('DELETE FROM listed')
 
 class SimpleS3Store(Store):
-    def __init__(self, credentials, bucket, baseurl, logger, prefix, cache=FileCache()):
+    def __init__(self, credentials, bucket, baseurl, logger, prefix, cache=FileCache(), **connection_params):
         self.credentials = credentials
         self.bucket_name = bucket
         self.prefix = prefix
         self.logger = logger
         self.baseurl = baseurl
         self.cache = cache
+        self.single_flight = SingleFlight(cache.cache_dir + '/.locks')
+        self.objects = ObjectIndex(cache.cache_dir + '/objects.sqlite')
+        # if set, missing thumbnails are created in the background
+        self.thumbnail_queue = None
+        # if set, the image documents, which record the blob of every key (see ImageDao.blob_key).
+        # the object index is a disposable cache of them
+        self.references = None
+        self.sender = FileSender()
+        # timeout, pool_size, max_retries and retry_backoff of the PooledS3Bucket
+        self.connection_params = connection_params
+        self.s3_bucket = None
+        self.s3_bucket_pid = None
+        self.s3_bucket_lock = threading.Lock()
 
-    # TODO is simples3.S3Bucket safe to re-use?
     def bucket(self):
-        return S3Bucket(str(self.bucket_name),
-                        str(self.credentials['aws_access_key_id']),
-                        str(self.credentials['aws_secret_access_key']),
-                        str(self.baseurl)) 
+        # one bucket per process is shared by all threads, forked processes create their own
+        with self.s3_bucket_lock:
+            if self.s3_bucket_pid != os.getpid():
+                self.s3_bucket = PooledS3Bucket(str(self.bucket_name),
+                                                str(self.credentials['aws_access_key_id']),
+                                                str(self.credentials['aws_secret_access_key']),
+                                                str(self.baseurl),
+                                                **self.connection_params)
+                self.s3_bucket_pid = os.getpid()
+            return self.s3_bucket
                                       
     def thumbnail_key(self, key, size):
         return key + ('_%sx%s' % (size))
+
+    def resolve(self, key):
+        """ the key of the stored original, which differs from key for duplicate uploads """
+        blob = self.objects.blob_of(self.prefix + key)
+        if blob != None:
+            return blob[len(self.prefix):]
+        blob_key = self.references.blob_key(key) if self.references != None else None
+        if blob_key == None:
+            return key
+        self.objects.cache_reference(self.prefix + key, self.prefix + blob_key)
+        return blob_key
     
     def default_headers(self, filename):
+        # store keys are never reused, so the objects can be cached forever
         return {'Content-Disposition': 'inline; filename=%s' % (filename,),
-                'Cache-Control': 'public max-age=86400'}
+                'Cache-Control': 'public, max-age=31536000, immutable'}
+
+    def open_original(self, key, b):
+        metadata = self.objects.metadata(self.prefix + key)
+        exts = (metadata['ext'],) if metadata != None else ('.jpg', '.png', '.gif')
+        for ext in exts:
+            if key + ext in self.cache:
+                return self.cache.open(key + ext)
+        response = b.get(self.prefix + key)
+        try:
+            with self.cache.open_atomic(key + exts[0]) as in_tmp:
+                copy_chunks(response, [in_tmp])
+        finally:
+            response.close()
+        return self.cache.open(key + exts[0])
 
     def create_thumbnail(self, key, size):
-        b = self.bucket()
-        s3_key = self.prefix + key
-        thumb_key = self.thumbnail_key(key, size)
+        self.create_thumbnails(key, [size])
 
-        if key in self.cache:
-            in_tmp = self.cache.open(key + '.jpg')
-        else:
-            # todo guess correct extension
-            in_tmp = self.cache.open(key + '.jpg', 'w+b')
-            in_tmp.write(b.get(s3_key).read())
-            in_tmp.seek(0)
+    def exists(self, s3_key, b=None):
+        known = self.objects.lookup(s3_key)
+        if known != None:
+            return known
         try:
-            img = Image.open(in_tmp)
-            out_tmp = self.cache.open(thumb_key + '.jpg', 'w+b')
+            (b or self.bucket()).info(s3_key)
+        except KeyError:
+            self.objects.add_miss(s3_key)
+            return False
+        self.objects.add(s3_key)
+        return True
+
+    def sync_objects(self):
+        """ rebuilds the index of existing objects from a bucket listing """
+        # listings are read to the end before their keys are used, a listing
+        # left half read would keep its connection out of the pool
+        s3_keys = [s3_key for s3_key, _, _, _ in self.bucket().listdir(self.prefix)]
+        self.objects.replace_all(s3_keys)
+
+    def create_thumbnails(self, key, sizes):
+        # keys of thumbnail jobs are resolved already or were saved on this host, workers
+        # of the thumbnail queue must not share the elasticsearch connections of their parent
+        key = self.objects.resolve(self.prefix + key)[len(self.prefix):]
+        b = self.bucket()
+        # concurrent requests for the same image wait for the first one and reuse its thumbnails
+        with self.single_flight.lock(key):
+            sizes = [size for size in sizes if not self.exists(self.prefix + self.thumbnail_key(key, size), b)]
+            if not sizes:
+                return
+            in_tmp = self.open_original(key, b)
             try:
-                resize(img, size, False, out_tmp)
-                out_tmp.seek(0)
-                thumb_s3_key = self.prefix + thumb_key
-                b.put(thumb_s3_key, out_tmp.read(), mimetype='image/jpeg',
-                      headers=self.default_headers(thumb_s3_key))
+                resize_all(Image.open(in_tmp), sizes,
+                           lambda size: self.cache.open_atomic(self.thumbnail_key(key, size) + '.jpg'))
             finally:
-                out_tmp.close()
-        finally:
-            in_tmp.close()
+                in_tmp.close()
+            for size in sizes:
+                thumb_key = self.thumbnail_key(key, size)
+                with self.cache.open(thumb_key + '.jpg') as out_tmp:
+                    thumb_s3_key = self.prefix + thumb_key
+                    metadata = image_metadata(out_tmp, 'image/jpeg')
+                    b.put(thumb_s3_key, out_tmp.read(), mimetype='image/jpeg',
+                          headers=self.default_headers(thumb_s3_key))
+                self.objects.add(thumb_s3_key, metadata)
 
     def deliver_image(self, key, size=None):
         check_store_key(key)
+        # the requested key, not the one of the shared original, is the etag the client knows
+        etag = self.thumbnail_key(key, size) if size else key
+        key = self.resolve(key)
         if size:
-            b = self.bucket()
-            try:
-                thumb_s3_key = self.prefix + self.thumbnail_key(key, size) 
-                b.info(thumb_s3_key)
-            except KeyError:
+            thumb_s3_key = self.prefix + self.thumbnail_key(key, size)
+            if not self.exists(thumb_s3_key):
+                if self.thumbnail_queue != None:
+                    retry = self.thumbnail_queue.create_or_retry(key, size)
+                    if retry != None:
+                        return retry
+                # creates it if the job failed or was rejected
                 self.create_thumbnail(key, size)
-            return self.deliver_file(thumb_s3_key)
+            return self.deliver_file(thumb_s3_key, etag)
         else:
-            return self.deliver_file(self.prefix + key)
+            return self.deliver_file(self.prefix + key, etag)
 
-    def deliver_file(self, s3_key):
+    def deliver_file(self, s3_key, etag=None):
         # check again if it's in the cache. if a thumbnail was newly
-        # created, it is now locally available. TODO guess extension?
+        # created, it is now locally available
         key_no_prefix = s3_key.replace(self.prefix, '')
-        exts = ('.jpg', '.png')
-        for ext in exts:
-            cache_key = key_no_prefix + ext
-            if cache_key in self.cache:
-                mimetype, _ = mimetypes.guess_type(cache_key)
-                return send_file(self.cache.path(cache_key), mimetype) 
+        etag = etag or key_no_prefix
+        metadata = self.objects.metadata(s3_key)
+        if metadata != None:
+            if key_no_prefix + metadata['ext'] in self.cache:
+                return self.sender.send(self.cache.path(key_no_prefix + metadata['ext']), metadata['mimetype'], etag)
+        else:
+            # objects stored before their metadata was recorded
+            for ext in ('.jpg', '.png'):
+                cache_key = key_no_prefix + ext
+                if cache_key in self.cache:
+                    mimetype, _ = mimetypes.guess_type(cache_key)
+                    return self.sender.send(self.cache.path(cache_key), mimetype, etag)
         url = self.bucket().make_url_authed(s3_key, 3600)
         return redirect(url, 307)
 
+    def object_info(self, key):
+        try:
+            info = self.bucket().info(self.prefix + key)
+        except KeyError:
+            return None
+        return info['size'], extension_for(info.get('mimetype', 'image/jpeg'))
+
+    def fetch_into_cache(self, key, ext):
+        written = 0
+        try:
+            response = self.bucket().get(self.prefix + key)
+        except KeyNotFound:
+            raise KeyError(key)
+        try:
+            with self.cache.open_atomic(key + ext) as cache_file:
+                while True:
+                    chunk = response.read(65536)
+                    if not chunk:
+                        break
+                    cache_file.write(chunk)
+                    written += len(chunk)
+        finally:
+            response.close()
+        return written
+
+    def manage_cache(self, log_file, max_size):
+        return self.cache.manage(log_file, max_size, self)
+
     def save(self, fp, mimetype='application/octet-stream'):
         key_name = unique_id()
         s3_key = self.prefix + key_name
-        # ".jpe" would have been my first choice for naming jpegs.. not
-        ext = mimetypes.guess_extension(mimetype).replace('jpe', 'jpg')
-        content = fp.read()
-        with self.cache.open(key_name + ext, 'w') as cache_file:
-            cache_file.write(content)
-        self.bucket().put(s3_key, content, mimetype=mimetype,
-                          headers=self.default_headers(s3_key + ext))
+        # the upload is copied to the cache file in chunks to learn its hash. unless the
+        # same content is already stored, the file is uploaded in parts, so memory use
+        # doesn't depend on the file size
+        head = fp.read(CHUNK_SIZE)
+        mimetype = sniff_mimetype(head, mimetype)
+        ext = extension_for(mimetype)
+        with self.cache.open_atomic(key_name + ext) as cache_file:
+            content_hash = copy_chunks(fp, [cache_file], head)
+            if self.objects.add_reference(s3_key, *content_hash, record=self.record_reference(key_name)) != None:
+                cache_file.discard()
+                return key_name
+            try:
+                cache_file.flush()
+                cache_file.seek(0)
+                with self.bucket().upload(s3_key, mimetype, self.default_headers(s3_key + ext)) as upload:
+                    copy_chunks(cache_file, [upload])
+                metadata = image_metadata(cache_file, mimetype, content_hash)
+            except Exception:
+                # nothing was stored under the key, later uploads of the content must not refer to it
+                self.objects.remove_reference(s3_key)
+                raise
+        # the name of the cache file and the content type of the object are already fixed
+        metadata.update(mimetype=mimetype, ext=ext)
+        self.objects.add(s3_key, metadata)
         return key_name
 
+    def record_reference(self, key_name):
+        """ the callback recording that a duplicate refers to its original in the image documents """
+        if self.references == None:
+            return None
+        def record(blob):
+            self.references.add_blob_reference(key_name, blob[len(self.prefix):])
+        return record
+
     def delete(self, key):
         check_store_key(key)
+        referenced = None
+        if self.references != None:
+            self.references.remove_blob_reference(key)
+            # images saved on other hosts may refer to the blob without this host knowing
+            referenced = lambda blob: self.references.count_blob_references(blob[len(self.prefix):]) > 0
+        blob, unreferenced = self.objects.remove_reference(self.prefix + key, referenced)
+        if not unreferenced:
+            return
         b = self.bucket()
-        for s3_key, _, _, _ in b.listdir(self.prefix + key):
+        for s3_key, _, _, _ in list(b.listdir(blob)):
             self.logger.info('deleting s3 key %s', s3_key)
             b.delete(s3_key)
+            self.objects.remove(s3_key)
+
+def store_from_config(config, logger, **connection):
+    """ the store configured by "store", connection overrides the simples3 connection options """
+    if config['store'] == 'simples3':
+        return SimpleS3Store(config['simples3']['credentials'],
+                             config['simples3']['bucket'],
+                             config['simples3']['baseurl'],
+                             logger,
+                             'images_',
+                             FileCache(config['cache']['basepath']),
+                             **dict(config['simples3'].get('connection', {}), **connection))
+    elif config['store'] == 'local':
+        return LocalStore(config['localstore']['basepath'])
+    raise Exception('no store backend configured, must be s3 or local')
@@ -0,0 +1,151 @@
+# encoding: utf-8
+import os, multiprocessing, threading, time, traceback
+from flask import Response
+
+# the store of a worker process, set by the pool initializer. the store is
+# inherited through fork, so it never needs to be pickled
+worker_store = None
+
+def init_worker(store):
+    global worker_store
+    worker_store = store
+
+def create_thumbnails_job(key, sizes, submitted_at):
+    started_at = time.time()
+    try:
+        worker_store.create_thumbnails(key, sizes)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    return key, sizes, error, started_at - submitted_at, time.time() - started_at
+
+class ThumbnailQueue(object):
+    """
+    creates thumbnails in a pool of worker processes. at most max_pending jobs
+    are admitted, further jobs are rejected and have to be submitted again later.
+    every web worker has its own pool, so processes defaults to 1.
+    """
+    def __init__(self, store, logger, processes=None, max_pending=64):
+        self.store = store
+        self.logger = logger
+        self.processes = processes or 1
+        self.max_pending = max_pending
+        self.pool = None
+        self.pool_pid = None
+        self.lock = threading.Lock()
+        # notified whenever a job is done
+        self.done = threading.Condition(self.lock)
+        # store key -> set of sizes which are being created
+        self.pending = {}
+        self.pending_jobs = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.total_duration = 0.0
+        self.max_latency = 0.0
+
+    def start(self):
+        """ creates the pool, which should happen before the process starts any threads """
+        if self.pool_pid != os.getpid():
+            # the threads of a pool inherited through fork don't run in this process
+            self.pool = multiprocessing.Pool(self.processes, init_worker, (self.store,))
+            self.pool_pid = os.getpid()
+
+    def get_pool(self):
+        if self.pool_pid != os.getpid():
+            self.logger.warning('creating the thumbnail pool on demand in process %s', os.getpid())
+            self.start()
+        return self.pool
+
+    def submit(self, key, sizes):
+        """ returns False if the job was rejected because too many jobs are pending """
+        with self.lock:
+            pending_sizes = self.pending.setdefault(key, set())
+            sizes = [size for size in sizes if size not in pending_sizes]
+            if not sizes:
+                return True
+            if self.pending_jobs >= self.max_pending:
+                self.rejected += 1
+                if not pending_sizes:
+                    del self.pending[key]
+                return False
+            pending_sizes.update(sizes)
+            self.pending_jobs += 1
+            self.submitted += 1
+            pool = self.get_pool()
+        pool.apply_async(create_thumbnails_job, (key, sizes, time.time()), callback=self.job_done)
+        return True
+
+    def job_done(self, result):
+        key, sizes, error, wait, duration = result
+        with self.lock:
+            self.pending_jobs -= 1
+            pending_sizes = self.pending.get(key, set())
+            pending_sizes.difference_update(sizes)
+            if not pending_sizes:
+                self.pending.pop(key, None)
+            if error == None:
+                self.completed += 1
+            else:
+                self.failed += 1
+            self.total_wait += wait
+            self.total_duration += duration
+            self.max_latency = max(self.max_latency, wait + duration)
+            self.done.notify_all()
+        if error != None:
+            self.logger.error('error while creating thumbnails %s for store_key %s:\n%s', sizes, key, error)
+
+    def wait(self, max_pending=0, interval=0.1):
+        """ blocks until no more than max_pending jobs are pending """
+        while True:
+            with self.lock:
+                if self.pending_jobs <= max_pending:
+                    return
+            time.sleep(interval)
+
+    def close(self):
+        """ waits for all jobs and stops the worker processes """
+        if self.pool != None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+            self.pool_pid = None
+
+    def wait_for(self, key, size, timeout):
+        """ blocks until the thumbnail of key in size is not pending anymore, False on timeout """
+        deadline = time.time() + timeout
+        with self.lock:
+            while size in self.pending.get(key, ()):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.done.wait(remaining)
+        return True
+
+    def create_or_retry(self, key, size, timeout=1.0):
+        """
+        submits the creation of the thumbnail and waits up to timeout seconds for it.
+        returns None if the job is done or was rejected, the caller then creates the
+        thumbnail if it is still missing. if the job is still pending, a 503 response
+        asks the client to retry a second later
+        """
+        if not self.submit(key, [size]) or self.wait_for(key, size, timeout):
+            return None
+        return Response('thumbnail is being created', status=503, mimetype='text/plain',
+                        headers={'Retry-After': '1', 'Cache-Control': 'no-cache, no-store'})
+
+    def stats(self):
+        with self.lock:
+            finished = self.completed + self.failed
+            return dict(processes=self.processes,
+                        max_pending=self.max_pending,
+                        pending=self.pending_jobs,
+                        submitted=self.submitted,
+                        completed=self.completed,
+                        failed=self.failed,
+                        rejected=self.rejected,
+                        avg_wait=self.total_wait / finished if finished else 0.0,
+                        avg_duration=self.total_duration / finished if finished else 0.0,
+                        max_latency=self.max_latency)
@@ -0,0 +1,137 @@
+# encoding: utf-8
+import os, json, time, uuid, fcntl, re
+from contextlib import contextmanager
+from storage import makedirs, CHUNK_SIZE
+
+UPLOAD_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+class UploadError(Exception):
+    pass
+
+class UnknownUpload(UploadError):
+    pass
+
+class OffsetMismatch(UploadError):
+    """ the chunk doesn't start where the received data ends """
+    def __init__(self, offset):
+        UploadError.__init__(self, 'expected chunk at offset %d' % (offset,))
+        self.offset = offset
+
+class ChunkedUploads(object):
+    """
+    files uploaded in chunks over several requests. every upload consists of
+    a data file, to which chunks are appended, and a json file describing it.
+    a client which lost its connection asks for the received offset and
+    continues from there. uploads not finished after max_age seconds are removed.
+    """
+    def __init__(self, directory, max_age=86400):
+        self.directory = directory
+        self.max_age = max_age
+
+    def path(self, upload_id, ext):
+        if not UPLOAD_ID_RE.match(upload_id):
+            raise UnknownUpload(upload_id)
+        return '%s/%s%s' % (self.directory, upload_id, ext)
+
+    def create(self, upload_group, filename, size=None):
+        """ returns the id of a new upload """
+        self.expire()
+        makedirs(self.directory)
+        upload_id = uuid.uuid4().hex
+        open(self.path(upload_id, '.data'), 'wb').close()
+        with open(self.path(upload_id, '.json'), 'w') as f:
+            json.dump(dict(upload_group=upload_group, filename=filename, size=size, created_at=time.time()), f)
+        return upload_id
+
+    def info(self, upload_id):
+        """ the description of the upload, including the number of bytes received as offset """
+        try:
+            with open(self.path(upload_id, '.json')) as f:
+                info = json.load(f)
+            info['offset'] = os.path.getsize(self.path(upload_id, '.data'))
+        except (IOError, OSError):
+            raise UnknownUpload(upload_id)
+        return info
+
+    @contextmanager
+    def locked_data(self, upload_id):
+        try:
+            f = open(self.path(upload_id, '.data'), 'r+b')
+        except IOError:
+            raise UnknownUpload(upload_id)
+        try:
+            # a client retrying a chunk while the first attempt is still running must not interleave
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield f
+        finally:
+            f.close()
+
+    def append(self, upload_id, offset, stream, length, total=None):
+        """
+        appends length bytes read from stream at offset and returns the new offset.
+        total is the size of the whole file if the client states it with the chunk
+        """
+        size = self.info(upload_id)['size']
+        if size != None and total != None and total != size:
+            raise UploadError('total of %d bytes differs from the announced size of %d bytes' % (total, size))
+        if size != None and offset + length > size:
+            raise UploadError('chunk exceeds the announced size of %d bytes' % (size,))
+        with self.locked_data(upload_id) as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() != offset:
+                raise OffsetMismatch(f.tell())
+            remaining = length
+            try:
+                while remaining > 0:
+                    chunk = stream.read(min(CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    remaining -= len(chunk)
+            finally:
+                # whatever arrived before the connection dropped is kept
+                f.flush()
+            return f.tell()
+
+    def open(self, upload_id):
+        """ opens the data of a complete upload """
+        info = self.info(upload_id)
+        if info['size'] != None and info['offset'] != info['size']:
+            raise OffsetMismatch(info['offset'])
+        return open(self.path(upload_id, '.data'), 'rb')
+
+    def take(self, upload_id):
+        """
+        opens the data of a complete upload and removes the upload, so concurrent
+        requests can't take it twice. the opened data stays readable
+        """
+        with self.locked_data(upload_id):
+            # the upload may have been taken while waiting for the lock
+            fp = self.open(upload_id)
+            self.remove(upload_id)
+            return fp
+
+    def remove(self, upload_id):
+        for ext in ('.data', '.json'):
+            try:
+                os.remove(self.path(upload_id, ext))
+            except OSError:
+                pass
+
+    def expire(self):
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in names:
+            upload_id, ext = os.path.splitext(name)
+            if ext != '.json':
+                continue
+            if not UPLOAD_ID_RE.match(upload_id):
+                continue
+            try:
+                expired = time.time() - os.path.getmtime(self.path(upload_id, '.data')) > self.max_age
+            except OSError:
+                expired = True
+            if expired:
+                self.remove(upload_id)
@@ -7,6 +7,14 @@ def check_store_key(store_key):
     if not re.match("^[0-9a-zA-Z_\-]+$", store_key):
         raise InvalidStoreKey()
 
+SIZE_UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+def parse_size(value):
+    """ bytes of a size like 500, 64K, 500M or 1.5G """
+    if value[-1].upper() in SIZE_UNITS:
+        return int(float(value[:-1]) * SIZE_UNITS[value[-1].upper()])
+    return int(value)
+
 def load_config():
     if os.environ.has_key('TAMARAW_CONFIG'):
         config_file = os.environ['TAMARAW_CONFIG']
@@ -27,3 +27,26 @@ class TestConfigDao(unittest.TestCase):
         self.assertTrue((not res.has_key('exists')) or not res['exists'])
         props = self.dao.get_property_config()
         self.assertEquals(ConfigDao.DEFAULT_PROPS, props)
+
+    def test_cached_until_ttl_expires(self):
+        props = self.dao.get_property_config()
+        other = ConfigDao({}, self.indexname)
+        other.update_property_config(props[:1])
+        self.assertEquals(props, self.dao.get_property_config())
+        self.dao.ttl = 0
+        self.assertEquals(props[:1], self.dao.get_property_config())
+
+    def test_missing_version_is_created(self):
+        self.dao.import_default_props()
+        self.dao.es.delete(self.dao.version_path())
+        other = ConfigDao({}, self.indexname)
+        other.get_property_config()
+        self.assertIsNotNone(other.version)
+        self.assertEquals(other.version, self.dao.fetch_version())
+
+    def test_lookup_tables(self):
+        self.assertEquals(u"Aufnahmeort", self.dao.get_property('prop_location')['human_de'])
+        self.assertIsNone(self.dao.get_property('prop_nonexisting'))
+        browse_keys = [prop['key'] for prop in self.dao.get_browse_properties()]
+        self.assertTrue('prop_tags' in browse_keys)
+        self.assertFalse('prop_title' in browse_keys)
@@ -0,0 +1,80 @@
+# encoding: utf-8
+import unittest, tempfile, threading, logging, time
+from tamaraw.facets import FacetCounts
+
+class StaticFacets:
+    def __init__(self, facets):
+        self.facets = facets
+
+    def get_facets(self, *keys):
+        return dict((key, self.facets.get(key, {})) for key in keys)
+
+class BlockingFacets(StaticFacets):
+    def __init__(self, facets):
+        StaticFacets.__init__(self, facets)
+        self.calls = 0
+        self.release = threading.Event()
+
+    def get_facets(self, *keys):
+        self.calls += 1
+        self.release.wait(5)
+        return StaticFacets.get_facets(self, *keys)
+
+class TestFacetCounts(unittest.TestCase):
+    def setUp(self):
+        self.counts = FacetCounts(tempfile.mkdtemp() + '/facets.sqlite', lambda: ['prop_location', 'prop_tags'])
+
+    def test_update_applies_differences(self):
+        self.counts.update(None, {'prop_location': u'Köln', 'prop_tags': [u'dom', u'rhein'], 'prop_title': u'x'})
+        self.counts.update(None, {'prop_location': u'Bonn', 'prop_tags': [u'rhein']})
+        self.assertEquals([(u'Bonn', 1), (u'Köln', 1)], self.counts.terms('prop_location'))
+        self.assertEquals([(u'dom', 1), (u'rhein', 2)], self.counts.terms('prop_tags'))
+        self.assertEquals([], self.counts.terms('prop_title'))
+        self.counts.update({'prop_location': u'Bonn', 'prop_tags': [u'rhein']},
+                           {'prop_location': u'Köln', 'prop_tags': [u'rhein', u'brücke'], 'prop_creation_year': 1950})
+        self.assertEquals([(u'Köln', 2)], self.counts.terms('prop_location'))
+        self.counts.update({'prop_location': u'Köln', 'prop_tags': [u'dom', u'rhein']}, None)
+        self.assertEquals([(u'brücke', 1), (u'rhein', 1)], self.counts.terms('prop_tags'))
+
+    def test_prefix_and_pages(self):
+        self.counts.replace('prop_location', {u'Bonn': 1, u'Köln': 3, u'Königswinter': 2, u'Kassel': 1, '': 4})
+        self.assertEquals([(u'Köln', 3), (u'Königswinter', 2)], self.counts.terms('prop_location', u'Kö'))
+        self.assertEquals([(u'Bonn', 1), (u'Kassel', 1)], self.counts.terms('prop_location', limit=2))
+        self.assertEquals([(u'Köln', 3)], self.counts.terms('prop_location', after=u'Kassel', limit=1))
+
+    def test_numeric_terms_sort_by_value(self):
+        self.counts.replace('prop_creation_year', {1950: 2, 850: 1, 2001: 1, 1949: 3})
+        self.assertEquals([(u'850', 1), (u'1949', 3)], self.counts.terms('prop_creation_year', limit=2, numeric=True))
+        self.assertEquals([(u'1950', 2), (u'2001', 1)],
+                          self.counts.terms('prop_creation_year', after=u'1949', numeric=True))
+        self.assertEquals([(u'1949', 3), (u'1950', 2)], self.counts.terms('prop_creation_year', u'19', numeric=True))
+
+    def test_recount_corrects_drift(self):
+        self.assertIsNone(self.counts.recounted_at('prop_location'))
+        self.counts.update(None, {'prop_location': u'Bonn'})
+        self.counts.recount(StaticFacets({'prop_location': {u'Köln': 2}, 'prop_tags': {1950: 1}}))
+        self.assertEquals([(u'Köln', 2)], self.counts.terms('prop_location'))
+        self.assertEquals([(u'1950', 1)], self.counts.terms('prop_tags'))
+        self.assertIsNotNone(self.counts.recounted_at('prop_location'))
+
+    def test_refresh_serves_stale_counts(self):
+        facets = BlockingFacets({'prop_location': {u'Köln': 2}})
+        facets.release.set()
+        self.counts.refresh(facets, 'prop_location', 60, logging.getLogger())
+        self.assertEquals([(u'Köln', 2)], self.counts.terms('prop_location'))
+        self.counts.refresh(facets, 'prop_location', 60, logging.getLogger())
+        self.assertEquals(1, facets.calls)
+        facets.facets = {'prop_location': {u'Bonn': 1}}
+        facets.release.clear()
+        for _ in xrange(3):
+            self.counts.refresh(facets, 'prop_location', -1, logging.getLogger())
+            self.assertEquals([(u'Köln', 2)], self.counts.terms('prop_location'))
+        facets.release.set()
+        deadline = time.time() + 5
+        while self.counts.recounting and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEquals(2, facets.calls)
+        self.assertEquals([(u'Bonn', 1)], self.counts.terms('prop_location'))
+
+if __name__ == '__main__':
+    unittest.main()
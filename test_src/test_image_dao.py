@@ -1,6 +1,8 @@
 # encoding: utf-8
-import unittest, time, uuid, rawes
-from tamaraw.dao import ImageDao
+import unittest, time, uuid, rawes, threading, requests
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from tamaraw.dao import ImageDao, ConfigDao, Batch, InvalidCursor, SearchError, connect
 from tamaraw.storage import unique_id
 from tamaraw.util import InvalidStoreKey
 from contracts.interface import ContractNotRespected
@@ -42,13 +44,156 @@ class TestImageDao(unittest.TestCase):
         self.assertEquals("foo.jpg", image['original_filename'])
         self.assertEquals("bar", image['prop$foo'])
 
+    def test_create_many(self):
+        upload_group = str(uuid.uuid4())
+        keys = [unique_id() for _ in xrange(3)]
+        self.assertEquals([None] * 3, self.dao.create_many(upload_group, [(key, key + '.jpg', {'prop_title': key}) for key in keys]))
+        for key in keys:
+            image = self.dao.get(key)
+            self.assertEquals((upload_group, key + '.jpg', key),
+                              (image['upload_group'], image['original_filename'], image['prop_title']))
+
+    def test_search_page_cursors(self):
+        upload_group = str(uuid.uuid4())
+        # created in one bulk request, all images share created_at and are ordered by the tiebreaker
+        self.dao.create_many(upload_group, [('key%d' % (i,), 'foo.jpg', {}) for i in xrange(5)])
+        self.dao.create(upload_group, 'newest', 'foo.jpg')
+        self.dao.refresh_indices()
+        pages = [self.dao.upload_group_by_creation(upload_group, 0, 2)]
+        while pages[-1]['next']:
+            pages.append(self.dao.upload_group_by_creation(upload_group, 0, 2, pages[-1]['next']))
+        keys = [[image['store_key'] for image in page['images']] for page in pages]
+        self.assertEquals(['newest', 'key4', 'key3', 'key2', 'key1', 'key0'], sum(keys, []))
+        self.assertEquals([(0, 6), (2, 6), (4, 6)], [(page['offset'], page['total']) for page in pages])
+        self.assertEquals(pages[0]['images'], self.dao.upload_group_by_creation(upload_group, 0, 2, pages[1]['prev'])['images'])
+        self.assertEquals(keys[1], [image['store_key'] for image in self.dao.upload_group_by_creation(upload_group, 2, 2)['images']])
+        self.assertRaises(InvalidCursor, self.dao.upload_group_by_creation, upload_group, 0, 2, 'nonsense')
+
     def test_get_facets(self):
+        ConfigDao({}, self.indexname).put_image_mapping([{'key': 'prop$foo', 'type': 'string', 'use_for_browse': True}])
         upload_group = str(uuid.uuid4())
         self.dao.create(upload_group, unique_id(), "foo1.jpg", **{'prop$foo': 'bar'})
         self.dao.create(upload_group, unique_id(), "foo2.jpg", **{'prop$foo': 'baz'})
+        self.dao.create(upload_group, unique_id(), "foo3.jpg", **{'prop$foo': 'baz quux'})
         self.dao.refresh_indices()
         facets = self.dao.get_facets('prop$foo')
-        self.assertEquals(facets['prop$foo'], {u'bar':1, u'baz':1})
+        # whole values are counted, not the analyzed terms
+        self.assertEquals(facets['prop$foo'], {u'bar':1, u'baz':1, u'baz quux':1})
+
+    def test_browse_matches_whole_values(self):
+        ConfigDao({}, self.indexname).put_image_mapping([{'key': 'prop$foo', 'type': 'string', 'use_for_browse': True}])
+        upload_group = str(uuid.uuid4())
+        self.dao.create(upload_group, 'KOELN', "foo1.jpg", **{'prop$foo': [u'Köln']})
+        self.dao.create(upload_group, 'KOELN_NORD', "foo2.jpg", **{'prop$foo': [u'Köln Nord', u'Bonn']})
+        self.dao.refresh_indices()
+        self.assertEquals(['KOELN'], [image['store_key'] for image in self.dao.browse('prop$foo', u'Köln', 0, 10)['images']])
+        self.assertEquals(['KOELN_NORD'], [image['store_key'] for image in self.dao.browse('prop$foo', u'Bonn', 0, 10)['images']])
+
+    def test_reindex_adds_raw_fields(self):
+        upload_group = str(uuid.uuid4())
+        self.dao.create(upload_group, unique_id(), "foo1.jpg", **{'prop$foo': 'bar baz'})
+        self.dao.refresh_indices()
+        ConfigDao({}, self.indexname).put_image_mapping([{'key': 'prop$foo', 'type': 'string', 'use_for_browse': True}])
+        self.assertEquals([1], list(self.dao.reindex()))
+        self.dao.refresh_indices()
+        self.assertEquals({u'bar baz': 1}, self.dao.get_facets('prop$foo')['prop$foo'])
+
+    def test_blob_references(self):
+        ConfigDao({}, self.indexname).put_image_mapping([])
+        self.dao.create('group', 'Abc-123', 'first.jpg')
+        self.dao.create('group', 'Def-456', 'second.jpg', blob_key='Abc-123')
+        self.dao.create('group', 'Ghi-789', 'other.jpg', blob_key='Ghi-789')
+        self.dao.create('group', 'Jkl-012', 'third.jpg', blob_key='abc-123')
+        self.assertEquals(('Abc-123', 'Abc-123', None),
+                          (self.dao.blob_key('Abc-123'), self.dao.blob_key('Def-456'), self.dao.blob_key('Unknown')))
+        self.dao.refresh_indices()
+        self.assertEquals(2, self.dao.count_blob_references('Abc-123'))
+        self.dao.delete('Abc-123')
+        self.dao.refresh_indices()
+        self.assertEquals(1, self.dao.count_blob_references('Abc-123'))
+        self.assertEquals(1, self.dao.count_blob_references('Ghi-789'))
+        # a duplicate whose image document isn't created yet
+        self.dao.add_blob_reference('Mno-345', 'Ghi-789')
+        self.assertEquals(2, self.dao.count_blob_references('Ghi-789'))
+        self.dao.remove_blob_reference('Mno-345')
+        self.assertEquals(1, self.dao.count_blob_references('Ghi-789'))
+
+    def test_batch_get_and_search(self):
+        upload_group = str(uuid.uuid4())
+        self.dao.create(upload_group, "abc123", "foo1.jpg", **{'prop$foo': 'bar'})
+        self.dao.refresh_indices()
+        batch = Batch(self.dao.es, self.indexname)
+        image = self.dao.get_deferred(batch, "abc123")
+        missing = self.dao.get_deferred(batch, "abc124")
+        self.dao.get_deferred(batch, "abc123")
+        search = self.dao.search_deferred(batch, self.dao.upload_group_query(upload_group), 0, 10)
+        self.assertEquals(3, len(batch.queued))
+        self.assertEquals("foo1.jpg", image.result()['original_filename'])
+        self.assertIsNone(missing.result())
+        images, total = search.result()
+        self.assertEquals(1, total)
+        self.assertEquals("abc123", images[0]['store_key'])
+
+    def test_batch_search_errors_are_raised(self):
+        self.dao.create(str(uuid.uuid4()), "abc123", "foo1.jpg")
+        self.dao.refresh_indices()
+        batch = Batch(self.dao.es, self.indexname)
+        failing = self.dao.search_deferred(batch, {'query': {'query_string': {'query': 'foo:('}}}, 0, 10)
+        self.assertRaises(SearchError, failing.result)
+
+    def test_daos_share_connection_pool(self):
+        self.assertIs(self.dao.es.connection, ConfigDao({}, self.indexname).es.connection)
+        self.assertIsNot(self.dao.es.connection, ImageDao({'pool_size': 2}, self.indexname).es.connection)
+
+class FakeElasticHandler(BaseHTTPRequestHandler):
+    """ answers every request with an empty object, "/slow" after a second, "/close" closes the connection """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path == '/slow':
+            time.sleep(1)
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        if self.path == '/close':
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write('{}')
+
+    def log_message(self, *args):
+        pass
+
+class FakeElasticServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # clients which timed out have closed their connection
+        pass
+
+class TestPooledConnection(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeElasticServer(('127.0.0.1', 0), FakeElasticHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.es = connect({'url': '127.0.0.1:%d' % (self.server.server_port,), 'timeout': 5, 'max_retries': 0})
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_reconnects_are_counted(self):
+        self.es.get('fast')
+        self.es.get('fast')
+        stats = self.es.connection.stats()
+        self.assertEquals((1, 0), (stats['connections_opened'], stats['reconnects']))
+        self.es.get('close')
+        self.es.get('fast')
+        stats = self.es.connection.stats()
+        self.assertEquals((1, 1), (stats['connections_opened'], stats['reconnects']))
+
+    def test_timeout_per_request(self):
+        self.assertRaises(requests.exceptions.Timeout, self.es.get, 'slow', timeout=0.2)
+        self.assertEquals({}, self.es.get('slow'))
 
 if __name__ == '__main__':
     unittest.main()
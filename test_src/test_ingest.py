@@ -0,0 +1,86 @@
+# encoding: utf-8
+import unittest, tempfile, logging, os
+from StringIO import StringIO
+from tamaraw.storage import LocalStore
+from tamaraw.ingest import Importer, Checkpoint, find_images, read_csv_properties, sidecar_properties
+
+class RejectingImageDao:
+    """ creates images in memory, except those whose filename contains "reject" """
+    def __init__(self):
+        self.images = {}
+        self.requests = 0
+
+    def create_many(self, upload_group, images):
+        self.requests += 1
+        errors = []
+        for store_key, filename, properties in images:
+            if 'reject' in filename:
+                errors.append('MapperParsingException')
+            else:
+                self.images[store_key] = dict(properties, upload_group=upload_group, original_filename=filename)
+                errors.append(None)
+        return errors
+
+    def refresh_indices(self):
+        pass
+
+class TestImporter(unittest.TestCase):
+    def setUp(self):
+        self.store = LocalStore(tempfile.mkdtemp())
+        self.dao = RejectingImageDao()
+        self.importer = Importer(self.store, self.dao, logging.getLogger(), workers=3)
+
+    def test_import_files(self):
+        files = [(StringIO('content %d' % (i,)), 'image%d.jpg' % (i,)) for i in xrange(5)]
+        files.append((StringIO('rejected content'), 'reject.jpg'))
+        results = self.importer.import_files('group', files)
+        self.assertEquals(1, self.dao.requests)
+        self.assertEquals(['image%d.jpg' % (i,) for i in xrange(5)] + ['reject.jpg'],
+                          [result['filename'] for result in results])
+        for i, result in enumerate(results[:5]):
+            self.assertIsNone(result['error'])
+            with open(self.store.path(result['store_key'])) as f:
+                self.assertEquals('content %d' % (i,), f.read())
+        self.assertEquals((None, 'MapperParsingException'), (results[5]['store_key'], results[5]['error']))
+        # the file of the rejected image was removed from the store again
+        self.assertEquals(5, len(list(self.store.files.names())))
+
+    def test_duplicates_record_their_blob(self):
+        # saved one after the other, concurrent saves of the same content may both be stored
+        importer = Importer(self.store, self.dao, logging.getLogger(), workers=1)
+        results = importer.import_files('group', [(StringIO('same'), 'a.jpg'), (StringIO('same'), 'b.jpg')])
+        first, second = [result['store_key'] for result in results]
+        self.assertEquals(set([first]), set(self.dao.images[key]['blob_key'] for key in (first, second)))
+
+class TestDirectoryIngest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        os.makedirs(self.directory + '/b/c')
+        for path in ('b/c/3.JPG', 'b/2.png', '1.jpg', 'notes.txt', '1.json'):
+            with open(self.directory + '/' + path, 'w') as f:
+                f.write('{"title": "eins", "prop_tags": ["a"]}' if path.endswith('.json') else path)
+
+    def test_find_images(self):
+        self.assertEquals(['1.jpg', 'b/2.png', 'b/c/3.JPG'], list(find_images(self.directory)))
+
+    def test_properties(self):
+        self.assertEquals({'prop_title': 'eins', 'prop_tags': ['a']}, sidecar_properties(self.directory + '/1.jpg'))
+        self.assertEquals({}, sidecar_properties(self.directory + '/b/2.png'))
+        with open(self.directory + '/meta.csv', 'w') as f:
+            f.write('filename,title,prop_location\nb/2.png,zwei,K\xc3\xb6ln\n3.JPG,drei,\n')
+        self.assertEquals({'b/2.png': {'prop_title': u'zwei', 'prop_location': u'K\xf6ln'},
+                           '3.JPG': {'prop_title': u'drei'}}, read_csv_properties(self.directory + '/meta.csv'))
+
+    def test_checkpoint(self):
+        path = self.directory + '/checkpoint'
+        checkpoint = Checkpoint(path, 'group1')
+        checkpoint.add('1.jpg', 'key1')
+        checkpoint.close()
+        checkpoint = Checkpoint(path, 'group2')
+        self.assertEquals('group1', checkpoint.upload_group)
+        self.assertTrue('1.jpg' in checkpoint)
+        self.assertFalse('b/2.png' in checkpoint)
+        checkpoint.close()
+
+if __name__ == '__main__':
+    unittest.main()
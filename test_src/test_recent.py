@@ -0,0 +1,35 @@
+# encoding: utf-8
+import unittest, tempfile, time
+from tamaraw.recent import RecentImages
+
+class TestRecentImages(unittest.TestCase):
+    def setUp(self):
+        self.recent = RecentImages(tempfile.mkdtemp() + '/recent.sqlite', ttl=60, refresh_interval=1)
+
+    def test_put_and_invalidate(self):
+        self.assertIsNone(self.recent.get())
+        self.recent.put({'hits': {'total': 1, 'hits': []}}, time.time())
+        self.assertEquals(1, self.recent.get()['hits']['total'])
+        self.recent.invalidate()
+        self.assertIsNone(self.recent.get())
+
+    def test_results_older_than_a_write_are_not_kept(self):
+        queried_at = time.time()
+        self.recent.invalidate()
+        self.recent.put({'hits': {'total': 1, 'hits': []}}, queried_at)
+        self.assertIsNone(self.recent.get())
+        # the write might not be searchable yet
+        self.recent.put({'hits': {'total': 1, 'hits': []}}, time.time())
+        self.assertIsNone(self.recent.get())
+        self.recent.refresh_interval = 0
+        self.recent.put({'hits': {'total': 1, 'hits': []}}, time.time())
+        self.assertIsNotNone(self.recent.get())
+
+    def test_expire(self):
+        self.recent.put({'hits': {'total': 1, 'hits': []}}, time.time())
+        self.recent.ttl = 0
+        time.sleep(0.01)
+        self.assertIsNone(self.recent.get())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,278 @@
+# encoding: utf-8
+import unittest, threading, tempfile, hashlib, urlparse, logging, os
+from StringIO import StringIO
+import Image
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from tamaraw.s3 import PooledS3Bucket
+from tamaraw.storage import SimpleS3Store, FileCache
+from tamaraw.prefetch import Prefetcher
+
+class FakeS3Handler(BaseHTTPRequestHandler):
+    """ keeps objects in memory and ignores authentication """
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def key(self):
+        return urlparse.urlsplit(self.path).path.split('/', 2)[2]
+
+    def query(self):
+        return urlparse.parse_qs(urlparse.urlsplit(self.path).query, keep_blank_values=True)
+
+    def listing(self):
+        prefix = urlparse.parse_qs(urlparse.urlsplit(self.path).query).get('prefix', [''])[0]
+        contents = ['<Contents><Key>%s</Key><LastModified>2016-10-18T12:00:00.000Z</LastModified>'
+                    '<ETag>&quot;%s&quot;</ETag><Size>%d</Size><Owner></Owner></Contents>'
+                    % (key, hashlib.md5(body).hexdigest(), len(body))
+                    for key, (body, _) in sorted(self.server.objects.items()) if key.startswith(prefix)]
+        return '<ListBucketResult>%s</ListBucketResult>' % (''.join(contents),)
+
+    def respond(self, status, body='', headers={}):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if 'partNumber' in self.query():
+            upload = self.server.uploads[self.query()['uploadId'][0]]
+            upload['parts'][int(self.query()['partNumber'][0])] = body
+            return self.respond(200, headers={'ETag': '"%s"' % (hashlib.md5(body).hexdigest(),)})
+        self.server.objects[self.key()] = (body, self.headers['Content-Type'])
+        self.respond(200)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if 'uploads' in self.query():
+            upload_id = 'upload%d' % (len(self.server.uploads),)
+            self.server.uploads[upload_id] = dict(mimetype=self.headers['Content-Type'], parts={})
+            return self.respond(200, '<InitiateMultipartUploadResult><UploadId>%s</UploadId>'
+                                     '</InitiateMultipartUploadResult>' % (upload_id,))
+        upload = self.server.uploads.pop(self.query()['uploadId'][0])
+        self.server.objects[self.key()] = (''.join(body for _, body in sorted(upload['parts'].items())),
+                                           upload['mimetype'])
+        self.respond(200, '<CompleteMultipartUploadResult></CompleteMultipartUploadResult>')
+
+    def do_GET(self):
+        if self.key() == '':
+            return self.respond(200, self.listing())
+        if self.key() not in self.server.objects:
+            return self.respond(404, '<Error><Message>not found</Message></Error>')
+        body, mimetype = self.server.objects[self.key()]
+        self.respond(200, body, {'Content-Type': mimetype})
+
+    do_HEAD = do_GET
+
+    def do_DELETE(self):
+        if 'uploadId' in self.query():
+            self.server.uploads.pop(self.query()['uploadId'][0])
+            return self.respond(204)
+        self.server.objects.pop(self.key(), None)
+        self.respond(204)
+
+    def log_message(self, *args):
+        pass
+
+class FakeS3Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FakeS3Handler)
+        self.objects = {}
+        self.uploads = {}
+        self.connections = 0
+
+class TestPooledS3Bucket(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeS3Server()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.bucket = PooledS3Bucket('bucket', 'access', 'secret',
+                                     'http://127.0.0.1:%s/bucket' % (self.server.server_port,),
+                                     timeout=5, pool_size=2)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_put_get_delete(self):
+        self.bucket.put('images_abc', 'foo', mimetype='image/jpeg')
+        self.assertEquals('foo', self.bucket.get('images_abc').read())
+        self.assertEquals('image/jpeg', self.bucket.info('images_abc')['mimetype'])
+        self.assertTrue(self.bucket.delete('images_abc'))
+        self.assertRaises(KeyError, self.bucket.info, 'images_abc')
+
+    def test_connection_is_reused(self):
+        for i in xrange(10):
+            self.bucket.put('images_%s' % (i,), 'foo')
+            self.assertTrue('images_%s' % (i,) in self.bucket)
+        self.assertEquals(1, self.server.connections)
+
+    def test_multipart_upload(self):
+        self.bucket.part_size = 5 * 1024 * 1024
+        content = os.urandom(1024 * 1024) * 11
+        with self.bucket.upload('images_big', 'image/jpeg') as upload:
+            for i in xrange(0, len(content), 1000000):
+                upload.write(content[i:i + 1000000])
+        self.assertEquals((content, 'image/jpeg'), self.server.objects['images_big'])
+        with self.bucket.upload('images_small', 'image/png') as upload:
+            upload.write('small')
+        self.assertEquals(('small', 'image/png'), self.server.objects['images_small'])
+        self.assertEquals({}, self.server.uploads)
+
+    def test_aborted_upload(self):
+        self.bucket.part_size = 5 * 1024 * 1024
+        try:
+            with self.bucket.upload('images_big', 'image/jpeg') as upload:
+                upload.write('x' * 6 * 1024 * 1024)
+                raise IOError('client went away')
+        except IOError:
+            pass
+        self.assertEquals(({}, {}), (self.server.objects, self.server.uploads))
+
+class ImageReferences:
+    """ the blob keys of images as recorded in their documents or before they are created """
+    def __init__(self, blobs):
+        self.blobs = blobs
+
+    def blob_key(self, store_key):
+        return self.blobs.get(store_key)
+
+    def add_blob_reference(self, store_key, blob_key):
+        self.blobs[store_key] = blob_key
+
+    def remove_blob_reference(self, store_key):
+        self.blobs.pop(store_key, None)
+
+    def count_blob_references(self, blob_key):
+        return self.blobs.values().count(blob_key)
+
+class TestSimpleS3Store(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeS3Server()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.store = SimpleS3Store({'aws_access_key_id': 'access', 'aws_secret_access_key': 'secret'}, 'bucket',
+                                   'http://127.0.0.1:%s/bucket' % (self.server.server_port,), logging.getLogger(),
+                                   'images_', FileCache(tempfile.mkdtemp()), timeout=5)
+        self.server.objects['images_abc'] = ('png content', 'image/png')
+        self.server.objects['images_abc_320x240'] = ('jpeg content', 'image/jpeg')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def prefetch(self, selection='all'):
+        prefetcher = Prefetcher(self.store, threads=2, out=StringIO())
+        return prefetcher.run(prefetcher.select(selection))
+
+    def test_prefetch_and_resume(self):
+        # left over by an interrupted run
+        with self.store.cache.open('abc.jpg', 'w') as f:
+            f.write('png')
+        stats = self.prefetch('originals')
+        self.assertEquals(1, stats['fetched'])
+        self.assertEquals(['abc.png'], list(self.store.cache.files.names()))
+        stats = self.prefetch()
+        self.assertEquals((1, 1), (stats['fetched'], stats['skipped']))
+        with self.store.cache.open('abc_320x240.jpg') as f:
+            self.assertEquals('jpeg content', f.read())
+
+    def test_streaming_save(self):
+        self.store.bucket().part_size = 5 * 1024 * 1024
+        original = StringIO()
+        Image.new('RGB', (64, 48)).save(original, 'PNG')
+        # trailing garbage makes the upload large enough for several parts
+        content = original.getvalue() + os.urandom(1024 * 1024) * 6
+        key = self.store.save(StringIO(content), 'image/jpeg')
+        self.assertEquals((content, 'image/png'), self.server.objects['images_' + key])
+        with self.store.cache.open(key + '.png') as f:
+            self.assertEquals(content, f.read())
+        metadata = self.store.objects.metadata('images_' + key)
+        self.assertEquals((hashlib.sha1(content).hexdigest(), len(content), 64, 48),
+                          (metadata['sha1'], metadata['size'], metadata['width'], metadata['height']))
+
+    def test_references_survive_the_object_index(self):
+        first = self.store.save(StringIO('same content'))
+        second = self.store.save(StringIO('same content'))
+        # another host with an empty index
+        store = SimpleS3Store({'aws_access_key_id': 'access', 'aws_secret_access_key': 'secret'}, 'bucket',
+                              self.store.baseurl, logging.getLogger(), 'images_', FileCache(tempfile.mkdtemp()),
+                              timeout=5)
+        store.references = ImageReferences({first: first, second: first})
+        self.assertEquals(first, store.resolve(second))
+        del store.references.blobs[first]
+        store.delete(first)
+        self.assertTrue('images_' + first in self.server.objects)
+        del store.references.blobs[second]
+        store.delete(second)
+        self.assertFalse('images_' + first in self.server.objects)
+
+    def test_duplicates_are_referenced_before_their_documents_exist(self):
+        self.store.references = ImageReferences({})
+        first = self.store.save(StringIO('same content'))
+        second = self.store.save(StringIO('same content'))
+        self.assertEquals({second: first}, self.store.references.blobs)
+        # the image of first is deleted, its original is kept with its metadata for the duplicate
+        self.store.delete(first)
+        self.assertTrue('images_' + first in self.server.objects)
+        self.assertEquals(len('same content'), self.store.objects.metadata('images_' + first)['size'])
+        third = self.store.save(StringIO('same content'))
+        self.assertEquals({second: first, third: first}, self.store.references.blobs)
+        self.store.delete(second)
+        self.assertTrue('images_' + first in self.server.objects)
+        self.store.delete(third)
+        self.assertFalse('images_' + first in self.server.objects)
+        self.assertEquals({}, self.store.references.blobs)
+
+    def test_failed_upload_is_not_referenced(self):
+        b = self.store.bucket()
+        def failing_put(*args, **kwargs):
+            raise IOError('connection reset')
+        b.put = failing_put
+        self.assertRaises(IOError, self.store.save, StringIO('same content'))
+        del b.put
+        self.assertEquals([], self.store.objects.connection().execute('SELECT key FROM refs').fetchall())
+        key = self.store.save(StringIO('same content'))
+        self.assertEquals('same content', self.server.objects['images_' + key][0])
+
+    def test_failed_download_releases_its_connection(self):
+        b = self.store.bucket()
+        class FullDisk(object):
+            def __enter__(self):
+                return self
+            def __exit__(self, *exc_info):
+                return False
+            def write(self, data):
+                raise IOError('disk full')
+        self.store.cache.open_atomic = lambda name: FullDisk()
+        self.assertRaises(IOError, self.store.open_original, 'abc', b)
+        del self.store.cache.open_atomic
+        with self.store.open_original('abc', b) as f:
+            self.assertEquals('png content', f.read())
+        self.assertEquals(1, self.server.connections)
+
+    def test_duplicate_upload_is_not_stored_again(self):
+        first = self.store.save(StringIO('same content'))
+        second = self.store.save(StringIO('same content'))
+        self.assertEquals(['images_' + first], [key for key in self.server.objects if key.startswith('images_' + first)])
+        self.assertFalse('images_' + second in self.server.objects)
+        with self.store.cache.open(first + '.jpg', 'w') as f:
+            f.write('same content')
+        self.assertEquals(first, self.store.resolve(second))
+        self.store.delete(first)
+        self.assertTrue('images_' + first in self.server.objects)
+        self.store.delete(second)
+        self.assertFalse('images_' + first in self.server.objects)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+# encoding: utf-8
+import unittest, tempfile, time
+from tamaraw.snapshots import ResultSnapshots
+
+class TestResultSnapshots(unittest.TestCase):
+    def setUp(self):
+        self.snapshots = ResultSnapshots(tempfile.mkdtemp() + '/snapshots.sqlite', max_entries=2, ttl=60)
+
+    def test_create_and_get(self):
+        snapshot_id = self.snapshots.create('search:foo', 10, ['a', 'b', 'c'], 42)
+        snapshot = self.snapshots.get(snapshot_id)
+        self.assertEquals(('search:foo', 10, 42, ['a', 'b', 'c']),
+                          (snapshot['result_set'], snapshot['start'], snapshot['total'], snapshot['keys']))
+        self.assertIsNone(self.snapshots.get('unknown'))
+
+    def test_oldest_are_removed(self):
+        first = self.snapshots.create('recent_images', 0, ['a'], 1)
+        second = self.snapshots.create('recent_images', 0, ['b'], 1)
+        time.sleep(0.01)
+        self.snapshots.get(first)
+        self.snapshots.create('recent_images', 0, ['c'], 1)
+        self.assertIsNone(self.snapshots.get(first))
+        self.assertIsNotNone(self.snapshots.get(second))
+
+    def test_latest_covering_offset(self):
+        self.snapshots.max_entries = 10
+        self.snapshots.create('recent_images', 0, ['a', 'b'], 4)
+        time.sleep(0.01)
+        newest = self.snapshots.create('recent_images', 0, ['a', 'c'], 4)
+        self.snapshots.create('recent_images', 2, ['d', 'e'], 4)
+        self.snapshots.create('search:foo', 0, ['a', 'b'], 2)
+        self.assertEquals(newest, self.snapshots.latest('recent_images', 1, 60)['id'])
+        self.assertEquals(['d', 'e'], self.snapshots.latest('recent_images', 3, 60)['keys'])
+        self.assertIsNone(self.snapshots.latest('recent_images', 4, 60))
+        time.sleep(0.01)
+        self.assertIsNone(self.snapshots.latest('recent_images', 1, 0))
+
+    def test_expire(self):
+        snapshot_id = self.snapshots.create('recent_images', 0, ['a'], 1)
+        self.snapshots.ttl = 0
+        time.sleep(0.01)
+        self.assertIsNone(self.snapshots.get(snapshot_id))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,13 +1,17 @@
 # encoding: utf-8
 import unittest
 from StringIO import StringIO
+import Image
 from tamaraw.storage import LocalStore
 from tamaraw.storage import unique_id
+from tamaraw.storage import store_from_config, snap_size, AtomicFile, SingleFlight, ObjectIndex, FileCache, FileSender, parse_log_time
+from flask import Flask
+import tempfile, threading, os, time, hashlib
 from tamaraw.dao import check_store_key
 
 class TestLocalStore(unittest.TestCase):
     def setUp(self):
-        self.store = LocalStore('/tmp')
+        self.store = LocalStore(tempfile.mkdtemp())
 
     def test_create_and_retrieve(self):
         store_key = self.store.save(StringIO("foo"))
@@ -19,5 +23,242 @@ class TestLocalStore(unittest.TestCase):
             store_key = unique_id()
             check_store_key(store_key)
 
+    def test_create_thumbnails(self):
+        original = StringIO()
+        Image.new('RGB', (2000, 1500)).save(original, 'JPEG')
+        original.seek(0)
+        store_key = self.store.save(original)
+        self.store.create_thumbnails(store_key, [(320, 240), (1280, 960), (400, 400)])
+        for size, expected in (((320, 240), (320, 240)), ((1280, 960), (1280, 960)), ((400, 400), (400, 300))):
+            self.assertEquals(expected, Image.open(self.store.thumbnail_path(store_key, size)).size)
+        metadata = self.store.objects.metadata(self.store.thumbnail_key(store_key, (400, 400)))
+        self.assertEquals(('image/jpeg', '.jpg', 400, 300), (metadata['mimetype'], metadata['ext'],
+                                                             metadata['width'], metadata['height']))
+
+    def test_metadata_is_recorded_on_save(self):
+        original = StringIO()
+        Image.new('RGB', (64, 48)).save(original, 'PNG')
+        content = original.getvalue()
+        original.seek(0)
+        # the mimetype derived from the file name is wrong, the content decides
+        store_key = self.store.save(original, 'image/jpeg')
+        metadata = self.store.objects.metadata(store_key)
+        self.assertEquals(dict(mimetype='image/png', ext='.png', size=len(content), width=64, height=48,
+                               sha1=hashlib.sha1(content).hexdigest()), metadata)
+        with Flask(__name__).test_request_context('/files/' + store_key):
+            response = self.store.deliver_image(store_key)
+            self.assertEquals('image/png', response.mimetype)
+
+    def test_sharded_layout_and_migration(self):
+        root = tempfile.mkdtemp()
+        store = LocalStore(root)
+        for name in ('FLATKEY', 'FLATKEY_320x240', 'objects.sqlite'):
+            with open(root + '/' + name, 'w') as f:
+                f.write(name)
+        new_key = store.save(StringIO('new'))
+        self.assertEquals(store.files.sharded_path(new_key), store.path(new_key))
+        # reads fall back to the flat layout until the files are migrated
+        self.assertEquals(root + '/FLATKEY', store.path('FLATKEY'))
+        self.assertEquals([1, 2], list(store.files.migrate(batch_size=1)))
+        self.assertEquals(store.files.sharded_path('FLATKEY'), store.path('FLATKEY'))
+        # thumbnails share the directory of their original
+        self.assertEquals(os.path.dirname(store.path('FLATKEY')), os.path.dirname(store.thumbnail_path('FLATKEY', (320, 240))))
+        with open(store.thumbnail_path('FLATKEY', (320, 240))) as f:
+            self.assertEquals('FLATKEY_320x240', f.read())
+        self.assertEquals(set(['FLATKEY', 'FLATKEY_320x240', new_key]), set(store.files.names()))
+        self.assertTrue(os.path.exists(root + '/objects.sqlite'))
+
+    def test_duplicates_share_the_original(self):
+        store = LocalStore(tempfile.mkdtemp())
+        first = store.save(StringIO('same content'))
+        second = store.save(StringIO('same content'))
+        other = store.save(StringIO('other content'))
+        self.assertNotEquals(first, second)
+        self.assertEquals(store.path(first), store.path(second))
+        self.assertNotEquals(store.path(first), store.path(other))
+        self.assertEquals(2, len(list(store.files.names())))
+        path = store.path(first)
+        store.delete(first)
+        with open(store.path(second)) as f:
+            self.assertEquals('same content', f.read())
+        store.delete(second)
+        self.assertFalse(os.path.exists(path))
+        # the content is stored again once all references are gone
+        third = store.save(StringIO('same content'))
+        self.assertEquals(store.files.sharded_path(third), store.path(third))
+
+    def test_ranges_of_duplicates_use_the_requested_etag(self):
+        store = LocalStore(tempfile.mkdtemp())
+        first = store.save(StringIO('same content'))
+        second = store.save(StringIO('same content'))
+        self.assertEquals(first, store.resolve(second))
+        with Flask(__name__).test_request_context('/files/' + second,
+                                                  headers={'Range': 'bytes=0-3', 'If-Range': '"%s"' % (second,)}):
+            response = store.deliver_image(second)
+            self.assertEquals(206, response.status_code)
+            self.assertEquals('same', ''.join(response.response))
+
+    def test_delete_removes_thumbnails(self):
+        store = LocalStore(tempfile.mkdtemp())
+        original = StringIO()
+        Image.new('RGB', (640, 480)).save(original, 'JPEG')
+        first = store.save(StringIO(original.getvalue()))
+        second = store.save(StringIO(original.getvalue()))
+        store.create_thumbnails(second, [(320, 240), (400, 400)])
+        self.assertEquals(3, len(list(store.files.names())))
+        store.delete(first)
+        self.assertEquals(3, len(list(store.files.names())))
+        store.delete(second)
+        self.assertEquals([], list(store.files.names()))
+        self.assertEquals([], store.objects.connection().execute('SELECT key FROM objects').fetchall())
+
+    def test_store_from_config(self):
+        root = tempfile.mkdtemp()
+        store = store_from_config({'store': 'local', 'localstore': {'basepath': root}}, None)
+        self.assertEquals(root, store.root)
+        self.assertRaises(Exception, store_from_config, {'store': 'ftp'}, None)
+
+    def test_atomic_file(self):
+        path = tempfile.mkdtemp() + '/atomic'
+        with AtomicFile(path) as f:
+            f.write('foo')
+            self.assertFalse(os.path.exists(path))
+        with open(path) as f:
+            self.assertEquals('foo', f.read())
+        try:
+            with AtomicFile(path) as f:
+                f.write('bar')
+                raise ValueError()
+        except ValueError:
+            pass
+        with open(path) as f:
+            self.assertEquals('foo', f.read())
+        self.assertEquals(['atomic'], os.listdir(os.path.dirname(path)))
+
+    def test_single_flight(self):
+        single_flight = SingleFlight(tempfile.mkdtemp())
+        active = []
+        overlaps = []
+        def work():
+            with single_flight.lock('abc'):
+                overlaps.append(len(active))
+                active.append(1)
+                time.sleep(0.01)
+                active.pop()
+        threads = [threading.Thread(target=work) for _ in xrange(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals([0] * 5, overlaps)
+        self.assertEquals({}, single_flight.locks)
+
+    def test_object_index(self):
+        index = ObjectIndex(tempfile.mkdtemp() + '/objects.sqlite', negative_ttl=60)
+        self.assertIsNone(index.lookup('images_abc'))
+        index.add_miss('images_abc')
+        self.assertFalse(index.lookup('images_abc'))
+        index.add('images_abc')
+        self.assertTrue(index.lookup('images_abc'))
+        self.assertTrue(ObjectIndex(index.path).lookup('images_abc'))
+        index.remove('images_abc')
+        self.assertIsNone(index.lookup('images_abc'))
+        index.add('images_def', dict(mimetype='image/jpeg', size=3, width=1, height=1, ext='.jpg', sha1='x'))
+        self.assertIsNone(index.metadata('images_ghi'))
+        index.replace_all(['images_def', 'images_ghi'])
+        self.assertTrue(index.lookup('images_ghi'))
+        self.assertEquals('image/jpeg', index.metadata('images_def')['mimetype'])
+
+    def test_snap_size(self):
+        ladder = [(640, 480), (320, 240)]
+        self.assertEquals((320, 240), snap_size((100, 100), ladder))
+        self.assertEquals((320, 240), snap_size((320, 240), ladder))
+        self.assertEquals((640, 480), snap_size((321, 240), ladder))
+        self.assertEquals((640, 480), snap_size((5000, 10), ladder))
+
+class DictSource:
+    def __init__(self, cache, objects):
+        self.cache = cache
+        self.objects = objects
+
+    def object_info(self, key):
+        if key not in self.objects:
+            return None
+        return len(self.objects[key]), '.jpg'
+
+    def fetch_into_cache(self, key, ext):
+        with self.cache.open(key + ext, 'w') as f:
+            f.write(self.objects[key])
+        return len(self.objects[key])
+
+class TestFileCache(unittest.TestCase):
+    LOG_LINE = '127.0.0.1 - - [%s] "GET /files/%s HTTP/1.1" %s 100 "-" "Mozilla/5.0"\n'
+
+    def setUp(self):
+        self.cache = FileCache(tempfile.mkdtemp())
+        self.log_file = self.cache.cache_dir + '/.access.log'
+
+    def write_log(self, requests):
+        with open(self.log_file, 'w') as f:
+            for timestamp, key, status in requests:
+                f.write(self.LOG_LINE % (timestamp, key, status))
+
+    def test_parse_log_time(self):
+        self.assertEquals(0, parse_log_time('01/Jan/1970:01:00:00 +0100'))
+        self.assertEquals(3600, parse_log_time('01/Jan/1970:00:00:00 -0100'))
+
+    def test_manage(self):
+        for key in ('cold', 'warm'):
+            with self.cache.open(key + '.jpg', 'w') as f:
+                f.write('x' * 10)
+        self.write_log([('18/Oct/2016:10:00:00 +0000', 'cold', 200),
+                        ('18/Oct/2016:12:00:00 +0000', 'warm', 200),
+                        ('18/Oct/2016:12:00:00 +0000', 'hot_320x240', 200),
+                        ('18/Oct/2016:12:00:01 +0000', 'hot_320x240', 200),
+                        ('18/Oct/2016:12:00:01 +0000', 'gone', 404),
+                        ('18/Oct/2016:12:00:01 +0000', 'missing', 200)])
+        source = DictSource(self.cache, {'hot_320x240': 'y' * 10})
+        report = self.cache.manage(self.log_file, 20, source, now=parse_log_time('18/Oct/2016:12:00:01 +0000'))
+        self.assertEquals(['hot_320x240.jpg', 'warm.jpg'], sorted(name for name, _ in self.cache.entries().values()))
+        self.assertEquals(5, report['requests'])
+        self.assertEquals(10, report['bytes_evicted'])
+        self.assertEquals(10, report['bytes_fetched'])
+        self.assertAlmostEquals(0.4, report['hit_ratio_before'])
+        self.assertAlmostEquals(0.6, report['hit_ratio_after'])
+
+class TestFileSender(unittest.TestCase):
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.root = tempfile.mkdtemp()
+        self.path = self.root + '/KEY'
+        with open(self.path, 'w') as f:
+            f.write('0123456789')
+
+    def send(self, sender, headers={}):
+        with self.app.test_request_context('/files/KEY', headers=headers):
+            response = sender.send(self.path, 'image/jpeg', 'KEY')
+            return response.status_code, response.headers, ''.join(response.response)
+
+    def test_range(self):
+        sender = FileSender()
+        status, headers, data = self.send(sender, {'Range': 'bytes=2-4'})
+        self.assertEquals((206, '234', 'bytes 2-4/10', '3'),
+                          (status, data, headers['Content-Range'], headers['Content-Length']))
+        self.assertEquals('789', self.send(sender, {'Range': 'bytes=-3'})[2])
+        self.assertEquals(416, self.send(sender, {'Range': 'bytes=20-'})[0])
+        self.assertEquals(206, self.send(sender, {'Range': 'bytes=2-4', 'If-Range': '"KEY"'})[0])
+        status, _, data = self.send(sender, {'Range': 'bytes=2-4', 'If-Range': '"OTHER"'})
+        self.assertEquals((200, '0123456789'), (status, data))
+
+    def test_offload(self):
+        sender = FileSender('x-accel-redirect', {self.root + '/': '/internal/files'})
+        status, headers, data = self.send(sender)
+        self.assertEquals((200, '/internal/files/KEY', ''), (status, headers['X-Accel-Redirect'], data))
+        sender = FileSender('x-sendfile')
+        self.assertEquals(self.path, self.send(sender)[1]['X-Sendfile'])
+        # files outside of the configured roots are sent by the worker
+        sender = FileSender('x-accel-redirect', {'/elsewhere': '/internal/files'})
+        self.assertEquals('0123456789', self.send(sender)[2])
+
 if __name__ == '__main__':
     unittest.main()
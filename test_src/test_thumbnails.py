@@ -0,0 +1,68 @@
+# encoding: utf-8
+import unittest, tempfile, shutil, logging, time, os
+from StringIO import StringIO
+import Image
+from tamaraw.storage import LocalStore
+from tamaraw.thumbnails import ThumbnailQueue
+from flask import Flask
+
+app = Flask('test_thumbnails')
+
+class TestThumbnailQueue(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store = LocalStore(self.root)
+        self.queue = ThumbnailQueue(self.store, logging.getLogger(), processes=1, max_pending=1)
+        self.queue.start()
+        self.store.thumbnail_queue = self.queue
+        original = StringIO()
+        Image.new('RGB', (800, 600)).save(original, 'JPEG')
+        original.seek(0)
+        self.store_key = self.store.save(original)
+
+    def tearDown(self):
+        if self.queue.pool != None:
+            self.queue.pool.terminate()
+        shutil.rmtree(self.root)
+
+    def wait_for_jobs(self):
+        for _ in xrange(100):
+            if self.queue.stats()['pending'] == 0:
+                return
+            time.sleep(0.05)
+
+    def test_waits_for_the_job(self):
+        with app.test_request_context('/files/%s_320x240' % (self.store_key,)):
+            rv = self.store.deliver_image(self.store_key, (320, 240))
+        self.assertEquals(200, rv.status_code)
+        self.assertEquals('image/jpeg', rv.mimetype)
+        self.assertTrue(os.path.exists(self.store.thumbnail_path(self.store_key, (320, 240))))
+        self.assertEquals(1, self.queue.stats()['completed'])
+
+    def test_created_in_the_request_when_full(self):
+        self.queue.submit(self.store_key, [(640, 480)])
+        with app.test_request_context('/files/%s_320x240' % (self.store_key,)):
+            rv = self.store.deliver_image(self.store_key, (320, 240))
+        self.assertEquals(200, rv.status_code)
+        self.assertTrue(os.path.exists(self.store.thumbnail_path(self.store_key, (320, 240))))
+        self.assertEquals(1, self.queue.stats()['rejected'])
+        self.wait_for_jobs()
+
+    def test_unavailable_while_pending(self):
+        # a job of another request which is still running
+        self.queue.pending[self.store_key] = set([(320, 240)])
+        with app.test_request_context('/files/%s_320x240' % (self.store_key,)):
+            rv = self.store.deliver_image(self.store_key, (320, 240))
+        self.assertEquals(503, rv.status_code)
+        self.assertEquals('1', rv.headers['Retry-After'])
+        self.assertTrue(rv.cache_control.no_store)
+
+    def test_rejects_when_full(self):
+        self.assertTrue(self.queue.submit(self.store_key, [(320, 240)]))
+        self.assertTrue(self.queue.submit(self.store_key, [(320, 240)]))
+        self.assertFalse(self.queue.submit(self.store_key, [(640, 480)]))
+        self.assertEquals(1, self.queue.stats()['rejected'])
+        self.wait_for_jobs()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+# encoding: utf-8
+import unittest, tempfile, os, time
+from StringIO import StringIO
+from tamaraw.uploads import ChunkedUploads, UploadError, UnknownUpload, OffsetMismatch
+
+class FailingStream:
+    """ delivers some data and then behaves like a dropped connection """
+    def __init__(self, data):
+        self.data = StringIO(data)
+
+    def read(self, n):
+        chunk = self.data.read(n)
+        if not chunk:
+            raise IOError('connection reset')
+        return chunk
+
+class TestChunkedUploads(unittest.TestCase):
+    def setUp(self):
+        self.uploads = ChunkedUploads(tempfile.mkdtemp() + '/uploads')
+
+    def test_resume_after_dropped_connection(self):
+        upload_id = self.uploads.create('group', 'scan.jpg', 10)
+        self.assertEquals(4, self.uploads.append(upload_id, 0, StringIO('0123'), 4))
+        self.assertRaises(IOError, self.uploads.append, upload_id, 4, FailingStream('45'), 6)
+        # the part received before the connection dropped is kept
+        info = self.uploads.info(upload_id)
+        self.assertEquals((6, 'group', 'scan.jpg'), (info['offset'], info['upload_group'], info['filename']))
+        self.assertRaises(OffsetMismatch, self.uploads.open, upload_id)
+        self.assertEquals(10, self.uploads.append(upload_id, 6, StringIO('6789'), 4))
+        with self.uploads.open(upload_id) as f:
+            self.assertEquals('0123456789', f.read())
+        self.uploads.remove(upload_id)
+        self.assertRaises(UnknownUpload, self.uploads.info, upload_id)
+
+    def test_rejects_wrong_offsets_and_sizes(self):
+        upload_id = self.uploads.create('group', 'scan.jpg', 4)
+        self.uploads.append(upload_id, 0, StringIO('01'), 2)
+        try:
+            self.uploads.append(upload_id, 0, StringIO('01'), 2)
+            self.fail()
+        except OffsetMismatch as e:
+            self.assertEquals(2, e.offset)
+        self.assertRaises(UploadError, self.uploads.append, upload_id, 2, StringIO('234'), 3)
+        self.assertRaises(UploadError, self.uploads.append, upload_id, 2, StringIO('23'), 2, 5)
+        self.assertRaises(UnknownUpload, self.uploads.info, '../../etc/passwd')
+
+    def test_take_once(self):
+        upload_id = self.uploads.create('group', 'scan.jpg', 4)
+        self.assertRaises(OffsetMismatch, self.uploads.take, upload_id)
+        self.uploads.append(upload_id, 0, StringIO('0123'), 4, 4)
+        with self.uploads.take(upload_id) as f:
+            self.assertRaises(UnknownUpload, self.uploads.take, upload_id)
+            self.assertEquals('0123', f.read())
+
+    def test_expire(self):
+        uploads = ChunkedUploads(self.uploads.directory, max_age=60)
+        old = uploads.create('group', 'old.jpg')
+        past = time.time() - 120
+        os.utime(uploads.path(old, '.data'), (past, past))
+        new = uploads.create('group', 'new.jpg')
+        self.assertRaises(UnknownUpload, uploads.info, old)
+        self.assertEquals(0, uploads.info(new)['offset'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,6 @@
 import time
 import os
+import re
 import tempfile
 import json
 import rawes
@@ -77,6 +78,47 @@ class TamarawTestCase(unittest.TestCase):
         self.assertOk(rv)
         assert 'test title' in rv.data
 
+    def test_thumbnail_size_is_snapped_to_ladder(self):
+        rv = self.app.get('/files/TEST_300x200')
+        self.assertEqual('302 FOUND', rv.status)
+        self.assertEqual('http://localhost/files/TEST_320x240', rv.headers['Location'])
+        self.assertEqual('public, max-age=3600', rv.headers['Cache-Control'])
+
+    def test_conditional_get(self):
+        rv = self.app.get('/files/TEST', headers={'If-None-Match': '"TEST"'})
+        self.assertEqual('304 NOT MODIFIED', rv.status)
+        assert 'immutable' in rv.headers['Cache-Control']
+        tamaraw.image_dao.create('asdf', 'TEST', 'foo.jpg', prop_title='test title')
+        tamaraw.image_dao.refresh_indices()
+        rv = self.app.get('/image/TEST')
+        self.assertOk(rv)
+        etag = rv.headers['ETag']
+        rv = self.app.get('/image/TEST', headers={'If-None-Match': etag})
+        self.assertEqual('304 NOT MODIFIED', rv.status)
+        self.assertEqual('', rv.data)
+        self.login_as_admin()
+        rv = self.app.get('/image/TEST', headers={'If-None-Match': etag})
+        self.assertOk(rv)
+
+    def test_result_set_navigation(self):
+        for store_key in ('TEST1', 'TEST2', 'TEST3'):
+            tamaraw.image_dao.create('asdf', store_key, 'foo.jpg', prop_title='title ' + store_key)
+            time.sleep(0.01)
+        tamaraw.image_dao.refresh_indices()
+        rv = self.app.get('/image/TEST2?r=recent_images&o=1')
+        self.assertOk(rv)
+        next_url = re.search(r'href="(/image/TEST1\?[^"]*s=[^"]*)"', rv.data).group(1).replace('&amp;', '&')
+        # another click from the result list shares the snapshot
+        rv = self.app.get('/image/TEST3?r=recent_images&o=0')
+        self.assertOk(rv)
+        self.assertEquals(re.search(r's=(\w+)', next_url).group(1), re.search(r's=(\w+)', rv.data).group(1))
+        # new uploads change the order of the result set, but not of the snapshot
+        tamaraw.image_dao.create('asdf', 'TEST4', 'foo.jpg', prop_title='title TEST4')
+        tamaraw.image_dao.refresh_indices()
+        rv = self.app.get(next_url)
+        self.assertOk(rv)
+        assert 'title TEST1' in rv.data
+
     def test_login(self):
         rv = self.login_as_admin()
         self.assertOk(rv)
@@ -134,6 +176,8 @@ class TamarawTestCase(unittest.TestCase):
         assert 'baz quux' in rv.data
 
     def test_browse_tags(self):
+        # browse pages look up the raw sub-fields of the mapping
+        tamaraw.config_dao.put_image_mapping(tamaraw.config_dao.get_property_config())
         tamaraw.image_dao.create('asdf', 'TEST1', 'foo.jpg', prop_title='foo bar',
                                  prop_tags=['alfalfa graybeard thriller cowslip'])
         tamaraw.image_dao.create('asdf', 'TEST2', 'foo.jpg', prop_title='baz quux',
@@ -173,6 +217,26 @@ class TamarawTestCase(unittest.TestCase):
         self.assertOk(rv)
         assert 'Spam Subscriber' not in rv.data
 
+    def test_chunked_upload(self):
+        self.login_as_admin()
+        rv = self.app.post('/upload/group1/chunked', data={'filename': 'scan.jpg', 'size': '6'})
+        upload_url = '/upload/group1/chunked/' + json.loads(rv.data)['upload_id']
+        rv = self.app.put(upload_url, data='foo', headers={'Content-Range': 'bytes 0-2/7'})
+        self.assertEquals('400 BAD REQUEST', rv.status)
+        rv = self.app.put(upload_url, data='foo', headers={'Content-Range': 'bytes 0-2/6'})
+        self.assertEquals(3, json.loads(rv.data)['offset'])
+        rv = self.app.post(upload_url + '/finalize')
+        self.assertEquals('409 CONFLICT', rv.status)
+        rv = self.app.put(upload_url, data='bar', headers={'Content-Range': 'bytes 3-5/6'})
+        self.assertEquals(6, json.loads(self.app.get(upload_url).data)['offset'])
+        rv = self.app.post(upload_url + '/finalize')
+        self.assertOk(rv)
+        store_key = json.loads(rv.data)['store_key']
+        self.assertEquals('404 NOT FOUND', self.app.post(upload_url + '/finalize').status)
+        with open(tamaraw.store.path(store_key)) as f:
+            self.assertEquals('foobar', f.read())
+        self.assertEquals('scan.jpg', tamaraw.image_dao.get(store_key)['original_filename'])
+
     def test_delete_image(self):
         self.login_as_admin()
         tamaraw.image_dao.create('asdf', 'TEST', 'foo.jpg', prop_title='test title')